@@ -0,0 +1,213 @@
+'''
+Class to handle the configuration of many rigid bodies
+as a structure of arrays. The locations are stored in an array
+with shape (Nbodies, 3) and the orientations (quaternions) in
+an array with shape (Nbodies, 4), so the integrators can update
+all the bodies, compute the blobs coordinates and apply the
+geometric matrix K without loops over bodies.
+
+The reference configurations are grouped by structure, i.e.
+all the bodies with the same reference configuration are
+rotated at once.
+
+The Body objects are kept in sync with the arrays, body.location*
+and body.orientation* are views of rows of the arrays, so the
+functions that work with Body objects (forces, slip, preconditioners...)
+see the same configuration.
+'''
+import numpy as np
+from quaternion_integrator import quaternion
+from quaternion_integrator.quaternion import Quaternion
+
+
+class BodiesArray(object):
+  '''
+  Structure of arrays with the configuration of all the bodies.
+  '''
+  def __init__(self, bodies):
+    '''
+    Constructor. Take a list (or array) of Body objects.
+    '''
+    self.bodies = bodies
+    self.Nbodies = len(bodies)
+    # Number of blobs per body and offset of the first blob of each body
+    self.Nblobs_bodies = np.array([b.Nblobs for b in bodies], dtype=int)
+    self.Nblobs = np.sum(self.Nblobs_bodies)
+    self.blobs_offset = np.zeros(self.Nbodies + 1, dtype=int)
+    self.blobs_offset[1:] = np.cumsum(self.Nblobs_bodies)
+    # Body lengths, used by the RFD schemes
+    self.body_length = np.array([b.body_length for b in bodies], dtype=float)
+
+    # Locations with shape (Nbodies, 3) and orientations with shape (Nbodies, 4)
+    self.location = np.array([b.location for b in bodies], dtype=float).reshape((self.Nbodies, 3))
+    self.location_new = np.array([b.location_new for b in bodies], dtype=float).reshape((self.Nbodies, 3))
+    self.location_old = np.array([b.location_old for b in bodies], dtype=float).reshape((self.Nbodies, 3))
+    self.orientation = np.array([b.orientation.entries for b in bodies], dtype=float).reshape((self.Nbodies, 4))
+    self.orientation_new = np.array([b.orientation_new.entries for b in bodies], dtype=float).reshape((self.Nbodies, 4))
+    self.orientation_old = np.array([b.orientation_old.entries for b in bodies], dtype=float).reshape((self.Nbodies, 4))
+
+    # Group bodies by reference configuration. For each structure
+    # save the reference configuration with shape (Nblobs_structure, 3),
+    # the indices of its bodies and the indices of its blobs with
+    # shape (Nbodies_structure, Nblobs_structure).
+    self.reference_configurations = []
+    self.structure_bodies = []
+    self.structure_blobs = []
+    structures = {}
+    for k, b in enumerate(bodies):
+      key = (b.Nblobs, b.reference_configuration.tostring())
+      if key not in structures:
+        structures[key] = len(self.reference_configurations)
+        self.reference_configurations.append(np.copy(b.reference_configuration))
+        self.structure_bodies.append([])
+      self.structure_bodies[structures[key]].append(k)
+    for i, ref in enumerate(self.reference_configurations):
+      self.structure_bodies[i] = np.array(self.structure_bodies[i], dtype=int)
+      self.structure_blobs.append(self.blobs_offset[self.structure_bodies[i]][:, None] + np.arange(ref.shape[0]))
+
+    # Make the Body objects views of the arrays
+    for k, b in enumerate(bodies):
+      b.location = self.location[k]
+      b.location_new = self.location_new[k]
+      b.location_old = self.location_old[k]
+      b.orientation = Quaternion(self.orientation[k])
+      b.orientation_new = Quaternion(self.orientation_new[k])
+      b.orientation_old = Quaternion(self.orientation_old[k])
+    return
+
+
+  def get_configuration(self, configuration = 'current'):
+    '''
+    Return the arrays (location, orientation) of the configuration
+    'current', 'new' or 'old'.
+    '''
+    if configuration == 'current':
+      return self.location, self.orientation
+    elif configuration == 'new':
+      return self.location_new, self.orientation_new
+    elif configuration == 'old':
+      return self.location_old, self.orientation_old
+
+
+  def copy_configuration(self, origin = 'current', target = 'old'):
+    '''
+    Copy the configuration origin to the configuration target.
+    '''
+    location_origin, orientation_origin = self.get_configuration(origin)
+    location_target, orientation_target = self.get_configuration(target)
+    np.copyto(location_target, location_origin)
+    np.copyto(orientation_target, orientation_origin)
+    return
+
+
+  def update_configuration(self, velocities, dt, origin = 'current', target = 'new', do_rotation = True):
+    '''
+    Move the bodies from the configuration origin with the
+    velocities during a time dt and save the result in the
+    configuration target. dt can be a scalar or an array
+    with shape (Nbodies, 1).
+
+    The linear and angular velocities are sorted like
+    velocities = (v_1, w_1, v_2, w_2, ...)
+    where v_i and w_i are the linear and angular velocities of body i.
+    '''
+    velocities = np.reshape(velocities, (self.Nbodies, 6))
+    location_origin, orientation_origin = self.get_configuration(origin)
+    location_target, orientation_target = self.get_configuration(target)
+    location_target[:] = location_origin + velocities[:, 0:3] * dt
+    if do_rotation:
+      orientation_target[:] = quaternion.product_array(quaternion.from_rotation_array(velocities[:, 3:6] * dt), orientation_origin)
+    else:
+      np.copyto(orientation_target, orientation_origin)
+    return
+
+
+  def rotation_matrices(self, configuration = 'current'):
+    '''
+    Return the rotation matrices of all the bodies with
+    shape (Nbodies, 3, 3). See Quaternion.rotation_matrix.
+    '''
+    return quaternion.rotation_matrix_array(self.get_configuration(configuration)[1])
+
+
+  def get_blobs_offsets(self, configuration = 'current'):
+    '''
+    Return the blobs coordinates relative to the
+    center of their bodies, shape (Nblobs, 3).
+    '''
+    R = self.rotation_matrices(configuration)
+    r_offsets = np.empty((self.Nblobs, 3))
+    for ref, body_index, blob_index in zip(self.reference_configurations, self.structure_bodies, self.structure_blobs):
+      r_offsets[blob_index] = np.einsum('kij,bj->kbi', R[body_index], ref)
+    return r_offsets
+
+
+  def get_blobs_r_vectors(self, configuration = 'current'):
+    '''
+    Return coordinates of all the blobs with shape (Nblobs, 3).
+    '''
+    location = self.get_configuration(configuration)[0]
+    return self.get_blobs_offsets(configuration) + np.repeat(location, self.Nblobs_bodies, axis=0)
+
+
+  def check_function(self, configuration = 'current', distance = 0.0):
+    '''
+    Check that no body crossed the wall, i.e., all
+    blobs have z > distance. See Body.check_function.
+    '''
+    r_vectors = self.get_blobs_r_vectors(configuration)
+    return not np.any(r_vectors[:, 2] < distance)
+
+
+  def K_matrix_vector_prod(self, vector, configuration = 'current'):
+    '''
+    Compute the product K*vector, i.e., the velocity of the
+    blobs v + w x r for the bodies velocities vector.
+    Return an array with shape (Nblobs, 3).
+    '''
+    velocities = np.reshape(vector, (self.Nbodies, 6))
+    R = self.rotation_matrices(configuration)
+    result = np.empty((self.Nblobs, 3))
+    for ref, body_index, blob_index in zip(self.reference_configurations, self.structure_bodies, self.structure_blobs):
+      r_offsets = np.einsum('kij,bj->kbi', R[body_index], ref)
+      result[blob_index] = velocities[body_index, None, 0:3] + np.cross(velocities[body_index, None, 3:6], r_offsets)
+    return result
+
+
+  def K_matrix_T_vector_prod(self, vector, configuration = 'current'):
+    '''
+    Compute the product K^T*vector, i.e., the force and torque
+    on the bodies for the blobs forces vector.
+    Return an array with shape (2*Nbodies, 3).
+    '''
+    lambda_blobs = np.reshape(vector, (self.Nblobs, 3))
+    R = self.rotation_matrices(configuration)
+    result = np.empty((self.Nbodies, 2, 3))
+    for ref, body_index, blob_index in zip(self.reference_configurations, self.structure_bodies, self.structure_blobs):
+      r_offsets = np.einsum('kij,bj->kbi', R[body_index], ref)
+      lambda_structure = lambda_blobs[blob_index]
+      result[body_index, 0] = np.sum(lambda_structure, axis=1)
+      result[body_index, 1] = np.sum(np.cross(r_offsets, lambda_structure), axis=1)
+    return np.reshape(result, (2 * self.Nbodies, 3))
+
+
+  def calc_K_matrix(self, configuration = 'current'):
+    '''
+    Calculate the geometric block-diagonal matrix K.
+    Shape (3*Nblobs, 6*Nbodies).
+    '''
+    r_offsets = self.get_blobs_offsets(configuration)
+    body_index = np.repeat(np.arange(self.Nbodies), self.Nblobs_bodies)
+    K = np.zeros((self.Nblobs, 3, self.Nbodies, 6))
+    blob_index = np.arange(self.Nblobs)
+    for i in range(3):
+      K[blob_index, i, body_index, i] = 1.0
+    # Rotational part, (R x)_i = -(r_i cross x)
+    K[blob_index, 0, body_index, 4] = r_offsets[:, 2]
+    K[blob_index, 0, body_index, 5] = -r_offsets[:, 1]
+    K[blob_index, 1, body_index, 3] = -r_offsets[:, 2]
+    K[blob_index, 1, body_index, 5] = r_offsets[:, 0]
+    K[blob_index, 2, body_index, 3] = r_offsets[:, 1]
+    K[blob_index, 2, body_index, 4] = -r_offsets[:, 0]
+    return np.reshape(K, (3 * self.Nblobs, 6 * self.Nbodies))
+
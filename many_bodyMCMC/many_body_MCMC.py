@@ -12,9 +12,12 @@ while found_functions is False:
   try:
     import many_body_potential_pycuda 
     from body import body
+    from body.bodies_array import BodiesArray
+    from quaternion_integrator import quaternion
     from quaternion_integrator.quaternion import Quaternion
     from read_input import read_input
     from read_input import read_vertex_file, read_clones_file
+    from read_input import clones_binary_file
     import utils
     found_functions = True
   except ImportError:
@@ -123,10 +126,16 @@ if __name__ == '__main__':
   acceptance_ratio = 0.5
 
   # Create blobs coordinates array
-  sample_r_vectors = get_blobs_r_vectors(bodies, Nblobs)
+  bodies_array = BodiesArray(bodies)
+  sample_r_vectors = bodies_array.get_blobs_r_vectors()
 
   # begin MCMC
   # get energy of the current state before jumping into the loop
+  # Open binary trajectory file
+  if read.save_clones == 'binary':
+    clones_writer = clones_binary_file.ClonesBinaryWriter(read.output_name + '.clones.bin', read.structures_ID, body_types, 
+                                                          mode = 'w' if read.initial_step == 0 else 'a')
+
   start_time = time.time()
   current_state_energy = many_body_potential_pycuda.compute_total_energy(bodies,
                                                                          sample_r_vectors,
@@ -138,22 +147,17 @@ if __name__ == '__main__':
                                                                          weight = weight,
                                                                          blob_radius = blob_radius)
 
-  # quaternion to be used for disturbing the orientation of each body
-  quaternion_shift = Quaternion(np.array([1,0,0,0]))
-
   # for each step in the Markov chain, disturb each body's location and orientation and obtain the new list of r_vectors
   # of each blob. Calculate the potential of the new state, and accept or reject it according to the Markov chain rules:
   # 1. if Ej < Ei, always accept the state  2. if Ej < Ei, accept the state according to the probability determined by
   # exp(-(Ej-Ei)/kT). Then record data.
   # Important: record data also when staying in the same state (i.e. when a sample state is rejected)
   for step in range(read.initial_step, read.n_steps):
-    blob_index = 0
-    for i, body in enumerate(bodies): # distrub bodies
-      body.location_new = body.location + np.random.uniform(-max_translation, max_translation, 3) # make small change to location
-      quaternion_shift = Quaternion.from_rotation(np.random.normal(0,1,3) * max_angle_shift)
-      body.orientation_new = quaternion_shift * body.orientation
-      sample_r_vectors[blob_index : blob_index + bodies[i].Nblobs] = body.get_r_vectors(body.location_new, body.orientation_new)
-      blob_index += body.Nblobs
+    # distrub bodies, make small change to locations and orientations
+    bodies_array.location_new[:] = bodies_array.location + np.random.uniform(-max_translation, max_translation, (num_bodies, 3))
+    quaternion_shift = quaternion.from_rotation_array(np.random.normal(0, 1, (num_bodies, 3)) * max_angle_shift)
+    bodies_array.orientation_new[:] = quaternion.product_array(quaternion_shift, bodies_array.orientation)
+    sample_r_vectors = bodies_array.get_blobs_r_vectors('new')
 
     # calculate potential of proposed new state
     sample_state_energy = many_body_potential_pycuda.compute_total_energy(bodies,
@@ -171,8 +175,7 @@ if __name__ == '__main__':
       current_state_energy = sample_state_energy
       accepted_moves += 1
       acceptance_ratio = acceptance_ratio * 0.95 + 0.05
-      for body in bodies:
-        body.location, body.orientation = body.location_new, body.orientation_new
+      bodies_array.copy_configuration(origin = 'new', target = 'current')
     else:
       acceptance_ratio = acceptance_ratio * 0.95
 	
@@ -224,9 +227,13 @@ if __name__ == '__main__':
                                                      orientation[2], 
                                                      orientation[3]))
             body_offset += body_types[i]
+      elif read.save_clones == 'binary':
+        clones_writer.write(step, 
+                            np.array([b.location for b in bodies]), 
+                            np.array([b.orientation.entries for b in bodies]))
       else:
         print 'Error, save_clones =', read.save_clones, 'is not implemented.'
-        print 'Use \"one_file_per_step\" or \"one_file\". \n'
+        print 'Use \"one_file_per_step\", \"one_file\" or \"binary\". \n'
         break
 
   # Save final data if...
@@ -269,9 +276,13 @@ if __name__ == '__main__':
                                                    orientation[2], 
                                                    orientation[3]))
           body_offset += body_types[i]
+    elif read.save_clones == 'binary':
+      clones_writer.write(step+1, 
+                          np.array([b.location for b in bodies]), 
+                          np.array([b.orientation.entries for b in bodies]))
     else:
       print 'Error, save_clones =', read.save_clones, 'is not implemented.'
-      print 'Use \"one_file_per_step\" or \"one_file\". \n'
+      print 'Use \"one_file_per_step\", \"one_file\" or \"binary\". \n'
 
 
 
@@ -280,6 +291,10 @@ if __name__ == '__main__':
   print 'accepted_moves = ', accepted_moves
   print 'Total time = ', end_time
 
+  # Close binary trajectory file
+  if read.save_clones == 'binary':
+    clones_writer.close()
+
   # Save wallclock time 
   with open(read.output_name + '.time', 'w') as f:
     f.write(str(time.time() - start_time) + '\n')
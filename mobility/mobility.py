@@ -5,6 +5,8 @@ import sys
 sys.path.append('../')
 import time
 import imp
+import itertools
+import multiprocessing.pool
 
 # Try to import the mobility boost implementation
 try:
@@ -252,6 +254,70 @@ def boosted_no_wall_mobility_vector_product(r_vectors, vector, eta, a, *args, **
   return vector_res
 
 
+def boosted_mobility_matrix_product(r_vectors, F, eta, a, *args, **kwargs):
+  ''' 
+  Compute the product M * F, with F an array (3*Nblobs, k), boosted
+  in C++. The blocks of each pair of blobs are computed once for
+  the k columns. It includes wall corrections.
+  Must compile mobility_ext.cc before this will work 
+  (use Makefile).
+
+  For blobs overlaping the wall we use
+  Compute M = B^T * M_tilde(z_effective) * B.
+  '''
+  L = kwargs.get('periodic_length', np.array([0.0, 0.0, 0.0]))
+  # Get effective height
+  r_vectors_effective = shift_heights(r_vectors, a)
+  # Compute damping matrix B
+  B, overlap = damping_matrix_B(r_vectors, a, *args, **kwargs)
+  # Compute B * F
+  if overlap is True:
+    F = B.dot(F)
+  # Compute M_tilde * B * F
+  num_particles = r_vectors.size / 3
+  num_columns = F.shape[1]
+  res = np.zeros(F.size)
+  r_vec_for_mob = np.reshape(r_vectors_effective, (r_vectors_effective.size / 3, 3))  
+  me.mobility_matrix_product(r_vec_for_mob, eta, a, num_particles, num_columns, L, np.ascontiguousarray(F).flatten(), res)
+  res = np.reshape(res, (3 * num_particles, num_columns))
+  # Compute B.T * M * B * F
+  if overlap is True:
+    res = B.dot(res)
+  return res
+
+
+def boosted_no_wall_mobility_matrix_product(r_vectors, F, eta, a, *args, **kwargs):
+  ''' 
+  Compute the product M * F, with F an array (3*Nblobs, k), boosted
+  in C++. The blocks of each pair of blobs are computed once for
+  the k columns. It uses the RPY tensor.
+  Must compile mobility_ext.cc before this will work 
+  (use Makefile).
+  '''
+  L = kwargs.get('periodic_length', np.array([0.0, 0.0, 0.0]))
+  num_particles = r_vectors.size / 3
+  num_columns = F.shape[1]
+  res = np.zeros(F.size)
+  r_vec_for_mob = np.reshape(r_vectors, (r_vectors.size / 3, 3))  
+  me.no_wall_mobility_matrix_product(r_vec_for_mob, eta, a, num_particles, num_columns, L, np.ascontiguousarray(F).flatten(), res)
+  return np.reshape(res, (3 * num_particles, num_columns))
+
+
+def mobility_matrix_product_columns(r_vectors, F, eta, a, *args, **kwargs):
+  '''
+  Compute the product M * F, with F an array (3*Nblobs, k), calling
+  the function mobility_vector_prod (keyword argument) once per
+  column. It is used by the implementations without a batched
+  kernel (pycuda and tree); the other keyword arguments are
+  passed to mobility_vector_prod.
+  '''
+  mobility_vector_prod = kwargs.pop('mobility_vector_prod')
+  res = np.empty(F.shape)
+  for k in range(F.shape[1]):
+    res[:, k] = mobility_vector_prod(r_vectors, np.ascontiguousarray(F[:, k]), eta, a, *args, **kwargs)
+  return res
+
+
 def single_wall_mobility_trans_times_force_pycuda(r_vectors, force, eta, a, *args, **kwargs):
   ''' 
   Returns the product of the mobility at the blob level by the force 
@@ -613,6 +679,153 @@ def rotne_prager_tensor(r_vectors, eta, a, *args, **kwargs):
         fluid_mobility[(j*3):(j*3 + 3), (k*3):(k*3 + 3)] = ((1./(6.*np.pi*eta*a)) * np.identity(3))
   return fluid_mobility
 
+def rotne_prager_tensor_coefficients(r_norm, a, *args, **kwargs):
+  '''
+  Return the coefficients C1 and C2 of the Rotne-Prager tensor,
+  C1 * I + C2 * r r^T / r**2, for an array of distances r_norm.
+  '''
+  far = r_norm > 2.*a
+  inv_r = 1. / np.where(far, r_norm, 2.*a)
+  inv_r3 = inv_r * inv_r * inv_r
+  # Constants for far RPY tensor and, for r <= 2a, C3 -> C1 and C4 -> C2
+  C1 = np.where(far, (3.*a/4.)*inv_r + (a**3/2.)*inv_r3, 1. - (9./(32.*a))*r_norm)
+  C2 = np.where(far, (3.*a/4.)*inv_r - (3.*a**3/2.)*inv_r3, (3./(32.*a))*r_norm)
+  return C1, C2
+
+
+def rotne_prager_tensor_blocks(r, a, *args, **kwargs):
+  '''
+  Return the 3x3 Rotne-Prager blocks, without the 1/(6*pi*eta*a)
+  prefactor, for an array of displacements r = r_target - r_source
+  with shape (..., 3). The output has shape (..., 3, 3).
+  Displacements equal to zero give the self mobility (identity).
+  '''
+  r_norm = np.sqrt(np.sum(r * r, axis=-1))
+  C1, C2 = rotne_prager_tensor_coefficients(r_norm, a)
+  r_norm = np.maximum(r_norm, np.finfo(float).eps)
+  return (C1[..., None, None] * np.identity(3) +
+          (C2 / r_norm**2)[..., None, None] * r[..., :, None] * r[..., None, :])
+
+
+def single_wall_correction_coefficients(r, h, a, *args, **kwargs):
+  '''
+  Return the unit vector e and the coefficients of the wall correction
+  from Appendix C of the Swan and Brady paper for an array of
+  displacements r = r_target - r_source with shape (..., 3) and the
+  (effective) heights h of the source blobs. The correction block is
+
+  W = c_ee * e e^T + c_id * I + c_ee3 * e e_3^T + c_e3e * e_3 e^T + c_e3e3 * e3 e3^T / e_z**2
+
+  with e_3 = (0, 0, e_z). Returns (e, c_ee, c_id, c_ee3, c_e3e, c_e3e3).
+  '''
+  R = r / a
+  R[..., 2] += 2. * h / a
+  R_norm = np.sqrt(np.sum(R * R, axis=-1))
+  e = R / R_norm[..., None]
+  ez2 = e[..., 2]**2
+  h_hat = h / (a * R[..., 2])
+  inv_R = 1. / R_norm
+  inv_R2 = inv_R * inv_R
+  inv_R3 = inv_R * inv_R2
+  inv_R5 = inv_R3 * inv_R2
+  c_ee = -0.25*(3.*(1. - 6.*h_hat*(1. - h_hat)*ez2)*inv_R
+                - 6.*(1. - 5.*ez2)*inv_R3
+                + 10.*(1. - 7.*ez2)*inv_R5)
+  c_id = -0.25*(3.*(1. + 2.*h_hat*(1. - h_hat)*ez2)*inv_R
+                + 2.*(1. - 3.*ez2)*inv_R3
+                - 2.*(1. - 5.*ez2)*inv_R5)
+  c_ee3 = 0.5*(3.*h_hat*(1. - 6.*(1. - h_hat)*ez2)*inv_R
+               - 6.*(1. - 5.*ez2)*inv_R3
+               + 10.*(2. - 7.*ez2)*inv_R5)
+  c_e3e = 0.5*(3.*h_hat*inv_R - 10.*inv_R5)
+  c_e3e3 = -(3.*(h_hat**2)*ez2*inv_R + 3.*ez2*inv_R3 + (2. - 15.*ez2)*inv_R5)
+  return e, c_ee, c_id, c_ee3, c_e3e, c_e3e3
+
+
+def single_wall_correction_blocks(r_target, r_source, a, *args, **kwargs):
+  '''
+  Return the 3x3 wall corrections from Appendix C of the Swan and Brady
+  paper, without the 1/(6*pi*eta*a) prefactor, for the blocks
+  (target, source). The inputs are arrays with shape (..., 3) (or arrays
+  that can be broadcast to a common shape) with the effective positions
+  of the blobs, the output has shape (..., 3, 3).
+  The self corrections are not included.
+  '''
+  e, c_ee, c_id, c_ee3, c_e3e, c_e3e3 = single_wall_correction_coefficients(r_target - r_source, r_source[..., 2], a)
+  ez = e[..., 2]
+  W = c_ee[..., None, None] * e[..., :, None] * e[..., None, :]
+  W += c_id[..., None, None] * np.identity(3)
+  W[..., :, 2] += (c_ee3 * ez)[..., None] * e
+  W[..., 2, :] += (c_e3e * ez)[..., None] * e
+  W[..., 2, 2] += c_e3e3
+  return W
+
+
+def single_wall_self_correction(h, *args, **kwargs):
+  '''
+  Return the diagonal of the self mobility wall correction,
+  without the 1/(6*pi*eta*a) prefactor, for blobs at 
+  heights h (in units of the blob radius). Shape (h.size, 3).
+  '''
+  correction = np.empty((h.size, 3))
+  correction[:, 0] = -(1./16.)*(9./h - 2./(h**3) + 1./(h**5))
+  correction[:, 1] = correction[:, 0]
+  correction[:, 2] = -(1./8.)*(9./h - 4./(h**3) + 1./(h**5))
+  return correction
+
+
+def rotne_prager_tensor_numpy(r_vectors, eta, a, *args, **kwargs):
+  ''' 
+  Vectorized version of rotne_prager_tensor. It computes all
+  the pairwise distances at once with numpy broadcasting.
+  Returns an array with shape (3*Nblobs, 3*Nblobs).
+  '''
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  num_particles = r_vectors.shape[0]
+  r = r_vectors[:, None, :] - r_vectors[None, :, :]
+  fluid_mobility = (1./(6.*np.pi*eta*a)) * rotne_prager_tensor_blocks(r, a)
+  return fluid_mobility.transpose(0, 2, 1, 3).reshape((3*num_particles, 3*num_particles))
+
+
+def single_wall_fluid_mobility_numpy(r_vectors, eta, a, *args, **kwargs):
+  ''' 
+  Vectorized version of single_wall_fluid_mobility. 
+  Mobility for particles near a wall from the Swan and Brady paper.
+
+  For blobs overlaping the wall we use
+  Compute M = B^T * M_tilde(z_effective) * B.
+  '''
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  num_particles = r_vectors.shape[0]
+  # Get effective height and damping (diagonal of B)
+  r_vectors_effective = np.copy(r_vectors)
+  r_vectors_effective[:, 2] = np.maximum(r_vectors[:, 2], a)
+  B = np.repeat(np.minimum(r_vectors[:, 2] / a, 1.0), 3)
+  overlap = np.any(r_vectors[:, 2] < a)
+
+  # Unbounded mobility, as a (N, 3, N, 3) view
+  fluid_mobility = rotne_prager_tensor_numpy(r_vectors_effective, eta, a)
+  M = fluid_mobility.reshape((num_particles, 3, num_particles, 3))
+
+  # Wall corrections for j < k, the blocks k > j are the transpose
+  j, k = np.triu_indices(num_particles, 1)
+  M[j, :, k, :] += (1./(6.*np.pi*eta*a)) * single_wall_correction_blocks(r_vectors_effective[j],
+                                                                          r_vectors_effective[k], a)
+  M[k, :, j, :] = M[j, :, k, :].transpose(0, 2, 1)
+
+  # Diagonal blocks, self mobility.
+  diag = np.arange(num_particles)
+  self_correction = (1./(6.*np.pi*eta*a)) * single_wall_self_correction(r_vectors_effective[:, 2] / a)
+  for l in range(3):
+    M[diag, l, diag, l] += self_correction[:, l]
+
+  # Compute M = B^T * M_tilde * B
+  if overlap:
+    return fluid_mobility * B[:, None] * B[None, :]
+  else:
+    return fluid_mobility
+
+
 
 def single_wall_fluid_mobility_product(r_vectors, vector, eta, a, *args, **kwargs):
   ''' 
@@ -642,6 +855,464 @@ def no_wall_fluid_mobility_product(r_vectors, vector, eta, a, *args, **kwargs):
   return velocities
 
 
+def mobility_vector_product_target_range(r_vectors, vector, eta, a, start, end, wall, L, *args, **kwargs):
+  '''
+  Compute the velocities of the target blobs start <= i < end
+  due to the forces on all the blobs, (M * vector)[3*start:3*end].
+  The interactions are evaluated with numpy without building
+  the mobility matrix.
+
+  vector can have shape (3*Nblobs, k), then the product is computed
+  for the k columns at once, the blocks of each pair of blobs
+  are evaluated only once. The output has shape (end-start, 3, k).
+
+  r_vectors should contain the effective heights if wall is True.
+  The blocks are computed with the RPY tensor plus the Swan and
+  Brady wall corrections (if wall is True). If a component of L
+  is larger than zero the space is assumed to be pseudo-periodic
+  in that direction and the first neighbor boxes are included,
+  as in the pycuda implementation.
+  '''
+  num_targets = end - start
+  num_particles = r_vectors.shape[0]
+  r_target = r_vectors[start:end]
+  force = np.reshape(vector, (num_particles, 3, -1))
+  num_columns = force.shape[2]
+  force_flat = np.reshape(force, (num_particles, 3 * num_columns))
+  # Project displacements to the minimal image
+  r = r_target[:, None, :] - r_vectors[None, :, :]
+  for i in range(3):
+    if L[i] > 0:
+      r[:, :, i] -= np.trunc(r[:, :, i] / L[i] + 0.5 * np.sign(r[:, :, i])) * L[i]
+  boxes = [range(-1, 2) if L[i] > 0 else [0] for i in range(3)]
+  self_pairs = (np.arange(num_targets), np.arange(start, end))
+
+  velocities = np.zeros((num_targets, 3, num_columns))
+  for box in itertools.product(*boxes):
+    r_image = r + np.array(box) * L
+    # RPY tensor, the self interaction gives C1 = 1 and C2 = 0
+    r_norm = np.sqrt(np.sum(r_image * r_image, axis=-1))
+    C1, C2 = rotne_prager_tensor_coefficients(r_norm, a)
+    rf = np.matmul(r_image[:, :, None, :], force)[:, :, 0, :] * (C2 / np.maximum(r_norm, np.finfo(float).eps)**2)[:, :, None]
+    velocities += np.dot(C1, force_flat).reshape((num_targets, 3, num_columns)) + np.matmul(r_image.transpose(0, 2, 1), rf)
+
+    if wall:
+      # Wall corrections, the self interactions are added below
+      e, c_ee, c_id, c_ee3, c_e3e, c_e3e3 = single_wall_correction_coefficients(r_image, r_vectors[None, :, 2], a)
+      if box == (0, 0, 0):
+        for c in (c_ee, c_id, c_ee3, c_e3e, c_e3e3):
+          c[self_pairs] = 0.0
+      ef = np.matmul(e[:, :, None, :], force)[:, :, 0, :]
+      ez = e[:, :, 2]
+      velocities += np.matmul(e.transpose(0, 2, 1), c_ee[:, :, None] * ef + (c_ee3 * ez)[:, :, None] * force[None, :, 2, :])
+      velocities += np.dot(c_id, force_flat).reshape((num_targets, 3, num_columns))
+      velocities[:, 2, :] += np.matmul((c_e3e * ez)[:, None, :], ef)[:, 0, :] + np.dot(c_e3e3, force[:, 2, :])
+
+  if wall:
+    velocities += single_wall_self_correction(r_target[:, 2] / a)[:, :, None] * force[start:end]
+  return velocities * (1./(6.*np.pi*eta*a))
+
+
+def get_thread_pool(num_threads):
+  '''
+  Return a pool with num_threads threads. The pools are
+  created the first time they are requested and then reused.
+  '''
+  if num_threads not in get_thread_pool.pools:
+    get_thread_pool.pools[num_threads] = multiprocessing.pool.ThreadPool(num_threads)
+  return get_thread_pool.pools[num_threads]
+get_thread_pool.pools = {}
+
+
+def mobility_vector_product_tiled(r_vectors, vector, eta, a, wall, *args, **kwargs):
+  '''
+  Compute the product M * vector looping over tiles of target blobs.
+  The size of the tiles is chosen so each tile computes about 
+  tile_pairs (default 2**16) pair interactions; the memory used 
+  is O(tile_pairs) instead of O(Nblobs**2).
+
+  If num_threads > 1 the tiles are distributed among a pool of
+  threads. All threads share the blobs coordinates and write to
+  disjoint slices of the output. Numpy releases the GIL during
+  the array operations so the tiles are computed concurrently.
+
+  If vector has shape (3*Nblobs, k) the k products are computed
+  at once and the output has the same shape.
+  '''
+  L = kwargs.get('periodic_length', np.array([0.0, 0.0, 0.0]))
+  L = np.array([0.0, 0.0, 0.0]) if L is None else np.array(L, dtype=float)
+  num_threads = kwargs.get('num_threads', 1)
+  num_particles = r_vectors.shape[0]
+  tile_size = max(1, kwargs.get('tile_pairs', 2**16) // num_particles)
+  if num_threads > 1:
+    # Use several tiles per thread to balance the load
+    tile_size = min(tile_size, max(1, -(-num_particles // (4 * num_threads))))
+  num_columns = np.size(vector) // (3 * num_particles)
+  velocities = np.empty((num_particles, 3, num_columns))
+
+  def tile_product(start):
+    end = min(start + tile_size, num_particles)
+    velocities[start:end] = mobility_vector_product_target_range(r_vectors, vector, eta, a, start, end, wall, L)
+
+  if num_threads > 1:
+    get_thread_pool(num_threads).map(tile_product, range(0, num_particles, tile_size))
+  else:
+    for start in range(0, num_particles, tile_size):
+      tile_product(start)
+  if np.ndim(vector) == 1:
+    return velocities.flatten()
+  return np.reshape(velocities, (3 * num_particles, num_columns))
+
+
+def rpy_wall_pair_velocities(r, h, force, a, wall, *args, **kwargs):
+  '''
+  Return the velocities, without the 1/(6*pi*eta*a) prefactor,
+  induced by the forces on the sources on the targets for a list of
+  pairs. r = r_target - r_source has shape (num_pairs, 3), h is the
+  (effective) height of the sources and force has shape (num_pairs, 3).
+  The blocks are the RPY tensor plus the Swan and Brady wall corrections
+  if wall is True. Self interactions should not be included.
+  '''
+  r_norm = np.sqrt(np.sum(r * r, axis=1))
+  C1, C2 = rotne_prager_tensor_coefficients(r_norm, a)
+  rf = np.sum(r * force, axis=1) * C2 / np.maximum(r_norm, np.finfo(float).eps)**2
+  velocities = C1[:, None] * force + rf[:, None] * r
+  if wall:
+    e, c_ee, c_id, c_ee3, c_e3e, c_e3e3 = single_wall_correction_coefficients(r, h, a)
+    ef = np.sum(e * force, axis=1)
+    ez = e[:, 2]
+    velocities += (c_ee * ef + c_ee3 * ez * force[:, 2])[:, None] * e + c_id[:, None] * force
+    velocities[:, 2] += c_e3e * ez * ef + c_e3e3 * force[:, 2]
+  return velocities
+
+
+def octree(r_vectors, leaf_size, max_level = 16, *args, **kwargs):
+  '''
+  Build an octree over the points r_vectors sorting them along 
+  a Morton (Z-order) curve. Nodes with more than leaf_size points 
+  are split. Returns (order, start, end, child_start, child_count),
+  the points of the node n are r_vectors[order[start[n]:end[n]]], 
+  the children of the node n are the nodes child_start[n] + 
+  range(child_count[n]). The node 0 is the root.
+  '''
+  num_points = r_vectors.shape[0]
+  r_min = np.min(r_vectors, axis=0)
+  size = max(np.max(r_vectors - r_min), np.finfo(float).tiny) * (1. + 1e-10)
+  cells = np.minimum(((r_vectors - r_min) * (2**max_level / size)).astype(np.int64), 2**max_level - 1)
+  codes = np.zeros(num_points, dtype=np.int64)
+  for bit in range(max_level):
+    for k in range(3):
+      codes |= ((cells[:, k] >> bit) & 1) << (3 * bit + 2 - k)
+  order = np.argsort(codes, kind='mergesort')
+  codes = codes[order]
+
+  # Split the nodes level by level, the children of all the
+  # nodes in one level are created at once
+  start = [np.array([0])]
+  end = [np.array([num_points])]
+  child_start = []
+  child_count = []
+  num_nodes = 1
+  for level in range(1, max_level + 1):
+    split = (end[-1] - start[-1]) > leaf_size
+    child_start.append(np.zeros(start[-1].size, dtype=int))
+    child_count.append(np.zeros(start[-1].size, dtype=int))
+    if not np.any(split):
+      break
+    s = start[-1][split]
+    e = end[-1][split]
+    prefix = codes >> (3 * (max_level - level))
+    change = np.flatnonzero(prefix[1:] != prefix[:-1]) + 1
+    parent = np.searchsorted(s, change, side='right') - 1
+    valid = parent >= 0
+    valid[valid] = (change[valid] > s[parent[valid]]) & (change[valid] < e[parent[valid]])
+    children_start = np.sort(np.concatenate([s, change[valid]]))
+    parent = np.searchsorted(s, children_start, side='right') - 1
+    children_end = np.empty_like(children_start)
+    children_end[:-1] = children_start[1:]
+    last = np.append(parent[1:] != parent[:-1], True)
+    children_end[last] = e[parent[last]]
+    counts = np.bincount(parent, minlength=s.size)
+    child_count[-1][split] = counts
+    child_start[-1][split] = num_nodes + np.cumsum(counts) - counts
+    num_nodes += children_start.size
+    start.append(children_start)
+    end.append(children_end)
+  if len(child_start) < len(start):
+    child_start.append(np.zeros(start[-1].size, dtype=int))
+    child_count.append(np.zeros(start[-1].size, dtype=int))
+  level = np.repeat(np.arange(len(start)), [x.size for x in start])
+  return (order, np.concatenate(start), np.concatenate(end), np.concatenate(child_start), np.concatenate(child_count), level)
+
+
+def tree_node_reduce(ufunc, x, start, end, level):
+  '''
+  Return ufunc.reduce over the rows x[start[n]:end[n]] for 
+  every node n. The nodes at the same level do not overlap,
+  so they are reduced at once with ufunc.reduceat.
+  '''
+  x = np.concatenate([x, x[:1]])
+  result = np.empty((start.size,) + x.shape[1:])
+  for l in np.unique(level):
+    nodes = np.flatnonzero(level == l)
+    indices = np.column_stack((start[nodes], end[nodes])).flatten()
+    result[nodes] = ufunc.reduceat(x, indices, axis=0)[::2]
+  return result
+
+
+def expand_pairs(a_start, a_count, b_start, b_count):
+  '''
+  Given a list of pairs of ranges, [a_start, a_start + a_count) and
+  [b_start, b_start + b_count), return the indices (ia, ib) of all
+  the combinations of elements in every pair of ranges.
+  '''
+  sizes = a_count * b_count
+  pair = np.repeat(np.arange(sizes.size), sizes)
+  k = np.arange(pair.size) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+  return a_start[pair] + k // b_count[pair], b_start[pair] + k % b_count[pair]
+
+
+def mobility_vector_product_tree(r_vectors, vector, eta, a, wall, *args, **kwargs):
+  '''
+  Approximate the product M * vector with a Barnes-Hut tree code.
+
+  The sources are sorted in an octree. The interaction between a leaf 
+  of target blobs and a node of sources is computed with the node
+  multipole expansion (total force and force dipole, represented by
+  seven pseudo-particles) if (radius_target + radius_node) < theta * distance,
+  otherwise the node is opened. Leaves that can not be approximated
+  interact directly. The error decreases like theta**2 and the
+  cost scales like N*log(N) for a fixed theta.
+
+  If a component of periodic_length is larger than zero the space 
+  is pseudo-periodic in that direction and the interactions with
+  the first neighbor boxes are included, as in the pycuda 
+  implementation. With a wall the z direction is never periodic.
+
+  Keyword arguments: theta (default 0.5), leaf_size (default 32)
+  and tile_pairs (number of pairs evaluated at once, default 2**14).
+  '''
+  theta = kwargs.get('theta', 0.5)
+  leaf_size = kwargs.get('leaf_size', 32)
+  tile_pairs = kwargs.get('tile_pairs', 2**14)
+  L = kwargs.get('periodic_length', np.array([0.0, 0.0, 0.0]))
+  L = np.zeros(3) if L is None else np.array(L, dtype=float)
+  if wall:
+    L[2] = 0.0
+  periodic = L > 0
+  num_particles = r_vectors.shape[0]
+  force = np.reshape(vector, (-1, 3))
+
+  # Build the trees and the interaction lists, they are reused
+  # while the blobs do not move (e.g. during the GMRES iterations)
+  cache = mobility_vector_product_tree.cache
+  key = (theta, leaf_size, wall, tuple(L))
+  if cache.get('key') != key or cache.get('r_vectors') is None or not np.array_equal(cache['r_vectors'], r_vectors):
+    cache.clear()
+    cache['key'] = key
+    cache['r_vectors'] = np.copy(r_vectors)
+    # Targets are the blobs wrapped to the unit cell, sources
+    # the images of the targets in the boxes that can be in
+    # the range of any target, |r_target - r_source| <= 1.5 * L
+    r_target = np.copy(r_vectors)
+    r_target[:, periodic] -= np.floor(r_target[:, periodic] / L[periodic]) * L[periodic]
+    shifts = np.array(list(itertools.product(*[range(-2, 3) if periodic[i] else [0] for i in range(3)])))
+    r_source = (r_target[None, :, :] + shifts[:, None, :] * L).reshape((-1, 3))
+    source_index = np.tile(np.arange(num_particles), shifts.shape[0])
+    source_image = np.repeat(np.any(shifts != 0, axis=1), num_particles)
+    in_range = np.all((r_source[:, periodic] >= -1.5 * L[periodic]) & (r_source[:, periodic] < 2.5 * L[periodic]), axis=1)
+    r_source, source_index, source_image = r_source[in_range], source_index[in_range], source_image[in_range]
+
+    t_order, t_start, t_end, t_child_start, t_child_count, t_level = octree(r_target, leaf_size)
+    s_order, s_start, s_end, s_child_start, s_child_count, s_level = octree(r_source, leaf_size)
+    r_target, r_source = r_target[t_order], r_source[s_order]
+    source_index, source_image = source_index[s_order], source_image[s_order]
+    t_min = tree_node_reduce(np.minimum, r_target, t_start, t_end, t_level)
+    t_max = tree_node_reduce(np.maximum, r_target, t_start, t_end, t_level)
+    s_min = tree_node_reduce(np.minimum, r_source, s_start, s_end, s_level)
+    s_max = tree_node_reduce(np.maximum, r_source, s_start, s_end, s_level)
+    t_center, t_radius = 0.5 * (t_min + t_max), 0.5 * np.linalg.norm(t_max - t_min, axis=1)
+    s_center, s_radius = 0.5 * (s_min + s_max), 0.5 * np.linalg.norm(s_max - s_min, axis=1)
+
+    # Traverse the source tree for all the target leaves at once
+    T = np.flatnonzero(t_child_count == 0)
+    S = np.zeros(T.size, dtype=int)
+    far_T, far_S, near_T, near_S = [], [], [], []
+    while T.size > 0:
+      distance = np.linalg.norm(t_center[T] - s_center[S], axis=1)
+      inside = np.ones(T.size, dtype=bool)
+      outside = np.zeros(T.size, dtype=bool)
+      for i in np.flatnonzero(periodic):
+        inside &= (s_min[S, i] >= t_max[T, i] - 1.5 * L[i]) & (s_max[S, i] <= t_min[T, i] + 1.5 * L[i])
+        outside |= (s_max[S, i] < t_min[T, i] - 1.5 * L[i]) | (s_min[S, i] > t_max[T, i] + 1.5 * L[i])
+      far = inside & (t_radius[T] + s_radius[S] < theta * distance)
+      leaf = s_child_count[S] == 0
+      near = ~outside & ~far & leaf
+      split = ~outside & ~far & ~leaf
+      far_T.append(T[far])
+      far_S.append(S[far])
+      near_T.append(T[near])
+      near_S.append(S[near])
+      T, S = expand_pairs(T[split], np.ones(np.sum(split), dtype=int), s_child_start[S[split]], s_child_count[S[split]])
+    cache['t_order'], cache['s_order'] = t_order, s_order
+    cache['r_target'], cache['r_source'] = r_target, r_source
+    cache['source_index'], cache['source_image'] = source_index, source_image
+    cache['t_start'], cache['t_end'] = t_start, t_end
+    cache['s_start'], cache['s_end'], cache['s_level'] = s_start, s_end, s_level
+    cache['s_min'], cache['s_max'] = s_min, s_max
+    cache['far_T'], cache['far_S'] = np.concatenate(far_T), np.concatenate(far_S)
+    cache['near_T'], cache['near_S'] = np.concatenate(near_T), np.concatenate(near_S)
+
+  t_order, s_order = cache['t_order'], cache['s_order']
+  r_target, r_source = cache['r_target'], cache['r_source']
+  source_index, source_image = cache['source_index'], cache['source_image']
+  t_start, t_end = cache['t_start'], cache['t_end']
+  s_start, s_end, s_level = cache['s_start'], cache['s_end'], cache['s_level']
+  s_min, s_max = cache['s_min'], cache['s_max']
+  far_T, far_S, near_T, near_S = cache['far_T'], cache['far_S'], cache['near_T'], cache['near_S']
+  f_target = force[t_order]
+  f_source = force[source_index]
+  velocities = np.zeros((num_particles, 3))
+
+  def accumulate(t, u):
+    for k in range(3):
+      velocities[:, k] += np.bincount(t, weights=u[:, k], minlength=num_particles)
+
+  # Near field, direct interactions between blobs
+  sizes = np.cumsum((t_end[near_T] - t_start[near_T]) * (s_end[near_S] - s_start[near_S]))
+  bounds = np.unique(np.concatenate([[0], np.searchsorted(sizes, np.arange(tile_pairs, sizes[-1] if sizes.size else 0, tile_pairs)), [sizes.size]]))
+  for first, last in zip(bounds[:-1], bounds[1:]):
+    T, S = near_T[first:last], near_S[first:last]
+    t, s = expand_pairs(t_start[T], t_end[T] - t_start[T], s_start[S], s_end[S] - s_start[S])
+    r = r_target[t] - r_source[s]
+    keep = source_image[s] | (source_index[s] != t_order[t])
+    for i in np.flatnonzero(periodic):
+      keep &= np.abs(r[:, i]) <= 1.5 * L[i]
+    t, s, r = t[keep], s[keep], r[keep]
+    accumulate(t, rpy_wall_pair_velocities(r, r_source[s, 2], f_source[s], a, wall))
+
+  # Far field, each source node is represented by seven pseudo-particles:
+  # the total force at the center c and the dipole D_k = sum_j (x_j - c)_k * f_j 
+  # as two forces +-D_k / (2*s_k) at c +- s_k * e_k, with s_k the node half-width
+  F_node = tree_node_reduce(np.add, f_source, s_start, s_end, s_level)
+  xF_node = tree_node_reduce(np.add, (r_source[:, :, None] * f_source[:, None, :]).reshape((-1, 9)), s_start, s_end, s_level)
+  center = 0.5 * (s_min + s_max)
+  step = 0.5 * (s_max - s_min)
+  D_node = xF_node.reshape((-1, 3, 3)) - center[:, :, None] * F_node[:, None, :]
+  D_node /= 2. * np.where(step > 0, step, np.inf)[:, :, None]
+  t_all, node_all = expand_pairs(t_start[far_T], t_end[far_T] - t_start[far_T], far_S, np.ones(far_S.size, dtype=int))
+  for first in range(0, t_all.size, tile_pairs):
+    t, node = t_all[first:first + tile_pairs], node_all[first:first + tile_pairs]
+    r = r_target[t] - center[node]
+    u = rpy_wall_pair_velocities(r, center[node, 2], F_node[node], a, wall)
+    for k in range(3):
+      for sign in (1., -1.):
+        r_pseudo = np.copy(r)
+        r_pseudo[:, k] -= sign * step[node, k]
+        u += rpy_wall_pair_velocities(r_pseudo, center[node, 2] - r_pseudo[:, 2] + r[:, 2], sign * D_node[node, k, :], a, wall)
+    accumulate(t, u)
+
+  # Self interactions
+  velocities += f_target
+  if wall:
+    velocities += single_wall_self_correction(r_target[:, 2] / a) * f_target
+  result = np.empty((num_particles, 3))
+  result[t_order] = velocities * (1./(6.*np.pi*eta*a))
+  return result.flatten()
+mobility_vector_product_tree.cache = {}
+
+
+def single_wall_mobility_trans_times_force_numpy(r_vectors, force, eta, a, *args, **kwargs):
+  ''' 
+  Returns the product of the mobility at the blob level by the force 
+  on the blobs. Mobility for particles near a wall, it uses the 
+  expression from the Swan and Brady paper.
+
+  The product is computed in tiles of target blobs with numpy,
+  the mobility matrix is never built. If a component of periodic_length
+  is larger than zero the space is assumed to be pseudo-periodic in that
+  direction, as in the pycuda implementation. Use the keyword argument
+  num_threads to compute the tiles with several threads.
+  If force has shape (3*Nblobs, k) the k products are computed at once.
+
+  For blobs overlaping the wall we use
+  Compute M = B^T * M_tilde(z_effective) * B.
+  '''
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  # Get effective height and damping (diagonal of B)
+  r_vectors_effective = np.copy(r_vectors)
+  r_vectors_effective[:, 2] = np.maximum(r_vectors[:, 2], a)
+  B = np.repeat(np.minimum(r_vectors[:, 2] / a, 1.0), 3)
+  overlap = np.any(r_vectors[:, 2] < a)
+  if np.ndim(force) == 2:
+    B = B[:, None]
+  # Compute B * force
+  if overlap:
+    force = B * force
+  # Compute M_tilde * B * force
+  velocities = mobility_vector_product_tiled(r_vectors_effective, force, eta, a, True, *args, **kwargs)
+  # Compute B.T * M * B * vector
+  if overlap:
+    velocities = B * velocities
+  return velocities
+
+
+def no_wall_mobility_trans_times_force_numpy(r_vectors, force, eta, a, *args, **kwargs):
+  ''' 
+  Returns the product of the mobility at the blob level by the force 
+  on the blobs. Mobility for particles in an unbounded domain, it uses
+  the standard RPY tensor.
+
+  The product is computed in tiles of target blobs with numpy,
+  the mobility matrix is never built. Use the keyword argument
+  num_threads to compute the tiles with several threads.
+  If force has shape (3*Nblobs, k) the k products are computed at once.
+  '''
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  return mobility_vector_product_tiled(r_vectors, force, eta, a, False, *args, **kwargs)
+
+
+def single_wall_mobility_trans_times_force_tree(r_vectors, force, eta, a, *args, **kwargs):
+  ''' 
+  Returns an approximation of the product of the mobility at the blob 
+  level by the force on the blobs computed with a Barnes-Hut tree code.
+  Mobility for particles near a wall, it uses the expression from the 
+  Swan and Brady paper. The accuracy is controlled with the keyword
+  argument theta (theta = 0 gives the exact product), see
+  mobility_vector_product_tree.
+
+  For blobs overlaping the wall we use
+  Compute M = B^T * M_tilde(z_effective) * B.
+  '''
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  # Get effective height and damping (diagonal of B)
+  r_vectors_effective = np.copy(r_vectors)
+  r_vectors_effective[:, 2] = np.maximum(r_vectors[:, 2], a)
+  B = np.repeat(np.minimum(r_vectors[:, 2] / a, 1.0), 3)
+  overlap = np.any(r_vectors[:, 2] < a)
+  # Compute B * force
+  if overlap:
+    force = B * force
+  # Compute M_tilde * B * force
+  velocities = mobility_vector_product_tree(r_vectors_effective, force, eta, a, True, *args, **kwargs)
+  # Compute B.T * M * B * vector
+  if overlap:
+    velocities = B * velocities
+  return velocities
+
+
+def no_wall_mobility_trans_times_force_tree(r_vectors, force, eta, a, *args, **kwargs):
+  ''' 
+  Returns an approximation of the product of the mobility at the blob 
+  level by the force on the blobs computed with a Barnes-Hut tree code.
+  Mobility for particles in an unbounded domain, it uses
+  the standard RPY tensor. The accuracy is controlled with the keyword
+  argument theta (theta = 0 gives the exact product).
+  '''
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  return mobility_vector_product_tree(r_vectors, force, eta, a, False, *args, **kwargs)
+
+
 def single_wall_self_mobility_with_rotation(location, eta, a, *args, **kwargs):
   ''' 
   Self mobility for a single sphere of radius a with translation rotation
@@ -743,7 +1414,12 @@ def mobility_vector_product_source_target_one_wall(source, target, force, radius
   That is, compute the matrix vector product  
   velocities_target = M_tt * forces_sources
   where M_tt has dimensions (target, source)
+
+  If force has shape (3*num_sources, k) the k products are computed
+  with one evaluation of each block M_ij and the output has shape
+  (3*num_targets, k).
   '''
+  matmat = np.ndim(force) == 2 and force.shape[0] == source.size
   # Compute effective heights
   x = shift_heights_different_radius(target, radius_target)
   y = shift_heights_different_radius(source, radius_source)
@@ -754,11 +1430,12 @@ def mobility_vector_product_source_target_one_wall(source, target, force, radius
 
   # Compute B * vector
   if overlap_source is True:
-    force = B_source.dot(force.flatten())
+    force = B_source.dot(force if matmat else force.flatten())
 
   # Compute unbounded contribution
-  force = np.reshape(force, (force.size / 3, 3))
   velocity = mobility_vector_product_source_target_unbounded(y, x, force, radius_source, radius_target, eta, *args, **kwargs)
+  force = np.reshape(force, (source.size / 3, 3, -1))
+  velocity = np.reshape(velocity, (target.size / 3, 3, -1))
   y_image = np.copy(y)
   y_image[:,2] = -y[:,2]
 
@@ -801,9 +1478,14 @@ def mobility_vector_product_source_target_one_wall(source, target, force, radius
       Mij = -prefactor * np.dot(Mij, P)
       velocity[i] += np.dot(Mij, force[j]) 
 
+  if matmat:
+    velocity = np.reshape(velocity, (target.size, force.shape[2]))
+  else:
+    velocity = velocity[:, :, 0]
+
   # Compute B.T * M * B * vector
   if overlap_target is True:
-    velocity = B_target.dot(np.reshape(velocity, velocity.size))
+    velocity = B_target.dot(velocity if matmat else np.reshape(velocity, velocity.size))
 
   return velocity
 
@@ -819,10 +1501,15 @@ def mobility_vector_product_source_target_unbounded(source, target, force, radiu
   velocities_target = M_tt * forces_sources
   where M_tt has dimensions (target, source)
 
+  If force has shape (3*num_sources, k) the k products are computed
+  with one evaluation of each block M_ij and the output has shape
+  (3*num_targets, k).
+
   See Reference P. J. Zuk et al. J. Fluid Mech. (2014), vol. 741, R5, doi:10.1017/jfm.2013.668
   '''
-  force = np.reshape(force, (force.size / 3, 3))
-  velocity = np.zeros((target.size / 3, 3))
+  matmat = np.ndim(force) == 2 and force.shape[0] == source.size
+  force = np.reshape(force, (source.size / 3, 3, -1))
+  velocity = np.zeros((target.size / 3, 3, force.shape[2]))
   prefactor = 1.0 / (8 * np.pi * eta)
   b2 = radius_target**2
   a2 = radius_source**2
@@ -848,7 +1535,9 @@ def mobility_vector_product_source_target_unbounded(source, target, force, radiu
         Mij = (1.0 / (6 * np.pi * eta * largest_radius)) * np.eye(3)
       velocity[i] += np.dot(Mij, force[j])
 
-  return velocity
+  if matmat:
+    return np.reshape(velocity, (target.size, force.shape[2]))
+  return velocity[:, :, 0]
 
 
 def boosted_mobility_vector_product_source_target(source, target, force, radius_source, radius_target, eta, *args, **kwargs):
@@ -858,10 +1547,15 @@ def boosted_mobility_vector_product_source_target(source, target, force, radius_
   Must compile mobility_ext.cc before this will work 
   (use Makefile).
 
+  If force has shape (3*num_sources, k) the k products are computed
+  with one evaluation of each block and the output has shape
+  (3*num_targets, k).
+
   For blobs overlaping the wall we use
   Compute M = B^T * M_tilde(z_effective) * B.
   '''
   L = kwargs.get('periodic_length', np.array([0.0, 0.0, 0.0]))
+  matmat = np.ndim(force) == 2 and force.shape[0] == source.size
 
   # Compute effective heights
   x = shift_heights_different_radius(target, radius_target)
@@ -873,17 +1567,23 @@ def boosted_mobility_vector_product_source_target(source, target, force, radius_
 
   # Compute B * vector
   if overlap_source is True:
-    force = B_source.dot(force.flatten())
+    force = B_source.dot(force if matmat else force.flatten())
 
   # Compute M_tilde * B * vector
   num_sources = source.size / 3
   num_targets = target.size / 3
-  vector_res = np.zeros(target.size)
   x_for_mob = np.reshape(x, (x.size / 3, 3))  
   y_for_mob = np.reshape(y, (y.size / 3, 3))  
-  force = np.reshape(force, force.size)
-
-  me.mobility_vector_product_source_target_one_wall(y_for_mob, x_for_mob, force, radius_source, radius_target, vector_res, L, eta, num_sources, num_targets)
+  if matmat:
+    num_columns = force.shape[1]
+    vector_res = np.zeros(target.size * num_columns)
+    force = np.ascontiguousarray(force).flatten()
+    me.mobility_matrix_product_source_target_one_wall(y_for_mob, x_for_mob, force, radius_source, radius_target, vector_res, L, eta, num_sources, num_targets, num_columns)
+    vector_res = np.reshape(vector_res, (target.size, num_columns))
+  else:
+    vector_res = np.zeros(target.size)
+    force = np.reshape(force, force.size)
+    me.mobility_vector_product_source_target_one_wall(y_for_mob, x_for_mob, force, radius_source, radius_target, vector_res, L, eta, num_sources, num_targets)
 
   # Compute B.T * M * B * vector
   if overlap_target is True:
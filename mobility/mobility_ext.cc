@@ -129,13 +129,18 @@ void MobilityVectorProduct_optimized(bp::list r_vectors,
 //////////////////////////////////////////////////////////////////////////////////////////
 /////////////// MOBILITY VECTOR PRODUCT TO BE OPTIMIZED /////////////////
 //////////////////////////////////////////////////////////////////////////////////////////
-void MobilityVectorProduct(bp::numeric::array r_vectors, 
+void MobilityMatrixProduct(bp::numeric::array r_vectors, 
                            double eta,
                            double a, 
                            int num_particles,
+                           int num_columns,
                            bp::numeric::array periodic_length,
                            bp::numeric::array vector,
                            bp::numeric::array vector_res ) {
+  // Compute the product of the mobility by num_columns vectors at once,
+  // vector and vector_res are the arrays (3*num_particles, num_columns)
+  // flattened in row major order. The 3x3 block of each pair is
+  // computed only once for all the columns.
   // Create the mobility of particles in a fluid with a single wall at z = 0.
   double pi = 3.1415926535897932;
   double C1, C2;
@@ -242,10 +247,12 @@ void MobilityVectorProduct(bp::numeric::array r_vectors,
 	      
               Mlm = Mlm / (6.0*pi*eta*a);
               if((j != k) or (box[0] != 0) or (box[1] !=0)){
-                vector_res[j*3+l] += Mlm*bp::extract<double>(vector[k*3+m]);
-                // Use the fact that M is symmetric 
-                if(j != k){
-                  vector_res[k*3+m] += Mlm*bp::extract<double>(vector[j*3+l]); 
+                for (int c = 0; c < num_columns; ++c) {
+                  vector_res[(j*3+l)*num_columns+c] += Mlm*bp::extract<double>(vector[(k*3+m)*num_columns+c]);
+                  // Use the fact that M is symmetric 
+                  if(j != k){
+                    vector_res[(k*3+m)*num_columns+c] += Mlm*bp::extract<double>(vector[(j*3+l)*num_columns+c]); 
+                  }
                 }
               }
             }
@@ -270,20 +277,34 @@ void MobilityVectorProduct(bp::numeric::array r_vectors,
           + (l == m ? 1.0 : 0.0 )*(l == 2 ? 1.0 : 0.0)*(-1./8.)*
           (9./h - 4./(pow(h,3)) + 1./(pow(h,5))));
         Mlm = Mlm*(1./(6.0*pi*eta*a));
-        vector_res[j*3+l]+= Mlm*bp::extract<double>(vector[j*3+m]);
+        for (int c = 0; c < num_columns; ++c) {
+          vector_res[(j*3+l)*num_columns+c] += Mlm*bp::extract<double>(vector[(j*3+m)*num_columns+c]);
+        }
       }
     }
   }
 }
+
+
+void MobilityVectorProduct(bp::numeric::array r_vectors, 
+                           double eta,
+                           double a, 
+                           int num_particles,
+                           bp::numeric::array periodic_length,
+                           bp::numeric::array vector,
+                           bp::numeric::array vector_res ) {
+  MobilityMatrixProduct(r_vectors, eta, a, num_particles, 1, periodic_length, vector, vector_res);
+}
 //////////////////////////////////////////////////////////////////////////////////////////
 /////////////// END OF MOBILITY VECTOR PRODUCT TO BE OPTIMIZED /////////////////
 //////////////////////////////////////////////////////////////////////////////////////////
 
 
-void NoWallMobilityVectorProduct(bp::numeric::array r_vectors, 
+void NoWallMobilityMatrixProduct(bp::numeric::array r_vectors, 
                                  double eta,
                                  double a, 
                                  int num_particles,
+                                 int num_columns,
                                  bp::numeric::array periodic_length,
                                  bp::numeric::array vector,
                                  bp::numeric::array vector_res ){
@@ -354,10 +375,12 @@ void NoWallMobilityVectorProduct(bp::numeric::array r_vectors,
               Mlm = (l == m ? 1.0 : 0.0)*C1 + R[l]*R[m]/pow(R_norm,2)*C2;       
               Mlm = Mlm / (6.0*pi*eta*a);
               if((j != k) or (box[0] != 0) or (box[1] !=0)){
-                vector_res[j*3+l] += Mlm*bp::extract<double>(vector[k*3+m]);
-                // Use the fact that M is symmetric 
-                if(j != k){
-                  vector_res[k*3+m] += Mlm*bp::extract<double>(vector[j*3+l]); 
+                for (int c = 0; c < num_columns; ++c) {
+                  vector_res[(j*3+l)*num_columns+c] += Mlm*bp::extract<double>(vector[(k*3+m)*num_columns+c]);
+                  // Use the fact that M is symmetric 
+                  if(j != k){
+                    vector_res[(k*3+m)*num_columns+c] += Mlm*bp::extract<double>(vector[(j*3+l)*num_columns+c]); 
+                  }
                 }
               }
             }
@@ -373,12 +396,25 @@ void NoWallMobilityVectorProduct(bp::numeric::array r_vectors,
     h = bp::extract<double>(r_vector_1[2])/a;
     for (int l = 0; l < 3; ++l) {
       Mlm = 1.0 / (6.0 * pi * eta * a);
-      vector_res[j*3+l]+= Mlm*bp::extract<double>(vector[j*3+l]);
+      for (int c = 0; c < num_columns; ++c) {
+        vector_res[(j*3+l)*num_columns+c] += Mlm*bp::extract<double>(vector[(j*3+l)*num_columns+c]);
+      }
     }
   }
 }
 
 
+void NoWallMobilityVectorProduct(bp::numeric::array r_vectors, 
+                                 double eta,
+                                 double a, 
+                                 int num_particles,
+                                 bp::numeric::array periodic_length,
+                                 bp::numeric::array vector,
+                                 bp::numeric::array vector_res ){
+  NoWallMobilityMatrixProduct(r_vectors, eta, a, num_particles, 1, periodic_length, vector, vector_res);
+}
+
+
 void SingleWallFluidMobilityCorrection(bp::list r_vectors, 
                                        double eta,
                                        double a, int num_particles,
@@ -781,7 +817,7 @@ void MobilityVectorProductOneParticle(bp::list r_vectors,
 
 
 
-void MobilityVectorProductSourceTargetOneWall(bp::numeric::array source, 
+void MobilityMatrixProductSourceTargetOneWall(bp::numeric::array source, 
                                               bp::numeric::array target,
                                               bp::numeric::array force,
                                               bp::numeric::array radius_source,
@@ -790,7 +826,10 @@ void MobilityVectorProductSourceTargetOneWall(bp::numeric::array source,
                                               bp::numeric::array periodic_length,
                                               double eta,
                                               int num_sources,
-                                              int num_targets){
+                                              int num_targets,
+                                              int num_columns){
+  // force and velocity are the arrays (3*num_sources, num_columns) and
+  // (3*num_targets, num_columns) flattened in row major order.
 
   // Create the mobility of particles in a fluid with a single wall at z = 0.
   double pi = 3.1415926535897932;
@@ -924,7 +963,9 @@ void MobilityVectorProductSourceTargetOneWall(bp::numeric::array source,
           // Compute velocity
           for(int l=0;l<3;l++){
             for(int m=0;m<3;m++){
-              velocity[j*3+l] += M[l][m]*bp::extract<double>(force[k*3+m]);
+              for(int c=0;c<num_columns;c++){
+                velocity[(j*3+l)*num_columns+c] += M[l][m]*bp::extract<double>(force[(k*3+m)*num_columns+c]);
+              }
             }
           }
         }
@@ -934,6 +975,21 @@ void MobilityVectorProductSourceTargetOneWall(bp::numeric::array source,
 }
 
 
+void MobilityVectorProductSourceTargetOneWall(bp::numeric::array source, 
+                                              bp::numeric::array target,
+                                              bp::numeric::array force,
+                                              bp::numeric::array radius_source,
+                                              bp::numeric::array radius_target,
+                                              bp::numeric::array velocity,
+                                              bp::numeric::array periodic_length,
+                                              double eta,
+                                              int num_sources,
+                                              int num_targets){
+  MobilityMatrixProductSourceTargetOneWall(source, target, force, radius_source, radius_target, velocity,
+                                           periodic_length, eta, num_sources, num_targets, 1);
+}
+
+
 
 BOOST_PYTHON_MODULE(mobility_ext)
 {
@@ -946,5 +1002,8 @@ BOOST_PYTHON_MODULE(mobility_ext)
   def("no_wall_mobility_vector_product", NoWallMobilityVectorProduct);
   def("mobility_vector_product_one_particle", MobilityVectorProductOneParticle);
   def("mobility_vector_product_source_target_one_wall", MobilityVectorProductSourceTargetOneWall);
+  def("mobility_matrix_product", MobilityMatrixProduct);
+  def("no_wall_mobility_matrix_product", NoWallMobilityMatrixProduct);
+  def("mobility_matrix_product_source_target_one_wall", MobilityMatrixProductSourceTargetOneWall);
 }
 
@@ -206,6 +206,98 @@ class TestMobility(unittest.TestCase):
     for i in range(len(fluid_mobility)):
       for j in range(len(fluid_mobility[0])):
         self.assertAlmostEqual(fluid_mobility[i, j], fluid_mobility_boost[i, j])
+
+  def test_numpy_v_python_agreement(self):
+    ''' 
+    Test that for random R vectors, including blobs overlapping
+    the wall, the numpy and python versions of mobility agree.'''
+    location = np.random.normal(1., 1., (6, 3))
+    location[0, 2] = 0.1
+    eta = 1.0
+    a = 0.25
+    fluid_mobility = mb.single_wall_fluid_mobility(location, eta, a)
+    fluid_mobility_numpy = mb.single_wall_fluid_mobility_numpy(location, eta, a)
+    rpy = mb.rotne_prager_tensor(location, eta, a)
+    rpy_numpy = mb.rotne_prager_tensor_numpy(location, eta, a)
+
+    for i in range(len(fluid_mobility)):
+      for j in range(len(fluid_mobility[0])):
+        self.assertAlmostEqual(fluid_mobility[i, j], fluid_mobility_numpy[i, j])
+        self.assertAlmostEqual(rpy[i, j], rpy_numpy[i, j])
+
+  def test_numpy_tiled_product_agreement(self):
+    ''' 
+    Test that the tiled numpy products agree with the dense
+    mobility times a vector.'''
+    location = np.random.normal(1., 1., (7, 3))
+    location[0, 2] = 0.1
+    force = np.random.normal(0., 1., 21)
+    eta = 1.0
+    a = 0.25
+    velocity = np.dot(mb.single_wall_fluid_mobility(location, eta, a), force)
+    velocity_numpy = mb.single_wall_mobility_trans_times_force_numpy(location, force, eta, a, tile_pairs=10)
+    velocity_no_wall = np.dot(mb.rotne_prager_tensor(location, eta, a), force)
+    velocity_no_wall_numpy = mb.no_wall_mobility_trans_times_force_numpy(location, force, eta, a, tile_pairs=10)
+    velocity_parallel = mb.single_wall_mobility_trans_times_force_numpy(location, force, eta, a, num_threads=3)
+
+    for i in range(len(velocity)):
+      self.assertAlmostEqual(velocity[i], velocity_numpy[i])
+      self.assertAlmostEqual(velocity_no_wall[i], velocity_no_wall_numpy[i])
+      self.assertAlmostEqual(velocity[i], velocity_parallel[i])
+
+  def test_matmat_agreement(self):
+    ''' 
+    Test that the products with several columns agree with
+    the products column by column.'''
+    location = np.random.normal(1., 1., (7, 3))
+    location[0, 2] = 0.1
+    force = np.random.normal(0., 1., (21, 4))
+    radius = np.ones(7) * 0.25
+    eta = 1.0
+    a = 0.25
+    L = np.array([6., 0., 0.])
+    products = [(mb.single_wall_fluid_mobility_product, {}),
+                (mb.single_wall_mobility_trans_times_force_numpy, {'tile_pairs': 10}),
+                (mb.single_wall_mobility_trans_times_force_numpy, {'num_threads': 3, 'periodic_length': L}),
+                (mb.no_wall_mobility_trans_times_force_numpy, {'periodic_length': L})]
+    for mobility_product, kwargs in products:
+      velocity = mobility_product(location, force, eta, a, **kwargs)
+      self.assertEqual(velocity.shape, force.shape)
+      for k in range(force.shape[1]):
+        velocity_k = mobility_product(location, force[:, k], eta, a, **kwargs)
+        for i in range(force.shape[0]):
+          self.assertAlmostEqual(velocity[i, k], velocity_k[i])
+
+    target = np.random.normal(1., 1., (5, 3))
+    target[:, 2] = np.abs(target[:, 2])
+    for mobility_product in [mb.mobility_vector_product_source_target_one_wall, 
+                             mb.mobility_vector_product_source_target_unbounded]:
+      velocity = mobility_product(location, target, force, radius, radius[0:5], eta)
+      self.assertEqual(velocity.shape, (15, 4))
+      for k in range(force.shape[1]):
+        velocity_k = mobility_product(location, target, force[:, k], radius, radius[0:5], eta).flatten()
+        for i in range(15):
+          self.assertAlmostEqual(velocity[i, k], velocity_k[i])
+
+  def test_tree_product_accuracy(self):
+    ''' 
+    Test that the tree code product is exact for theta = 0
+    and accurate for theta > 0.'''
+    location = np.random.uniform(0., 20., (400, 3))
+    location[:, 2] = np.random.uniform(0.5, 5., 400)
+    force = np.random.normal(0., 1., 1200)
+    eta = 1.0
+    a = 0.25
+    for wall, mob_tree, mob_numpy in [(True, mb.single_wall_mobility_trans_times_force_tree, mb.single_wall_mobility_trans_times_force_numpy),
+                                      (False, mb.no_wall_mobility_trans_times_force_tree, mb.no_wall_mobility_trans_times_force_numpy)]:
+      for L in [np.zeros(3), np.array([20., 20., 0.])]:
+        velocity = mob_numpy(location, force, eta, a, periodic_length=L)
+        velocity_exact = mob_tree(location, force, eta, a, periodic_length=L, theta=0., leaf_size=8)
+        velocity_tree = mob_tree(location, force, eta, a, periodic_length=L, theta=0.3, leaf_size=8)
+        error = np.linalg.norm(velocity_exact - velocity) / np.linalg.norm(velocity)
+        self.assertAlmostEqual(error, 0.0)
+        error = np.linalg.norm(velocity_tree - velocity) / np.linalg.norm(velocity)
+        self.assertTrue(error < 1e-02)
         
 
     
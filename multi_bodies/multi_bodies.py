@@ -3,7 +3,9 @@ import numpy as np
 import scipy.linalg
 import subprocess
 import cPickle
+import copy
 from functools import partial
+import os
 import sys
 import time
 
@@ -18,13 +20,16 @@ while found_functions is False:
   try:
     import multi_bodies_functions
     from mobility import mobility as mb
+    from quaternion_integrator import quaternion
     from quaternion_integrator.quaternion import Quaternion
     from quaternion_integrator.quaternion_integrator_multi_bodies import QuaternionIntegrator
+    from quaternion_integrator.quaternion_integrator_multi_bodies import InitialGuess
     from quaternion_integrator.quaternion_integrator_rollers import QuaternionIntegratorRollers
     from body import body 
     from read_input import read_input
     from read_input import read_vertex_file
     from read_input import read_clones_file
+    from read_input import clones_binary_file
     from read_input import read_slip_file
     import utils
     try:
@@ -73,7 +78,8 @@ def set_mobility_blobs(implementation):
   at the blob level to the right implementation.
   The implementation in C++ is much faster than 
   the one python; to use it the user should compile 
-  the file mobility/mobility_ext.cc.
+  the file mobility/mobility_ext.cc. The numpy implementation
+  is vectorized and does not need any compilation.
 
   These functions return an array with shape 
   (3*Nblobs, 3*Nblobs).
@@ -83,14 +89,18 @@ def set_mobility_blobs(implementation):
     return mb.rotne_prager_tensor
   elif implementation == 'C++_no_wall':
     return mb.boosted_infinite_fluid_mobility
+  elif implementation == 'numpy_no_wall':
+    return mb.rotne_prager_tensor_numpy
   # Implementations with wall
   elif implementation == 'python':
     return mb.single_wall_fluid_mobility
   elif implementation == 'C++':
     return  mb.boosted_single_wall_fluid_mobility
+  elif implementation == 'numpy':
+    return mb.single_wall_fluid_mobility_numpy
 
 
-def set_mobility_vector_prod(implementation):
+def set_mobility_vector_prod(implementation, *args, **kwargs):
   '''
   Set the function to compute the matrix-vector
   product (M*F) with the mobility defined at the blob 
@@ -101,8 +111,16 @@ def set_mobility_vector_prod(implementation):
   To use the pycuda implementation is necessary to have 
   installed pycuda and a GPU with CUDA capabilities. To
   use the C++ implementation the user has to compile 
-  the file mobility/mobility_ext.cc.  
+  the file mobility/mobility_ext.cc. The numpy implementation
+  computes the product in tiles without building the
+  mobility matrix and does not need any compilation.
+  The numpy_parallel implementation distributes the tiles 
+  among num_threads threads. The tree implementation approximates
+  the product with a Barnes-Hut tree code, its accuracy is 
+  controlled by the opening angle tree_theta.
   ''' 
+  num_threads = kwargs.get('num_threads', 1)
+  tree_theta = kwargs.get('tree_theta', 0.5)
   # Implementations without wall
   if implementation == 'python_no_wall':
     return mb.no_wall_fluid_mobility_product
@@ -110,6 +128,12 @@ def set_mobility_vector_prod(implementation):
     return mb.boosted_no_wall_mobility_vector_product
   elif implementation == 'pycuda_no_wall':
     return mb.no_wall_mobility_trans_times_force_pycuda
+  elif implementation == 'numpy_no_wall':
+    return mb.no_wall_mobility_trans_times_force_numpy
+  elif implementation == 'numpy_parallel_no_wall':
+    return partial(mb.no_wall_mobility_trans_times_force_numpy, num_threads=num_threads)
+  elif implementation == 'tree_no_wall':
+    return partial(mb.no_wall_mobility_trans_times_force_tree, theta=tree_theta)
   # Implementations with wall
   elif implementation == 'python':
     return mb.single_wall_fluid_mobility_product
@@ -117,8 +141,49 @@ def set_mobility_vector_prod(implementation):
     return mb.boosted_mobility_vector_product
   elif implementation == 'pycuda':
     return mb.single_wall_mobility_trans_times_force_pycuda
+  elif implementation == 'numpy':
+    return mb.single_wall_mobility_trans_times_force_numpy
+  elif implementation == 'numpy_parallel':
+    return partial(mb.single_wall_mobility_trans_times_force_numpy, num_threads=num_threads)
+  elif implementation == 'tree':
+    return partial(mb.single_wall_mobility_trans_times_force_tree, theta=tree_theta)
 
 
+
+def set_mobility_matmat(implementation, *args, **kwargs):
+  '''
+  Set the function to compute the product M*F with the mobility
+  defined at the blob level and F an array with shape (3*Nblobs, k),
+  with the same implementations as set_mobility_vector_prod.
+
+  The python, numpy and C++ implementations evaluate the blocks
+  of each pair of blobs once for the k columns. The pycuda and
+  tree implementations compute the product column by column.
+  '''
+  num_threads = kwargs.get('num_threads', 1)
+  # Implementations without wall
+  if implementation == 'python_no_wall':
+    return mb.no_wall_fluid_mobility_product
+  elif implementation == 'C++_no_wall':
+    return mb.boosted_no_wall_mobility_matrix_product
+  elif implementation == 'numpy_no_wall':
+    return mb.no_wall_mobility_trans_times_force_numpy
+  elif implementation == 'numpy_parallel_no_wall':
+    return partial(mb.no_wall_mobility_trans_times_force_numpy, num_threads=num_threads)
+  # Implementations with wall
+  elif implementation == 'python':
+    return mb.single_wall_fluid_mobility_product
+  elif implementation == 'C++':
+    return mb.boosted_mobility_matrix_product
+  elif implementation == 'numpy':
+    return mb.single_wall_mobility_trans_times_force_numpy
+  elif implementation == 'numpy_parallel':
+    return partial(mb.single_wall_mobility_trans_times_force_numpy, num_threads=num_threads)
+  # Implementations without batched kernel
+  else:
+    return partial(mb.mobility_matrix_product_columns,
+                   mobility_vector_prod=set_mobility_vector_prod(implementation, *args, **kwargs))
+
 def calc_K_matrix(bodies, Nblobs):
   '''
   Calculate the geometric block-diagonal matrix K.
@@ -133,16 +198,21 @@ def calc_K_matrix(bodies, Nblobs):
   return K
 
 
-def calc_K_matrix_bodies(bodies, Nblobs):
+def calc_K_matrix_bodies(bodies, Nblobs, r_vectors = None):
   '''
-  Calculate the geometric matrix K for
-  each body. List of shape (3*Nblobs, 6*Nbodies).
+  Calculate the information to apply the geometric matrix K
+  without building it. Return a tuple with the blobs coordinates 
+  relative to the center of their bodies, shape (Nblobs, 3), and 
+  the index of the first blob of each body, shape (Nbodies).
   '''
-  K = []
-  for k, b in enumerate(bodies):
-    K_body = b.calc_K_matrix()
-    K.append(K_body)
-  return K
+  Nblobs_bodies = np.array([b.Nblobs for b in bodies], dtype=int)
+  blobs_index = np.zeros(len(bodies), dtype=int)
+  blobs_index[1:] = np.cumsum(Nblobs_bodies)[:-1]
+  if r_vectors is None:
+    r_vectors = get_blobs_r_vectors(bodies, Nblobs)
+  location = np.array([b.location for b in bodies]).reshape((len(bodies), 3))
+  r_offsets = np.reshape(r_vectors, (Nblobs, 3)) - np.repeat(location, Nblobs_bodies, axis=0)
+  return r_offsets, blobs_index
 
 
 def K_matrix_vector_prod(bodies, vector, Nblobs, K_bodies = None):
@@ -150,20 +220,19 @@ def K_matrix_vector_prod(bodies, vector, Nblobs, K_bodies = None):
   Compute the matrix vector product K*vector where
   K is the geometrix matrix that transport the information from the 
   level of describtion of the body to the level of describtion of the blobs.
+  The product is computed as v + w x r, with r the blobs
+  coordinates relative to the body center, see calc_K_matrix_bodies.
   ''' 
   # Prepare variables
-  result = np.empty((Nblobs, 3))
-  v = np.reshape(vector, (len(bodies) * 6))
-
-  # Loop over bodies
-  offset = 0
-  for k, b in enumerate(bodies):
-    if K_bodies is None:
-      K = b.calc_K_matrix()
-    else:
-      K = K_bodies[k] 
-    result[offset : offset+b.Nblobs] = np.reshape(np.dot(K, v[6*k : 6*(k+1)]), (b.Nblobs, 3))
-    offset += b.Nblobs    
+  if K_bodies is None:
+    K_bodies = calc_K_matrix_bodies(bodies, Nblobs)
+  r_offsets, blobs_index = K_bodies
+  Nblobs_bodies = np.diff(np.append(blobs_index, Nblobs))
+  v = np.reshape(vector, (len(bodies), 6))
+
+  # Compute blobs velocities
+  result = np.repeat(v[:, 0:3], Nblobs_bodies, axis=0)
+  result += np.cross(np.repeat(v[:, 3:6], Nblobs_bodies, axis=0), r_offsets)
   return result
 
 
@@ -172,21 +241,19 @@ def K_matrix_T_vector_prod(bodies, vector, Nblobs, K_bodies = None):
   Compute the matrix vector product K^T*vector where
   K is the geometrix matrix that transport the information from the 
   level of describtion of the body to the level of describtion of the blobs.
+  The product is computed as (sum(lambda), sum(r x lambda)), with r the blobs
+  coordinates relative to the body center, see calc_K_matrix_bodies.
   ''' 
   # Prepare variables
-  result = np.empty((len(bodies), 6))
-  v = np.reshape(vector, (Nblobs * 3))
-
-  # Loop over bodies
-  offset = 0
-  for k, b in enumerate(bodies):
-    if K_bodies is None:
-      K = b.calc_K_matrix()
-    else:
-      K = K_bodies[k] 
-    result[k : k+1] = np.dot(K.T, v[3*offset : 3*(offset+b.Nblobs)])
-    offset += b.Nblobs    
-
+  if K_bodies is None:
+    K_bodies = calc_K_matrix_bodies(bodies, Nblobs)
+  r_offsets, blobs_index = K_bodies
+  v = np.reshape(vector, (Nblobs, 3))
+
+  # Compute force and torque on bodies
+  result = np.empty((len(bodies), 2, 3))
+  result[:, 0] = np.add.reduceat(v, blobs_index, axis=0)
+  result[:, 1] = np.add.reduceat(np.cross(r_offsets, v), blobs_index, axis=0)
   result = np.reshape(result, (2*len(bodies), 3))
   return result
 
@@ -205,6 +272,8 @@ def linear_operator_rigid(vector, bodies, r_vectors, eta, a, K_bodies = None, *a
   Ncomp_bodies = 6 * len(bodies)
   res = np.empty((Ncomp_blobs + Ncomp_bodies))
   v = np.reshape(vector, (vector.size/3, 3))
+  if K_bodies is None:
+    K_bodies = calc_K_matrix_bodies(bodies, Nblobs, r_vectors = r_vectors)
   
   # Compute the "slip" part
   res[0:Ncomp_blobs] = mobility_vector_prod(r_vectors, vector[0:Ncomp_blobs], eta, a, *args, **kwargs) 
@@ -217,12 +286,148 @@ def linear_operator_rigid(vector, bodies, r_vectors, eta, a, K_bodies = None, *a
   return res
 
 
-@utils.static_var('mobility_bodies', [])
-@utils.static_var('K_bodies', [])
-@utils.static_var('M_factorization_blobs', [])
-@utils.static_var('M_factorization_blobs_inv', [])
-@utils.static_var('mobility_inv_blobs', [])
-def build_block_diagonal_preconditioners_det_stoch(bodies, r_vectors, Nblobs, eta, a, *args, **kwargs):
+def linear_operator_rigid_matmat(X, bodies, r_vectors, eta, a, K_bodies = None, *args, **kwargs):
+  '''
+  Return the action of the linear operator of the rigid body on the
+  columns of X, an array with shape (3*Nblobs + 6*num_bodies, k).
+  The mobility products of all the columns are computed at once 
+  with mobility_matmat, see set_mobility_matmat.
+  '''
+  Ncomp_blobs = r_vectors.size
+  Nblobs = r_vectors.size / 3
+  Ncomp_bodies = 6 * len(bodies)
+  if K_bodies is None:
+    K_bodies = calc_K_matrix_bodies(bodies, Nblobs, r_vectors = r_vectors)
+  res = np.empty(X.shape)
+
+  # Compute the "slip" part
+  res[0:Ncomp_blobs] = mobility_matmat(r_vectors, X[0:Ncomp_blobs], eta, a, *args, **kwargs)
+  for k in range(X.shape[1]):
+    K_times_U = K_matrix_vector_prod(bodies, X[Ncomp_blobs : Ncomp_blobs+Ncomp_bodies, k], Nblobs, K_bodies = K_bodies)
+    res[0:Ncomp_blobs, k] -= np.reshape(K_times_U, (3*Nblobs))
+
+    # Compute the "-force_torque" part
+    K_T_times_lambda = K_matrix_T_vector_prod(bodies, X[0:Ncomp_blobs, k], Nblobs, K_bodies = K_bodies)
+    res[Ncomp_blobs : Ncomp_blobs+Ncomp_bodies, k] = -np.reshape(K_T_times_lambda, (Ncomp_bodies))
+  return res
+
+
+class PreconditionerRefresh(object):
+  '''
+  Store the blocks of the block diagonal preconditioners and decide
+  when to factorize them again.
+
+  All the blocks are factorized every update_PC steps. In between,
+  if the thresholds are larger than zero, only the blocks of the bodies
+  that moved more than height_threshold in the direction normal to the wall
+  or rotated more than angle_threshold (in radians) since their last
+  factorization are factorized again. Besides, all the blocks are
+  factorized again when the average number of iterations of the last
+  window solves is larger than iterations_ratio times the average
+  after the last full factorization.
+  '''
+  def __init__(self, update_PC = 1, height_threshold = 0.0, angle_threshold = 0.0, iterations_ratio = 0.0, window = 8):
+    self.update_PC = update_PC
+    self.height_threshold = height_threshold
+    self.angle_threshold = angle_threshold
+    self.iterations_ratio = iterations_ratio
+    self.window = window
+    self.caches = {}
+    self.iterations = {}
+    self.iterations_reference = {}
+    self.full_factorizations_count = 0
+    self.body_factorizations_count = 0
+
+  def update_cache(self, name, bodies, step = 0):
+    '''
+    Return the cache of the preconditioner name and the indices of 
+    the bodies with outdated blocks. Every update_PC steps the cache
+    is created again and all the bodies are outdated.
+    '''
+    cache = self.caches.get(name)
+    location = np.array([b.location for b in bodies])
+    orientation = np.array([b.orientation.entries for b in bodies])
+    if cache is None or len(cache['location']) != len(bodies) or (step % self.update_PC == 0 and step != cache['step']):
+      # Factorize all the blocks
+      cache = {'blocks': [None] * len(bodies), 'shared': {}, 'location': location, 'orientation': orientation, 'step': step}
+      self.caches[name] = cache
+      self.iterations = {}
+      self.iterations_reference = {}
+      self.full_factorizations_count += 1
+      return cache, np.arange(len(bodies))
+
+    # Factorize the blocks of the bodies that moved
+    moved = np.zeros(len(bodies), dtype=bool)
+    if self.height_threshold > 0:
+      moved = np.logical_or(moved, np.abs(location[:,2] - cache['location'][:,2]) > self.height_threshold)
+    if self.angle_threshold > 0:
+      cos_half_angle = np.minimum(np.abs(np.einsum('ij,ij->i', orientation, cache['orientation'])), 1.0)
+      moved = np.logical_or(moved, 2.0 * np.arccos(cos_half_angle) > self.angle_threshold)
+    cache['location'][moved] = location[moved]
+    cache['orientation'][moved] = orientation[moved]
+    return cache, np.flatnonzero(moved)
+
+  def get_blocks(self, name, bodies, factorize, step = 0, key = None):
+    '''
+    Return the list of blocks of the preconditioner name, one per body,
+    factorizing again the outdated ones with the function factorize(body).
+    If key is not None the bodies with the same key(body) share one block,
+    factorized for the first of them.
+    '''
+    cache, outdated = self.update_cache(name, bodies, step)
+    for k in outdated:
+      if key is None:
+        cache['blocks'][k] = factorize(bodies[k])
+        self.body_factorizations_count += 1
+      else:
+        key_k = key(bodies[k])
+        if key_k not in cache['shared']:
+          cache['shared'][key_k] = factorize(bodies[k])
+          self.body_factorizations_count += 1
+        cache['blocks'][k] = cache['shared'][key_k]
+    return cache['blocks']
+
+  def get_cluster_blocks(self, name, bodies, find_clusters, factorize, step = 0):
+    '''
+    Return the list of clusters of the preconditioner name, arrays with 
+    the indices of their bodies found with find_clusters(), and the list 
+    of their blocks factorized with factorize(cluster). The clusters are 
+    found again when all the blocks are factorized, in between only the
+    blocks of the clusters with outdated bodies are factorized again.
+    '''
+    cache, outdated = self.update_cache(name, bodies, step)
+    if 'clusters' not in cache:
+      cache['clusters'] = find_clusters()
+      cache['blocks'] = [None] * len(cache['clusters'])
+      cache['cluster_of_body'] = np.empty(len(bodies), dtype=int)
+      for k, cluster in enumerate(cache['clusters']):
+        cache['cluster_of_body'][cluster] = k
+    for k in np.unique(cache['cluster_of_body'][outdated]):
+      cache['blocks'][k] = factorize(cache['clusters'][k])
+      self.body_factorizations_count += len(cache['clusters'][k])
+    return cache['clusters'], cache['blocks']
+
+  def add_iterations(self, kind, iterations):
+    '''
+    Save the iterations of a solve of kind (e.g. 'deterministic' or
+    'stochastic'). If the average of the last solves grows too much
+    all the blocks are factorized in the next call to get_blocks.
+    '''
+    if self.iterations_ratio <= 0:
+      return
+    x = self.iterations.setdefault(kind, [])
+    x.append(iterations)
+    if len(x) > self.window:
+      del x[0]
+    if len(x) == self.window:
+      mean = np.mean(x)
+      if kind not in self.iterations_reference:
+        self.iterations_reference[kind] = mean
+      elif mean > self.iterations_ratio * max(self.iterations_reference[kind], 1.0):
+        self.caches = {}
+
+
+def build_block_diagonal_preconditioners_det_stoch(bodies, r_vectors, Nblobs, eta, a, refresh = None, *args, **kwargs):
   '''
   Build the deterministic and stochastic block diagonal preconditioners for rigid bodies.
   It solves exactly the mobility problem for each body
@@ -242,50 +447,42 @@ def build_block_diagonal_preconditioners_det_stoch(bodies, r_vectors, Nblobs, et
   y = (P.T * M * P) * x
   y = P_inv * x
   y = N*F - N*K.T*M^{-1}*slip
+
+  The blocks are stored in refresh (a PreconditionerRefresh object)
+  that decides which ones to factorize again; if refresh is None
+  all the blocks are factorized.
   '''
-  mobility_bodies = []
-  K_bodies = []
-  M_factorization_blobs = []
-  M_factorization_blobs_inv = []
-  mobility_inv_blobs = []
-
-  if(kwargs.get('step') % kwargs.get('update_PC') == 0) or len(build_block_diagonal_preconditioners_det_stoch.mobility_bodies) == 0:
-    # Loop over bodies
-    for b in bodies:
-      # 1. Compute blobs mobility 
-      M = b.calc_mobility_blobs(eta, a)
-      # 2. Compute Cholesy factorization, M = L^T * L
-      L, lower = scipy.linalg.cho_factor(M)
-      L = np.triu(L)   
-      M_factorization_blobs.append(L.T)
-      # 3. Compute inverse of L
-      M_factorization_blobs_inv.append(scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), check_finite=False))
-      # 4. Compute inverse mobility blobs
-      mobility_inv_blobs.append(scipy.linalg.solve_triangular(L, scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), trans='T', check_finite=False), check_finite=False))
-      # 5. Compute geometric matrix K
-      K = b.calc_K_matrix()
-      K_bodies.append(K)
-      # 6. Compute body mobility
-      mobility_bodies.append(np.linalg.pinv(np.dot(K.T, scipy.linalg.cho_solve((L,lower), K, check_finite=False))))
-
-    # Save variables to use in next steps if PC is not updated
-    build_block_diagonal_preconditioners_det_stoch.mobility_bodies = mobility_bodies
-    build_block_diagonal_preconditioners_det_stoch.K_bodies = K_bodies
-    build_block_diagonal_preconditioners_det_stoch.M_factorization_blobs = M_factorization_blobs
-    build_block_diagonal_preconditioners_det_stoch.M_factorization_blobs_inv = M_factorization_blobs_inv
-    build_block_diagonal_preconditioners_det_stoch.mobility_inv_blobs = mobility_inv_blobs
+  def factorize(b):
+    # 1. Compute blobs mobility 
+    M = b.calc_mobility_blobs(eta, a)
+    # 2. Compute Cholesy factorization, M = L^T * L
+    L, lower = scipy.linalg.cho_factor(M)
+    L = np.triu(L)   
+    # 3. Compute inverse of L
+    L_inv = scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), check_finite=False)
+    # 4. Compute inverse mobility blobs
+    M_inv = scipy.linalg.solve_triangular(L, scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), trans='T', check_finite=False), check_finite=False)
+    # 5. Compute geometric matrix K
+    K = b.calc_K_matrix()
+    # 6. Compute body mobility
+    N = np.linalg.pinv(np.dot(K.T, scipy.linalg.cho_solve((L,lower), K, check_finite=False)))
+    return L.T, L_inv, M_inv, K, N
+
+  if refresh is None:
+    blocks = [factorize(b) for b in bodies]
   else:
-    # Use old values
-    mobility_bodies = build_block_diagonal_preconditioners_det_stoch.mobility_bodies 
-    K_bodies = build_block_diagonal_preconditioners_det_stoch.K_bodies
-    M_factorization_blobs = build_block_diagonal_preconditioners_det_stoch.M_factorization_blobs 
-    M_factorization_blobs_inv = build_block_diagonal_preconditioners_det_stoch.M_factorization_blobs_inv 
-    mobility_inv_blobs = build_block_diagonal_preconditioners_det_stoch.mobility_inv_blobs 
-    
+    blocks = refresh.get_blocks('det_stoch', bodies, factorize, step = kwargs.get('step'))
+  M_factorization_blobs = [block[0] for block in blocks]
+  M_factorization_blobs_inv = [block[1] for block in blocks]
+  mobility_inv_blobs = [block[2] for block in blocks]
+  K_bodies = [block[3] for block in blocks]
+  mobility_bodies = [block[4] for block in blocks]
+
 
   def block_diagonal_preconditioner(vector, bodies = None, mobility_bodies = None, mobility_inv_blobs = None, K_bodies = None, Nblobs = None, *args, **kwargs):
     '''
-    Apply the block diagonal preconditioner.
+    Apply the block diagonal preconditioner. vector can be
+    an array with shape (System_size, k).
     '''
     result = np.empty(vector.shape)
     offset = 0
@@ -340,48 +537,42 @@ def build_block_diagonal_preconditioners_det_stoch(bodies, r_vectors, Nblobs, et
   return block_diagonal_preconditioner_partial, mobility_pc_partial, P_inv_mult_partial
 
 
-@utils.static_var('mobility_bodies', [])
-@utils.static_var('K_bodies', [])
-@utils.static_var('mobility_inv_blobs', [])
-def build_block_diagonal_preconditioner(bodies, r_vectors, Nblobs, eta, a, *args, **kwargs):
+def build_block_diagonal_preconditioner(bodies, r_vectors, Nblobs, eta, a, refresh = None, *args, **kwargs):
   '''
   Build the block diagonal preconditioner for rigid bodies.
   It solves exactly the mobility problem for each body
   independently, i.e., no interation between bodies is taken
   into account.
+
+  The blocks are stored in refresh (a PreconditionerRefresh object),
+  if refresh is None all the blocks are factorized.
   '''
-  mobility_inv_blobs = []
-  mobility_bodies = []
-  K_bodies = []
-  if(kwargs.get('step') % kwargs.get('update_PC') == 0) or len(build_block_diagonal_preconditioner.mobility_bodies) == 0:
-    # Loop over bodies
-    for b in bodies:
-      # 1. Compute blobs mobility and invert it
-      M = b.calc_mobility_blobs(eta, a)
-      # 2. Compute Cholesy factorization, M = L^T * L
-      L, lower = scipy.linalg.cho_factor(M)
-      L = np.triu(L)   
-      # 3. Compute inverse mobility blobs
-      mobility_inv_blobs.append(scipy.linalg.solve_triangular(L, scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), trans='T', check_finite=False), check_finite=False))
-      # 4. Compute geometric matrix K
-      K = b.calc_K_matrix()
-      K_bodies.append(K)
-      # 5. Compute body mobility
-      mobility_bodies.append(np.linalg.pinv(np.dot(K.T, scipy.linalg.cho_solve((L,lower), K, check_finite=False))))
-
-    # Save variables to use in next steps if PC is not updated
-    build_block_diagonal_preconditioner.mobility_bodies = mobility_bodies
-    build_block_diagonal_preconditioner.K_bodies = K_bodies
-    build_block_diagonal_preconditioner.mobility_inv_blobs = mobility_inv_blobs
+  def factorize(b):
+    # 1. Compute blobs mobility and invert it
+    M = b.calc_mobility_blobs(eta, a)
+    # 2. Compute Cholesy factorization, M = L^T * L
+    L, lower = scipy.linalg.cho_factor(M)
+    L = np.triu(L)   
+    # 3. Compute inverse mobility blobs
+    M_inv = scipy.linalg.solve_triangular(L, scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), trans='T', check_finite=False), check_finite=False)
+    # 4. Compute geometric matrix K
+    K = b.calc_K_matrix()
+    # 5. Compute body mobility
+    N = np.linalg.pinv(np.dot(K.T, scipy.linalg.cho_solve((L,lower), K, check_finite=False)))
+    return M_inv, K, N
+
+  if refresh is None:
+    blocks = [factorize(b) for b in bodies]
   else:
-    # Use old values
-    mobility_bodies = build_block_diagonal_preconditioner.mobility_bodies 
-    K_bodies = build_block_diagonal_preconditioner.K_bodies
-    mobility_inv_blobs = build_block_diagonal_preconditioner.mobility_inv_blobs 
+    blocks = refresh.get_blocks('det', bodies, factorize, step = kwargs.get('step'))
+  mobility_inv_blobs = [block[0] for block in blocks]
+  K_bodies = [block[1] for block in blocks]
+  mobility_bodies = [block[2] for block in blocks]
 
   def block_diagonal_preconditioner(vector, bodies = None, mobility_bodies = None, mobility_inv_blobs = None, K_bodies = None, Nblobs = None):
     '''
-    Apply the block diagonal preconditioner.
+    Apply the block diagonal preconditioner. vector can be
+    an array with shape (System_size, k).
     '''
     result = np.empty(vector.shape)
     offset = 0
@@ -411,6 +602,382 @@ def build_block_diagonal_preconditioner(bodies, r_vectors, Nblobs, eta, a, *args
   return block_diagonal_preconditioner_partial
 
 
+def build_block_diagonal_preconditioners_structure(bodies, r_vectors, Nblobs, eta, a, domain = 'single_wall', height_bucket = 0.0, refresh = None, *args, **kwargs):
+  '''
+  Build the same deterministic and stochastic block diagonal preconditioners
+  than build_block_diagonal_preconditioners_det_stoch but factorizing
+  the blobs mobility only once per structure type.
+
+  The blocks are computed in the body frame of reference and
+  applied to each body rotating the vectors, since for a body with 
+  rotation matrix R the blobs mobility is M = R * M_body * R^T. 
+  Without wall (domain = 'no_wall') this is exact and all the bodies 
+  of a structure share the same blocks. With a wall M_body is invariant
+  under rotations about the z axis, so it only depends on the height z 
+  of the body and on the direction of the z axis in the body frame, 
+  R^T * e_z. The bodies are grouped in buckets of z and of 
+  R^T * e_z * max|r_blob| of width height_bucket (the blob radius if 
+  height_bucket <= 0), so the heights of the blobs of the bodies in a bucket
+  differ in less than about 2 * height_bucket, and all the bodies in a bucket 
+  share the blocks of the first body in the bucket. The cost to build the 
+  preconditioners is O(number_of_structures * number_of_buckets * Nblobs_structure**3).
+
+  The blocks are stored in refresh (a PreconditionerRefresh object)
+  that decides which bodies use new blocks; if refresh is None
+  all the blocks are factorized.
+  '''
+  if height_bucket <= 0:
+    height_bucket = a
+  if refresh is None:
+    refresh = PreconditionerRefresh()
+
+  def key(b):
+    # Bodies with the same key share blocks
+    key_b = (b.ID, b.Nblobs) if b.ID is not None else (id(b),)
+    if domain != 'no_wall':
+      # Bucket the height and the z axis in the body frame, R^T * e_z
+      radius = np.max(np.linalg.norm(b.reference_configuration, axis=1))
+      key_b += (int(np.floor(b.location[2] / height_bucket)),)
+      key_b += tuple(np.floor(b.orientation.rotation_matrix()[2] * radius / height_bucket).astype(int))
+    return key_b
+
+  def factorize(b):
+    # 1. Compute blobs mobility in the body frame, M_body = R^T * M * R
+    R = b.orientation.rotation_matrix()
+    M = np.reshape(b.calc_mobility_blobs(eta, a), (b.Nblobs, 3, b.Nblobs, 3))
+    M = np.reshape(np.einsum('mi,bmcn,nj->bicj', R, M, R), (3 * b.Nblobs, 3 * b.Nblobs))
+    # 2. Compute Cholesy factorization, M = L^T * L
+    L, lower = scipy.linalg.cho_factor(M)
+    L = np.triu(L)
+    # 3. Compute inverse of L
+    L_inv = scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), check_finite=False)
+    # 4. Compute inverse mobility blobs
+    M_inv = scipy.linalg.solve_triangular(L, scipy.linalg.solve_triangular(L, np.eye(b.Nblobs * 3), trans='T', check_finite=False), check_finite=False)
+    # 5. Compute geometric matrix K in the body frame
+    K = b.calc_K_matrix(location = np.zeros(3), orientation = Quaternion(np.array([1.0, 0.0, 0.0, 0.0])))
+    # 6. Compute body mobility
+    N = np.linalg.pinv(np.dot(K.T, scipy.linalg.cho_solve((L,lower), K, check_finite=False)))
+    return L, L_inv, M_inv, K, N
+  blocks = refresh.get_blocks('structure', bodies, factorize, step = kwargs.get('step'), key = key)
+
+  # Group bodies that share blocks
+  R = quaternion.rotation_matrix_array(np.array([b.orientation.entries for b in bodies]).reshape((len(bodies), 4)))
+  groups = {}
+  offset = 0
+  for k, b in enumerate(bodies):
+    groups.setdefault(id(blocks[k]), []).append((k, offset))
+    offset += b.Nblobs
+
+  group_list = []
+  for members in groups.itervalues():
+    body_index = np.array([m[0] for m in members], dtype=int)
+    blobs_offset = np.array([m[1] for m in members], dtype=int)
+    b = bodies[body_index[0]]
+    # Indices of the blobs components with shape (Nbodies_group, Nblobs_structure, 3)
+    # and of the bodies components with shape (Nbodies_group, 2, 3)
+    blobs_index = 3 * (blobs_offset[:, None, None] + np.arange(b.Nblobs)[None, :, None]) + np.arange(3)
+    bodies_index = 3 * Nblobs + 6 * body_index[:, None, None] + np.arange(6).reshape((2, 3))
+    group_list.append((R[body_index], blobs_index, bodies_index, blocks[body_index[0]]))
+
+  def to_body_frame(R, x):
+    ''' Rotate the vectors x, shape (Nbodies_group, N, 3), to the body frame. '''
+    return np.reshape(np.einsum('kji,knj->kni', R, x), (x.shape[0], x.shape[1] * 3))
+
+  def to_lab_frame(R, x):
+    ''' Rotate the vectors x, shape (Nbodies_group, 3*N), to the lab frame. '''
+    return np.einsum('kij,knj->kni', R, np.reshape(x, (x.shape[0], x.shape[1] / 3, 3)))
+
+  def block_diagonal_preconditioner(vector, group_list = None):
+    '''
+    Apply the block diagonal preconditioner.
+    '''
+    result = np.empty(vector.shape)
+    for R, blobs_index, bodies_index, (L, L_inv, M_inv, K, N) in group_list:
+      # 1. Solve M*Lambda_tilde = slip
+      slip = to_body_frame(R, vector[blobs_index])
+      Lambda_tilde = np.dot(slip, M_inv)
+      # 2. Compute rigid body velocity
+      F = to_body_frame(R, vector[bodies_index])
+      Y = np.dot(-F - np.dot(Lambda_tilde, K), N.T)
+      # 3. Solve M*Lambda = (slip + K*Y)
+      result[blobs_index] = to_lab_frame(R, np.dot(slip + np.dot(Y, K.T), M_inv))
+      # 4. Set result
+      result[bodies_index] = to_lab_frame(R, Y)
+    return result
+  block_diagonal_preconditioner_partial = partial(block_diagonal_preconditioner, group_list = group_list)
+
+  # Define preconditioned mobility matrix product, with P = R * inv(L)
+  def mobility_pc(w, group_list = None, r_vectors = None, eta = None, a = None, *args, **kwargs):
+    result = np.empty_like(w)
+    # Apply P
+    for R, blobs_index, bodies_index, (L, L_inv, M_inv, K, N) in group_list:
+      result[blobs_index] = to_lab_frame(R, np.dot(w[blobs_index].reshape((R.shape[0], -1)), L_inv.T))
+    # Multiply by M
+    result_2 = mobility_vector_prod(r_vectors, result, eta, a, *args, **kwargs)
+    # Apply P.T
+    for R, blobs_index, bodies_index, (L, L_inv, M_inv, K, N) in group_list:
+      result[blobs_index] = np.dot(to_body_frame(R, result_2[blobs_index]), L_inv).reshape(blobs_index.shape)
+    return result
+  mobility_pc_partial = partial(mobility_pc, group_list = group_list, r_vectors = r_vectors, eta = eta, a = a, *args, **kwargs)
+
+  # Define inverse preconditioner P_inv = R * L^T
+  def P_inv_mult(w, group_list = None):
+    for R, blobs_index, bodies_index, (L, L_inv, M_inv, K, N) in group_list:
+      w[blobs_index] = to_lab_frame(R, np.dot(w[blobs_index].reshape((R.shape[0], -1)), L))
+    return w
+  P_inv_mult_partial = partial(P_inv_mult, group_list = group_list)
+
+  # Return preconditioner functions
+  return block_diagonal_preconditioner_partial, mobility_pc_partial, P_inv_mult_partial
+
+
+def build_block_diagonal_preconditioner_structure(bodies, r_vectors, Nblobs, eta, a, domain = 'single_wall', height_bucket = 0.0, refresh = None, *args, **kwargs):
+  '''
+  Build the deterministic block diagonal preconditioner for rigid bodies
+  with the blocks shared by structure type, see 
+  build_block_diagonal_preconditioners_structure.
+  '''
+  return build_block_diagonal_preconditioners_structure(bodies, r_vectors, Nblobs, eta, a, domain, height_bucket, refresh, *args, **kwargs)[0]
+
+
+def build_block_diagonal_preconditioners_cholesky(bodies, r_vectors, Nblobs, eta, a, single_precision = 'False', refresh = None, *args, **kwargs):
+  '''
+  Build the same deterministic and stochastic block diagonal preconditioners
+  than build_block_diagonal_preconditioners_det_stoch but storing for each 
+  body only the Cholesky factor L of the blobs mobility, M = L^T * L, in packed 
+  format (in single precision if single_precision == 'True'). The inverses are 
+  never formed, the preconditioners are applied with triangular solves and the body 
+  mobility N = (K.T * M^{-1} * K)^{-1} is applied with the Cholesky factorization 
+  of the 6x6 matrix K.T * M^{-1} * K.
+
+  The factors are stored in refresh (a PreconditionerRefresh object)
+  that decides which ones to factorize again; if refresh is None
+  all the blocks are factorized.
+  '''
+  if single_precision == 'True':
+    dtype = np.float32
+    trttp, tpsv, tpmv = scipy.linalg.lapack.strttp, scipy.linalg.blas.stpsv, scipy.linalg.blas.stpmv
+  else:
+    dtype = np.float64
+    trttp, tpsv, tpmv = scipy.linalg.lapack.dtrttp, scipy.linalg.blas.dtpsv, scipy.linalg.blas.dtpmv
+
+  def factorize(b):
+    # 1. Compute blobs mobility 
+    M = b.calc_mobility_blobs(eta, a)
+    # 2. Compute Cholesy factorization, M = L^T * L
+    L, lower = scipy.linalg.cho_factor(M, overwrite_a=True, check_finite=False)
+    # 3. Compute geometric matrix K
+    K = b.calc_K_matrix()
+    # 4. Factorize inverse body mobility K.T * M^{-1} * K
+    N_inv = np.dot(K.T, scipy.linalg.cho_solve((L,lower), K, check_finite=False))
+    try:
+      N_factor = scipy.linalg.cho_factor(N_inv)
+    except np.linalg.LinAlgError:
+      # Singular for bodies with collinear blobs, use the pseudo-inverse
+      N_factor = np.linalg.pinv(N_inv)
+    # 5. Save packed Cholesky factor
+    L_packed, info = trttp(np.asarray(L, dtype=dtype), uplo='U')
+    return L_packed, K, N_factor
+
+  if refresh is None:
+    factors = [factorize(b) for b in bodies]
+  else:
+    factors = refresh.get_blocks('cholesky', bodies, factorize, step = kwargs.get('step'))
+
+  def block_diagonal_preconditioner(vector, bodies = None, factors = None, Nblobs = None):
+    '''
+    Apply the block diagonal preconditioner.
+    '''
+    result = np.empty(vector.shape)
+    offset = 0
+    for k, b in enumerate(bodies):
+      L_packed, K, N_factor = factors[k]
+      n = 3 * b.Nblobs
+      # 1. Solve M*Lambda_tilde = slip
+      slip = vector[3*offset : 3*(offset + b.Nblobs)]
+      Lambda_tilde = tpsv(n, L_packed, tpsv(n, L_packed, slip.astype(dtype), trans=1))
+      # 2. Compute rigid body velocity
+      F = -vector[3*Nblobs + 6*k : 3*Nblobs + 6*(k+1)] - np.dot(K.T, Lambda_tilde)
+      Y = scipy.linalg.cho_solve(N_factor, F) if isinstance(N_factor, tuple) else np.dot(N_factor, F)
+      # 3. Solve M*Lambda = (slip + K*Y)
+      result[3*offset : 3*(offset + b.Nblobs)] = tpsv(n, L_packed, tpsv(n, L_packed, (slip + np.dot(K, Y)).astype(dtype), trans=1))
+      # 4. Set result
+      result[3*Nblobs + 6*k : 3*Nblobs + 6*(k+1)] = Y
+      offset += b.Nblobs
+    return result
+  block_diagonal_preconditioner_partial = partial(block_diagonal_preconditioner, bodies = bodies, factors = factors, Nblobs = Nblobs)
+
+  # Define preconditioned mobility matrix product, with P = inv(L)
+  def mobility_pc(w, bodies = None, factors = None, r_vectors = None, eta = None, a = None, *args, **kwargs):
+    result = np.empty_like(w)
+    # Apply P
+    offset = 0
+    for k, b in enumerate(bodies):
+      result[3*offset : 3*(offset + b.Nblobs)] = tpsv(3 * b.Nblobs, factors[k][0], w[3*offset : 3*(offset + b.Nblobs)].astype(dtype))
+      offset += b.Nblobs
+    # Multiply by M
+    result_2 = mobility_vector_prod(r_vectors, result, eta, a, *args, **kwargs)
+    # Apply P.T
+    offset = 0
+    for k, b in enumerate(bodies):
+      result[3*offset : 3*(offset + b.Nblobs)] = tpsv(3 * b.Nblobs, factors[k][0], result_2[3*offset : 3*(offset + b.Nblobs)].astype(dtype), trans=1)
+      offset += b.Nblobs
+    return result
+  mobility_pc_partial = partial(mobility_pc, bodies = bodies, factors = factors, r_vectors = r_vectors, eta = eta, a = a, *args, **kwargs)
+  
+  # Define inverse preconditioner P_inv = L^T
+  def P_inv_mult(w, bodies = None, factors = None):
+    offset = 0
+    for k, b in enumerate(bodies):
+      w[3*offset : 3*(offset + b.Nblobs)] = tpmv(3 * b.Nblobs, factors[k][0], w[3*offset : 3*(offset + b.Nblobs)].astype(dtype), trans=1)
+      offset += b.Nblobs
+    return w
+  P_inv_mult_partial = partial(P_inv_mult, bodies = bodies, factors = factors)
+
+  # Return preconditioner functions
+  return block_diagonal_preconditioner_partial, mobility_pc_partial, P_inv_mult_partial
+
+
+def build_block_diagonal_preconditioner_cholesky(bodies, r_vectors, Nblobs, eta, a, single_precision = 'False', refresh = None, *args, **kwargs):
+  '''
+  Build the deterministic block diagonal preconditioner for rigid bodies
+  storing only the Cholesky factors, see 
+  build_block_diagonal_preconditioners_cholesky.
+  '''
+  return build_block_diagonal_preconditioners_cholesky(bodies, r_vectors, Nblobs, eta, a, single_precision, refresh, *args, **kwargs)[0]
+
+
+def find_body_clusters(bodies, r_vectors, a, gap, max_bodies, *args, **kwargs):
+  '''
+  Group the bodies in clusters of at most max_bodies bodies. Two bodies
+  are joined if the gap between two of their blobs, i.e. the distance
+  minus 2*a, is smaller than gap; the closest pairs are joined first.
+  The blob pairs are found with a cell list. Returns a list with the 
+  indices of the bodies in each cluster.
+  '''
+  body_of_blob = np.repeat(np.arange(len(bodies)), [b.Nblobs for b in bodies])
+  i, j, r = multi_bodies_functions.neighbor_pairs_cell_list(r_vectors, 2.0 * a + gap, kwargs.get('periodic_length'))
+  body_i = body_of_blob[i]
+  body_j = body_of_blob[j]
+  sel = body_i != body_j
+  body_i, body_j = np.minimum(body_i[sel], body_j[sel]), np.maximum(body_i[sel], body_j[sel])
+  distance = np.sum(r[sel] * r[sel], axis=1)
+
+  # Keep the closest blob pair of each pair of bodies, sorted by distance
+  order = np.argsort(distance, kind='mergesort')
+  pair = body_i[order] * len(bodies) + body_j[order]
+  pair, first = np.unique(pair, return_index=True)
+  pair = pair[np.argsort(first)]
+
+  # Join clusters (union-find) if the joined cluster is small enough
+  root = np.arange(len(bodies))
+  size = np.ones(len(bodies), dtype=int)
+  def find(k):
+    while root[k] != k:
+      root[k] = root[root[k]]
+      k = root[k]
+    return k
+  for p in pair:
+    ri = find(p // len(bodies))
+    rj = find(p % len(bodies))
+    if ri != rj and size[ri] + size[rj] <= max_bodies:
+      root[rj] = ri
+      size[ri] += size[rj]
+  roots = np.array([find(k) for k in range(len(bodies))])
+  return [np.flatnonzero(roots == k) for k in np.unique(roots)]
+
+
+def build_block_diagonal_preconditioners_cluster(bodies, r_vectors, Nblobs, eta, a, gap = 0.0, max_bodies = 8, refresh = None, *args, **kwargs):
+  '''
+  Build the deterministic and stochastic block diagonal preconditioners
+  with one block per cluster of bodies instead of one block per body.
+  The clusters group the bodies closer than gap (by default gap = a) 
+  with at most max_bodies bodies, see find_body_clusters. For each cluster 
+  the blobs mobility of all its bodies is factorized, M = L^T * L, so the
+  hydrodynamic interactions between nearly touching bodies are included.
+
+  The clusters and their blocks are stored in refresh (a PreconditionerRefresh
+  object), the clusters are formed again with the full factorizations and 
+  in between the clusters with outdated bodies are factorized again; 
+  if refresh is None the clusters are formed and factorized.
+
+  Returns the same functions than build_block_diagonal_preconditioners_det_stoch
+  with P = inv(L) and P_inv = L^T.
+  '''
+  if refresh is None:
+    refresh = PreconditionerRefresh()
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  offset = np.cumsum([0] + [b.Nblobs for b in bodies])
+
+  def factorize(cluster):
+    blobs_index = np.concatenate([np.arange(offset[k], offset[k+1]) for k in cluster])
+    bodies_index = np.concatenate([np.arange(3*Nblobs + 6*k, 3*Nblobs + 6*(k+1)) for k in cluster])
+    # 1. Compute blobs mobility of the cluster
+    M = bodies[cluster[0]].mobility_blobs(r_vectors[blobs_index], eta, a)
+    # 2. Compute Cholesy factorization, M = L^T * L
+    L, lower = scipy.linalg.cho_factor(M, overwrite_a=True, check_finite=False)
+    L = np.triu(L)
+    # 3. Compute geometric matrix K of the cluster
+    K = scipy.linalg.block_diag(*[bodies[k].calc_K_matrix() for k in cluster])
+    # 4. Compute cluster mobility
+    N = np.linalg.pinv(np.dot(K.T, scipy.linalg.cho_solve((L,lower), K, check_finite=False)))
+    blobs_index = np.reshape(3 * blobs_index[:, None] + np.arange(3), blobs_index.size * 3)
+    return blobs_index, bodies_index, L, K, N
+
+  find_clusters = partial(find_body_clusters, bodies, r_vectors, a, gap if gap > 0 else a, max_bodies, *args, **kwargs)
+  clusters = refresh.get_cluster_blocks('cluster', bodies, find_clusters, factorize, step = kwargs.get('step'))[1]
+
+  def block_diagonal_preconditioner(vector, clusters = None):
+    '''
+    Apply the block diagonal preconditioner.
+    '''
+    result = np.empty(vector.shape)
+    for blobs_index, bodies_index, L, K, N in clusters:
+      # 1. Solve M*Lambda_tilde = slip
+      slip = vector[blobs_index]
+      Lambda_tilde = scipy.linalg.cho_solve((L, False), slip, check_finite=False)
+      # 2. Compute rigid bodies velocities
+      Y = np.dot(N, -vector[bodies_index] - np.dot(K.T, Lambda_tilde))
+      # 3. Solve M*Lambda = (slip + K*Y)
+      result[blobs_index] = scipy.linalg.cho_solve((L, False), slip + np.dot(K, Y), check_finite=False)
+      # 4. Set result
+      result[bodies_index] = Y
+    return result
+  block_diagonal_preconditioner_partial = partial(block_diagonal_preconditioner, clusters = clusters)
+
+  # Define preconditioned mobility matrix product
+  def mobility_pc(w, clusters = None, r_vectors = None, eta = None, a = None, *args, **kwargs):
+    result = np.empty_like(w)
+    # Apply P
+    for cluster in clusters:
+      result[cluster[0]] = scipy.linalg.solve_triangular(cluster[2], w[cluster[0]], check_finite=False)
+    # Multiply by M
+    result_2 = mobility_vector_prod(r_vectors, result, eta, a, *args, **kwargs)
+    # Apply P.T
+    for cluster in clusters:
+      result[cluster[0]] = scipy.linalg.solve_triangular(cluster[2], result_2[cluster[0]], trans='T', check_finite=False)
+    return result
+  mobility_pc_partial = partial(mobility_pc, clusters = clusters, r_vectors = r_vectors, eta = eta, a = a, *args, **kwargs)
+
+  # Define inverse preconditioner P_inv
+  def P_inv_mult(w, clusters = None):
+    for cluster in clusters:
+      w[cluster[0]] = np.dot(cluster[2].T, w[cluster[0]])
+    return w
+  P_inv_mult_partial = partial(P_inv_mult, clusters = clusters)
+
+  # Return preconditioner functions
+  return block_diagonal_preconditioner_partial, mobility_pc_partial, P_inv_mult_partial
+
+
+def build_block_diagonal_preconditioner_cluster(bodies, r_vectors, Nblobs, eta, a, gap = 0.0, max_bodies = 8, refresh = None, *args, **kwargs):
+  '''
+  Build the deterministic block diagonal preconditioner with one
+  block per cluster of bodies, see build_block_diagonal_preconditioners_cluster.
+  '''
+  return build_block_diagonal_preconditioners_cluster(bodies, r_vectors, Nblobs, eta, a, gap, max_bodies, refresh, *args, **kwargs)[0]
+
+
 def block_diagonal_preconditioner(vector, bodies, mobility_bodies, mobility_inv_blobs, Nblobs):
   '''
   Block diagonal preconditioner for rigid bodies.
@@ -496,11 +1063,126 @@ def build_stochastic_block_diagonal_preconditioner(bodies, r_vectors, eta, a, *a
   return mobility_pc_partial, P_inv_mult_partial
 
 
+def write_clones(save_clones, output_name, structures_ID, body_types, step, location, orientation, clones_writer = None):
+  '''
+  Save the locations (Nbodies, 3) and orientations (Nbodies, 4) of
+  the bodies at step with the format save_clones, 'one_file_per_step',
+  'one_file' or 'binary' (written by clones_writer).
+  '''
+  if save_clones == 'binary':
+    clones_writer.write(step, location, orientation)
+    return
+  body_offset = 0
+  for i, ID in enumerate(structures_ID):
+    if save_clones == 'one_file_per_step':
+      name = output_name + '.' + ID + '.' + str(step).zfill(8) + '.clones'
+      status = 'w'
+    else:
+      name = output_name + '.' + ID + '.config'
+      status = 'w' if step == 0 else 'a'
+    with open(name, status) as f_ID:
+      f_ID.write(str(body_types[i]) + '\n')
+      for j in range(body_offset, body_offset + body_types[i]):
+        f_ID.write('%s %s %s %s %s %s %s\n' % (location[j, 0], 
+                                               location[j, 1], 
+                                               location[j, 2], 
+                                               orientation[j, 0], 
+                                               orientation[j, 1], 
+                                               orientation[j, 2], 
+                                               orientation[j, 3]))
+    body_offset += body_types[i]
+
+
+# Integrator variables saved in the checkpoints, the integrators
+# only have some of them
+checkpoint_integrator_variables = ['first_step', 
+                                   'first_guess', 
+                                   'velocities', 
+                                   'velocities_previous_step', 
+                                   'deterministic_torque_previous_step', 
+                                   'invalid_configuration_count', 
+                                   'wall_overlaps', 
+                                   'det_iterations_count', 
+                                   'stoch_iterations_count', 
+                                   'eig_bounds', 
+                                   'eig_bounds_step', 
+                                   'chebyshev_coefficients', 
+                                   'krylov_recycle_space', 
+                                   'initial_guess', 
+                                   'verlet_list_blobs', 
+                                   'verlet_list_bodies', 
+                                   'preconditioner_refresh']
+
+
+def checkpoint_data(step, structures_ID, body_types, bodies, integrator, preconditioner = 'False'):
+  '''
+  Return a binary string with the state of the simulation before
+  the time step step: configuration of the bodies, random generator
+  state and integrator history and counters. If preconditioner is 'True'
+  the factorizations of the block diagonal preconditioners are saved too.
+  '''
+  state = {'step': step,
+           'structures_ID': list(structures_ID),
+           'body_types': list(body_types),
+           'location': np.array([b.location for b in bodies]),
+           'orientation': np.array([b.orientation.entries for b in bodies]),
+           'random_state': np.random.get_state(),
+           'integrator': {}}
+  for name in checkpoint_integrator_variables:
+    if hasattr(integrator, name):
+      value = getattr(integrator, name)
+      # For objects (e.g. Verlet lists) save their variables
+      if hasattr(value, '__dict__'):
+        value = copy.copy(value.__dict__)
+      state['integrator'][name] = value
+  if preconditioner != 'True' and state['integrator'].get('preconditioner_refresh') is not None:
+    # Save the counters but not the blocks
+    state['integrator']['preconditioner_refresh']['caches'] = {}
+  return cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+
+
+def write_checkpoint(name, data):
+  '''
+  Write the checkpoint data to the file name. The data is written
+  to a temporary file and then renamed, so the file name always
+  holds a complete checkpoint.
+  '''
+  with open(name + '.tmp', 'wb') as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(name + '.tmp', name)
+
+
+def restore_checkpoint(name, structures_ID, body_types, bodies, integrator):
+  '''
+  Restore the state saved in the checkpoint file name and 
+  return the step to continue the simulation.
+  '''
+  with open(name, 'rb') as f:
+    state = cPickle.load(f)
+  if state['structures_ID'] != list(structures_ID) or state['body_types'] != list(body_types):
+    raise IOError('Checkpoint ' + name + ' was written with different structures')
+  for k, b in enumerate(bodies):
+    b.location[:] = state['location'][k]
+    b.orientation.entries[:] = state['orientation'][k]
+  np.random.set_state(state['random_state'])
+  for key, value in state['integrator'].iteritems():
+    old = getattr(integrator, key, None)
+    if hasattr(old, '__dict__') and isinstance(value, dict):
+      # Keep the object, other functions (e.g. partials) reference it
+      old.__dict__.update(value)
+    else:
+      setattr(integrator, key, value)
+  return state['step']
+
+
 if __name__ == '__main__':
   # Get command line arguments
   parser = argparse.ArgumentParser(description='Run a multi-body simulation and save trajectory.')
   parser.add_argument('--input-file', dest='input_file', type=str, default='data.main', help='name of the input file')
   parser.add_argument('--print-residual', action='store_true', help='print gmres and lanczos residuals')
+  parser.add_argument('--restart', dest='restart', type=str, default=None, help='name of the checkpoint file to restart the simulation')
   args=parser.parse_args()
   input_file = args.input_file
 
@@ -519,9 +1201,11 @@ if __name__ == '__main__':
   output_name = read.output_name 
   structures = read.structures
   structures_ID = read.structures_ID
-  mobility_vector_prod = set_mobility_vector_prod(read.mobility_vector_prod_implementation)
-  multi_bodies_functions.calc_blob_blob_forces = multi_bodies_functions.set_blob_blob_forces(read.blob_blob_force_implementation)
-  multi_bodies_functions.calc_body_body_forces_torques = multi_bodies_functions.set_body_body_forces_torques(read.body_body_force_torque_implementation)
+  mobility_vector_prod = set_mobility_vector_prod(read.mobility_vector_prod_implementation,
+                                                  num_threads=read.num_threads,
+                                                  tree_theta=read.tree_theta)
+  multi_bodies_functions.calc_blob_blob_forces = multi_bodies_functions.set_blob_blob_forces(read.blob_blob_force_implementation, debye_cutoff=read.debye_cutoff)
+  multi_bodies_functions.calc_body_body_forces_torques = multi_bodies_functions.set_body_body_forces_torques(read.body_body_force_torque_implementation, debye_cutoff=read.debye_cutoff)
 
   # Copy input file to output
   subprocess.call(["cp", input_file, output_name + '.inputfile'])
@@ -580,6 +1264,14 @@ if __name__ == '__main__':
     f.write('num_bodies         ' + str(num_bodies) + '\n')
     f.write('num_blobs          ' + str(Nblobs) + '\n')
 
+  # Create Verlet lists, they are used by the numpy_cells implementations
+  if read.verlet_skin > 0:
+    verlet_list_blobs = multi_bodies_functions.VerletList(read.verlet_skin)
+    verlet_list_bodies = multi_bodies_functions.VerletList(read.verlet_skin)
+  else:
+    verlet_list_blobs = None
+    verlet_list_bodies = None
+
   # Create integrator
   if scheme.find('rollers') == -1:
     integrator = QuaternionIntegrator(bodies, Nblobs, scheme, tolerance = read.solver_tolerance, domain = read.domain) 
@@ -595,7 +1287,8 @@ if __name__ == '__main__':
                                                debye_length_wall = read.debye_length_wall,
                                                repulsion_strength = read.repulsion_strength,
                                                debye_length = read.debye_length, 
-                                               periodic_length = read.periodic_length)
+                                               periodic_length = read.periodic_length,
+                                               verlet_list_blobs = verlet_list_blobs)
     integrator.omega_one_roller = read.omega_one_roller
     integrator.free_kinematics = read.free_kinematics
     integrator.hydro_interactions = read.hydro_interactions
@@ -611,13 +1304,49 @@ if __name__ == '__main__':
                                                debye_length_wall = read.debye_length_wall, 
                                                repulsion_strength = read.repulsion_strength, 
                                                debye_length = read.debye_length, 
-                                               periodic_length = read.periodic_length) 
+                                               periodic_length = read.periodic_length,
+                                               verlet_list_blobs = verlet_list_blobs,
+                                               verlet_list_bodies = verlet_list_bodies)
+  integrator.verlet_list_blobs = verlet_list_blobs
+  integrator.verlet_list_bodies = verlet_list_bodies
   integrator.calc_K_matrix_bodies = calc_K_matrix_bodies
   integrator.calc_K_matrix = calc_K_matrix
   integrator.linear_operator = linear_operator_rigid
   integrator.preconditioner = block_diagonal_preconditioner
-  integrator.build_block_diagonal_preconditioner = build_block_diagonal_preconditioner
-  integrator.build_block_diagonal_preconditioners_det_stoch = build_block_diagonal_preconditioners_det_stoch
+  integrator.preconditioner_refresh = PreconditionerRefresh(update_PC = read.update_PC,
+                                                            height_threshold = read.preconditioner_refresh_height,
+                                                            angle_threshold = read.preconditioner_refresh_angle,
+                                                            iterations_ratio = read.preconditioner_refresh_iterations)
+  if read.preconditioner_implementation == 'structure':
+    integrator.build_block_diagonal_preconditioner = partial(build_block_diagonal_preconditioner_structure,
+                                                             domain = read.domain,
+                                                             height_bucket = read.preconditioner_height_bucket,
+                                                             refresh = integrator.preconditioner_refresh)
+    integrator.build_block_diagonal_preconditioners_det_stoch = partial(build_block_diagonal_preconditioners_structure,
+                                                                        domain = read.domain,
+                                                                        height_bucket = read.preconditioner_height_bucket,
+                                                                        refresh = integrator.preconditioner_refresh)
+  elif read.preconditioner_implementation == 'cholesky':
+    integrator.build_block_diagonal_preconditioner = partial(build_block_diagonal_preconditioner_cholesky,
+                                                             single_precision = read.preconditioner_single_precision,
+                                                             refresh = integrator.preconditioner_refresh)
+    integrator.build_block_diagonal_preconditioners_det_stoch = partial(build_block_diagonal_preconditioners_cholesky,
+                                                                        single_precision = read.preconditioner_single_precision,
+                                                                        refresh = integrator.preconditioner_refresh)
+  elif read.preconditioner_implementation == 'cluster':
+    integrator.build_block_diagonal_preconditioner = partial(build_block_diagonal_preconditioner_cluster,
+                                                             gap = read.preconditioner_cluster_gap,
+                                                             max_bodies = read.preconditioner_cluster_size,
+                                                             refresh = integrator.preconditioner_refresh)
+    integrator.build_block_diagonal_preconditioners_det_stoch = partial(build_block_diagonal_preconditioners_cluster,
+                                                                        gap = read.preconditioner_cluster_gap,
+                                                                        max_bodies = read.preconditioner_cluster_size,
+                                                                        refresh = integrator.preconditioner_refresh)
+  else:
+    integrator.build_block_diagonal_preconditioner = partial(build_block_diagonal_preconditioner,
+                                                             refresh = integrator.preconditioner_refresh)
+    integrator.build_block_diagonal_preconditioners_det_stoch = partial(build_block_diagonal_preconditioners_det_stoch,
+                                                                        refresh = integrator.preconditioner_refresh)
   integrator.eta = eta
   integrator.a = a
   integrator.first_guess = np.zeros(Nblobs*3 + num_bodies*6)
@@ -630,9 +1359,27 @@ if __name__ == '__main__':
   integrator.postprocess = multi_bodies_functions.postprocess
   integrator.periodic_length = read.periodic_length
   integrator.update_PC = read.update_PC
+  integrator.stochastic_forcing_implementation = read.stochastic_forcing_implementation
+  integrator.krylov_recycle_dim = read.krylov_recycle_dim
+  if read.initial_guess_extrapolation != 'None':
+    integrator.initial_guess = InitialGuess(order = {'constant': 0, 'linear': 1, 'quadratic': 2}[read.initial_guess_extrapolation])
   integrator.print_residual = args.print_residual
   integrator.do_rotation = read.do_rotation
 
+  # Restore the simulation state from a checkpoint
+  initial_step = read.initial_step
+  if args.restart is not None:
+    initial_step = restore_checkpoint(args.restart, structures_ID, body_types, bodies, integrator)
+    print 'Restarting from checkpoint ', args.restart, ', step = ', initial_step
+
+    # Save the restored random generator state
+    with open(output_name + '.random_state', 'wb') as f:
+      cPickle.dump(np.random.get_state(), f)
+  if initial_step >= n_steps:
+    print 'Error, initial step = ', initial_step, ' is not smaller than n_steps = ', n_steps
+    print 'Increase n_steps to continue the simulation. \n'
+    sys.exit()
+
   # Initialize HydroGrid library:
   if found_HydroGrid:
     cc.calculate_concentration(output_name, 
@@ -648,53 +1395,33 @@ if __name__ == '__main__':
                                0, 
                                get_blobs_r_vectors(bodies, Nblobs))
 
+  # Open binary trajectory file
+  clones_writer = None
+  if read.save_clones == 'binary':
+    clones_writer = clones_binary_file.ClonesBinaryWriter(output_name + '.clones.bin', structures_ID, body_types, 
+                                                          mode = 'w' if initial_step == 0 else 'a',
+                                                          last_step = initial_step if args.restart is not None else None)
+
+  # Start output thread
+  output_writer = utils.AsyncWriter(max_tasks = read.output_queue_size)
+
   # Loop over time steps
   start_time = time.time()  
-  for step in range(read.initial_step, n_steps):
-    # Save data if...
-    if (step % n_save) == 0 and step >= 0:
+  for step in range(initial_step, n_steps):
+    # Save data if... (the data of the checkpoint step was saved before the checkpoint)
+    if (step % n_save) == 0 and step >= 0 and not (args.restart is not None and step == initial_step):
       elapsed_time = time.time() - start_time
       print 'Integrator = ', scheme, ', step = ', step, ', invalid configurations', integrator.invalid_configuration_count, ', wallclock time = ', time.time() - start_time
-      # For each type of structure save locations and orientations to one file
-      body_offset = 0
-      if read.save_clones == 'one_file_per_step':
-        for i, ID in enumerate(structures_ID):
-          name = output_name + '.' + ID + '.' + str(step).zfill(8) + '.clones'
-          with open(name, 'w') as f_ID:
-            f_ID.write(str(body_types[i]) + '\n')
-            for j in range(body_types[i]):
-              orientation = bodies[body_offset + j].orientation.entries
-              f_ID.write('%s %s %s %s %s %s %s\n' % (bodies[body_offset + j].location[0], 
-                                                     bodies[body_offset + j].location[1], 
-                                                     bodies[body_offset + j].location[2], 
-                                                     orientation[0], 
-                                                     orientation[1], 
-                                                     orientation[2], 
-                                                     orientation[3]))
-            body_offset += body_types[i]
-      elif read.save_clones == 'one_file':
-        for i, ID in enumerate(structures_ID):
-          name = output_name + '.' + ID + '.config'
-          if step == 0:
-            status = 'w'
-          else:
-            status = 'a'
-          with open(name, status) as f_ID:
-            f_ID.write(str(body_types[i]) + '\n')
-            for j in range(body_types[i]):
-              orientation = bodies[body_offset + j].orientation.entries
-              f_ID.write('%s %s %s %s %s %s %s\n' % (bodies[body_offset + j].location[0], 
-                                                     bodies[body_offset + j].location[1], 
-                                                     bodies[body_offset + j].location[2], 
-                                                     orientation[0], 
-                                                     orientation[1], 
-                                                     orientation[2], 
-                                                     orientation[3]))
-            body_offset += body_types[i]
-      else:
+      # For each type of structure save locations and orientations,
+      # the output thread writes a snapshot of the configuration
+      if read.save_clones not in ('one_file_per_step', 'one_file', 'binary'):
         print 'Error, save_clones =', read.save_clones, 'is not implemented.'
-        print 'Use \"one_file_per_step\" or \"one_file\". \n'
+        print 'Use \"one_file_per_step\", \"one_file\" or \"binary\". \n'
         break
+      output_writer.put(write_clones, read.save_clones, output_name, structures_ID, body_types, step,
+                        np.array([b.location for b in bodies]), 
+                        np.array([b.orientation.entries for b in bodies]),
+                        clones_writer = clones_writer)
 
       # Save mobilities
       if read.save_blobs_mobility == 'True' or read.save_body_mobility == 'True':
@@ -702,14 +1429,14 @@ if __name__ == '__main__':
         mobility_blobs = integrator.mobility_blobs(r_vectors_blobs, read.eta, read.blob_radius)
         if read.save_blobs_mobility == 'True':
           name = output_name + '.blobs_mobility.' + str(step).zfill(8) + '.dat'
-          np.savetxt(name, mobility_blobs, delimiter='  ')
+          output_writer.put(np.savetxt, name, mobility_blobs, delimiter='  ')
         if read.save_body_mobility == 'True':
           resistance_blobs = np.linalg.inv(mobility_blobs)
           K = integrator.calc_K_matrix(bodies, Nblobs)
           resistance_bodies = np.dot(K.T, np.dot(resistance_blobs, K))
           mobility_bodies = np.linalg.pinv(np.dot(K.T, np.dot(resistance_blobs, K)))
           name = output_name + '.body_mobility.' + str(step).zfill(8) + '.dat'
-          np.savetxt(name, mobility_bodies, delimiter='  ')
+          output_writer.put(np.savetxt, name, mobility_bodies, delimiter='  ')
         
     # Update HydroGrid
     if (step % read.sample_HydroGrid) == 0 and found_HydroGrid:
@@ -742,52 +1469,26 @@ if __name__ == '__main__':
                                    2, 
                                    get_blobs_r_vectors(bodies, Nblobs))
 
+    # Save checkpoint
+    if read.n_checkpoint > 0 and (step % read.n_checkpoint) == 0 and step != initial_step:
+      output_writer.put(write_checkpoint, output_name + '.checkpoint', 
+                        checkpoint_data(step, structures_ID, body_types, bodies, integrator, preconditioner = read.checkpoint_preconditioner))
+
     # Advance time step
     integrator.advance_time_step(dt, step = step)
 
   # Save final data if...
   if ((step+1) % n_save) == 0 and step >= 0:
     print 'Integrator = ', scheme, ', step = ', step+1, ', invalid configurations', integrator.invalid_configuration_count, ', wallclock time = ', time.time() - start_time
-    # For each type of structure save locations and orientations to one file
-    body_offset = 0
-    if read.save_clones == 'one_file_per_step':
-      for i, ID in enumerate(structures_ID):
-        name = output_name + '.' + ID + '.' + str(step+1).zfill(8) + '.clones'
-        with open(name, 'w') as f_ID:
-          f_ID.write(str(body_types[i]) + '\n')
-          for j in range(body_types[i]):
-            orientation = bodies[body_offset + j].orientation.entries
-            f_ID.write('%s %s %s %s %s %s %s\n' % (bodies[body_offset + j].location[0], 
-                                                   bodies[body_offset + j].location[1], 
-                                                   bodies[body_offset + j].location[2], 
-                                                   orientation[0], 
-                                                   orientation[1], 
-                                                   orientation[2], 
-                                                   orientation[3]))
-          body_offset += body_types[i]
-      
-    elif read.save_clones == 'one_file':
-      for i, ID in enumerate(structures_ID):
-        name = output_name + '.' + ID + '.config'
-        if step+1 == 0:
-          status = 'w'
-        else:
-          status = 'a'
-        with open(name, status) as f_ID:
-          f_ID.write(str(body_types[i]) + '\n')
-          for j in range(body_types[i]):
-            orientation = bodies[body_offset + j].orientation.entries
-            f_ID.write('%s %s %s %s %s %s %s\n' % (bodies[body_offset + j].location[0], 
-                                                   bodies[body_offset + j].location[1], 
-                                                   bodies[body_offset + j].location[2], 
-                                                   orientation[0], 
-                                                   orientation[1], 
-                                                   orientation[2], 
-                                                   orientation[3]))
-          body_offset += body_types[i]
+    # For each type of structure save locations and orientations
+    if read.save_clones in ('one_file_per_step', 'one_file', 'binary'):
+      output_writer.put(write_clones, read.save_clones, output_name, structures_ID, body_types, step+1,
+                        np.array([b.location for b in bodies]), 
+                        np.array([b.orientation.entries for b in bodies]),
+                        clones_writer = clones_writer)
     else:
       print 'Error, save_clones =', read.save_clones, 'is not implemented.'
-      print 'Use \"one_file_per_step\" or \"one_file\". \n'
+      print 'Use \"one_file_per_step\", \"one_file\" or \"binary\". \n'
 
     # Save mobilities
     if read.save_blobs_mobility == 'True' or read.save_body_mobility == 'True':
@@ -795,14 +1496,19 @@ if __name__ == '__main__':
       mobility_blobs = integrator.mobility_blobs(r_vectors_blobs, read.eta, read.blob_radius)
       if read.save_blobs_mobility == 'True':
         name = output_name + '.blobs_mobility.' + str(step+1).zfill(8) + '.dat'
-        np.savetxt(name, mobility_blobs, delimiter='  ')
+        output_writer.put(np.savetxt, name, mobility_blobs, delimiter='  ')
       if read.save_body_mobility == 'True':
         resistance_blobs = np.linalg.inv(mobility_blobs)
         K = integrator.calc_K_matrix(bodies, Nblobs)
         resistance_bodies = np.dot(K.T, np.dot(resistance_blobs, K))
         mobility_bodies = np.linalg.pinv(np.dot(K.T, np.dot(resistance_blobs, K)))
         name = output_name + '.body_mobility.' + str(step+1).zfill(8) + '.dat'
-        np.savetxt(name, mobility_bodies, delimiter='  ')
+        output_writer.put(np.savetxt, name, mobility_bodies, delimiter='  ')
+
+  # Save final checkpoint
+  if read.n_checkpoint > 0 and ((step+1) % read.n_checkpoint) == 0:
+    output_writer.put(write_checkpoint, output_name + '.checkpoint', 
+                      checkpoint_data(step+1, structures_ID, body_types, bodies, integrator, preconditioner = read.checkpoint_preconditioner))
         
   # Update HydroGrid data
   if ((step+1) % read.sample_HydroGrid) == 0 and found_HydroGrid:    
@@ -852,6 +1558,11 @@ if __name__ == '__main__':
                                get_blobs_r_vectors(bodies, Nblobs))
 
 
+  # Wait for the output thread and close binary trajectory file
+  output_writer.close()
+  if read.save_clones == 'binary':
+    clones_writer.close()
+
   # Save wallclock time 
   with open(output_name + '.time', 'w') as f:
     f.write(str(time.time() - start_time) + '\n')
@@ -861,5 +1572,13 @@ if __name__ == '__main__':
     f.write('invalid_configuration_count    = ' + str(integrator.invalid_configuration_count) + '\n'
             + 'deterministic_iterations_count = ' + str(integrator.det_iterations_count) + '\n'
             + 'stochastic_iterations_count    = ' + str(integrator.stoch_iterations_count) + '\n')
+    if verlet_list_blobs is not None:
+      f.write('verlet_list_blobs_rebuild_count  = ' + str(verlet_list_blobs.rebuild_count) + '\n'
+              + 'verlet_list_bodies_rebuild_count = ' + str(verlet_list_bodies.rebuild_count) + '\n')
+    if integrator.preconditioner_refresh is not None:
+      f.write('preconditioner_full_factorizations_count = ' + str(integrator.preconditioner_refresh.full_factorizations_count) + '\n'
+              + 'preconditioner_body_factorizations_count = ' + str(integrator.preconditioner_refresh.body_factorizations_count) + '\n')
+    if integrator.initial_guess is not None:
+      f.write(integrator.initial_guess.info())
 
   print '\n\n\n# End'
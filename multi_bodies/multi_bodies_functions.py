@@ -8,6 +8,7 @@ import numpy as np
 import sys
 import imp
 import os.path
+import itertools
 from functools import partial
 
 import utils
@@ -58,6 +59,115 @@ def project_to_periodic_image(r, L):
         r[i] = r[i] - int(r[i] / L[i] + 0.5 * (int(r[i]>0) - int(r[i]<0))) * L[i]
   return r
 
+def project_to_periodic_image_numpy(r, L):
+  '''
+  Vectorized version of project_to_periodic_image for
+  an array of vectors r with shape (N, 3).
+  '''
+  if L is not None:
+    for i in range(3):
+      if(L[i] > 0):
+        r[:, i] -= np.trunc(r[:, i] / L[i] + 0.5 * np.sign(r[:, i])) * L[i]
+  return r
+
+
+def neighbor_pairs_cell_list(r_vectors, cutoff, L, *args, **kwargs):
+  '''
+  Find all the pairs of points (i, j), with i < j, closer than
+  cutoff using a cell list. Returns (i, j, r) where r[k] is the vector
+  r_vectors[j[k]] - r_vectors[i[k]] in the minimal image convention.
+
+  The space is divided in cells of size >= cutoff, so only pairs
+  in the same or in neighbor cells are checked. If a component of L 
+  is larger than zero the space is periodic in that direction.
+  '''
+  r_vectors = np.reshape(r_vectors, (-1, 3))
+  N = r_vectors.shape[0]
+  L = np.zeros(3) if L is None else np.array(L, dtype=float)
+  periodic = L > 0
+
+  # Assign points to cells
+  r_min = np.where(periodic, 0.0, np.min(r_vectors, axis=0))
+  length = np.where(periodic, L, np.max(r_vectors, axis=0) - r_min)
+  num_cells = np.maximum(np.floor(length / cutoff), 1).astype(int)
+  cell_size = np.where(periodic, L / num_cells, np.maximum(length / num_cells, cutoff))
+  r_cells = r_vectors - r_min
+  r_cells[:, periodic] -= np.floor(r_cells[:, periodic] / L[periodic]) * L[periodic]
+  cell_coor = np.minimum((r_cells / cell_size).astype(int), num_cells - 1)
+  cell = np.ravel_multi_index(cell_coor.T, num_cells)
+  order = np.argsort(cell, kind='mergesort')
+  cell_count = np.bincount(cell, minlength=np.prod(num_cells))
+  cell_start = np.cumsum(cell_count) - cell_count
+
+  # Loop over the neighbor cells, in periodic directions with
+  # less than three cells use every neighbor cell only once
+  offsets = []
+  for i in range(3):
+    if periodic[i]:
+      offsets.append(np.unique(np.arange(-1, 2) % num_cells[i]))
+    else:
+      offsets.append(np.arange(-1, 2))
+  pairs_i, pairs_j = [], []
+  for offset in itertools.product(*offsets):
+    neighbor = cell_coor + np.array(offset)
+    valid = np.all((neighbor >= 0) & (neighbor < num_cells) | periodic, axis=1)
+    neighbor = np.ravel_multi_index((neighbor[valid] % num_cells).T, num_cells)
+    i = np.flatnonzero(valid)
+    counts = cell_count[neighbor]
+    i = np.repeat(i, counts)
+    k = np.arange(i.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    j = order[np.repeat(cell_start[neighbor], counts) + k]
+    keep = i < j
+    pairs_i.append(i[keep])
+    pairs_j.append(j[keep])
+  i = np.concatenate(pairs_i)
+  j = np.concatenate(pairs_j)
+  r = project_to_periodic_image_numpy(r_vectors[j] - r_vectors[i], L)
+  close = np.sum(r * r, axis=1) < cutoff**2
+  return i[close], j[close], r[close]
+
+
+class VerletList(object):
+  '''
+  Verlet neighbor list with a skin. The list stores the pairs closer
+  than cutoff + skin and it is only rebuilt (with a cell list) when 
+  a point has moved more than skin / 2 since the last build, 
+  otherwise the stored pairs are filtered with the current positions.
+  '''
+  def __init__(self, skin):
+    '''
+    Init object
+    '''
+    self.skin = skin
+    self.cutoff = None
+    self.r_vectors_build = None
+    self.pairs_i = None
+    self.pairs_j = None
+    self.rebuild_count = 0
+    return
+
+  def pairs(self, r_vectors, cutoff, L):
+    '''
+    Return the pairs (i, j, r) closer than cutoff as 
+    neighbor_pairs_cell_list.
+    '''
+    r_vectors = np.reshape(r_vectors, (-1, 3))
+    rebuild = (self.r_vectors_build is None or self.cutoff != cutoff or
+               self.r_vectors_build.shape != r_vectors.shape)
+    if not rebuild:
+      displacement = project_to_periodic_image_numpy(r_vectors - self.r_vectors_build, L)
+      rebuild = np.max(np.sum(displacement * displacement, axis=1)) > (0.5 * self.skin)**2
+    if rebuild:
+      self.pairs_i, self.pairs_j, r = neighbor_pairs_cell_list(r_vectors, cutoff + self.skin, L)
+      self.r_vectors_build = np.copy(r_vectors)
+      self.cutoff = cutoff
+      self.rebuild_count += 1
+    else:
+      r = project_to_periodic_image_numpy(r_vectors[self.pairs_j] - r_vectors[self.pairs_i], L)
+    close = np.sum(r * r, axis=1) < cutoff**2
+    return self.pairs_i[close], self.pairs_j[close], r[close]
+
+
 def default_zero_r_vectors(r_vectors, *args, **kwargs):
   return np.zeros((r_vectors.size / 3, 3))
 
@@ -179,7 +289,7 @@ def calc_one_blob_forces(r_vectors, *args, **kwargs):
   return force_blobs
 
 
-def set_blob_blob_forces(implementation):
+def set_blob_blob_forces(implementation, *args, **kwargs):
   '''
   Set the function to compute the blob-blob forces
   to the right function.
@@ -189,7 +299,11 @@ def set_blob_blob_forces(implementation):
   installed pycuda and a GPU with CUDA capabilities. To
   use the C++ implementation the user has to compile 
   the file blob_blob_forces_ext.cc.   
+  The numpy_cells implementation only computes the interactions
+  between blobs closer than 2*blob_radius + debye_cutoff * debye_length
+  using a cell list.
   '''
+  debye_cutoff = kwargs.get('debye_cutoff', 10.0)
   if implementation == 'None':
     return default_zero_r_vectors
   elif implementation == 'python':
@@ -198,6 +312,8 @@ def set_blob_blob_forces(implementation):
     return calc_blob_blob_forces_boost 
   elif implementation == 'pycuda':
     return forces_pycuda.calc_blob_blob_forces_pycuda
+  elif implementation == 'numpy_cells':
+    return partial(calc_blob_blob_forces_numpy_cells, debye_cutoff = debye_cutoff)
 
 
 def blob_blob_force(r, *args, **kwargs):
@@ -251,6 +367,46 @@ def calc_blob_blob_forces_python(r_vectors, *args, **kwargs):
   return force_blobs
 
 
+def blob_blob_force_numpy(r, *args, **kwargs):
+  '''
+  Vectorized version of blob_blob_force. It computes the
+  forces for an array of vectors r with shape (N, 3),
+  already projected to the minimal image.
+  '''
+  # Get parameters from arguments
+  eps = kwargs.get('repulsion_strength')
+  b = kwargs.get('debye_length')
+  a = kwargs.get('blob_radius')
+
+  # Compute force
+  r_norm = np.sqrt(np.sum(r * r, axis=1))
+  magnitude = (eps / b) * np.exp(-np.maximum(r_norm - 2*a, 0.0) / b)
+  return -(magnitude / np.maximum(r_norm, np.finfo(float).eps))[:, None] * r
+
+
+def calc_blob_blob_forces_numpy_cells(r_vectors, *args, **kwargs):
+  '''
+  This function computes the blob-blob forces using a cell list,
+  only the pairs closer than 2*blob_radius + debye_cutoff * debye_length
+  interact. If a VerletList is given in the argument verlet_list_blobs
+  the pairs are taken from it. It returns an array with shape (Nblobs, 3).
+  '''
+  Nblobs = r_vectors.size / 3
+  r_vectors = np.reshape(r_vectors, (Nblobs, 3))
+  cutoff = 2 * kwargs.get('blob_radius') + kwargs.get('debye_cutoff') * kwargs.get('debye_length')
+  verlet_list = kwargs.get('verlet_list_blobs')
+
+  if verlet_list is not None:
+    i, j, r = verlet_list.pairs(r_vectors, cutoff, kwargs.get('periodic_length'))
+  else:
+    i, j, r = neighbor_pairs_cell_list(r_vectors, cutoff, kwargs.get('periodic_length'))
+  force = blob_blob_force_numpy(r, *args, **kwargs)
+  force_blobs = np.zeros((Nblobs, 3))
+  for k in range(3):
+    force_blobs[:, k] = np.bincount(i, weights=force[:, k], minlength=Nblobs) - np.bincount(j, weights=force[:, k], minlength=Nblobs)
+  return force_blobs
+
+
 def calc_blob_blob_forces_boost(r_vectors, *args, **kwargs):
   '''
   Call a boost function to compute the blob-blob forces.
@@ -271,15 +427,21 @@ def calc_blob_blob_forces_boost(r_vectors, *args, **kwargs):
   return np.reshape(forces, (number_of_blobs, 3))
 
 
-def set_body_body_forces_torques(implementation):
+def set_body_body_forces_torques(implementation, *args, **kwargs):
   '''
   Set the function to compute the body-body forces
   to the right function. 
+  The numpy_cells implementation only computes the interactions
+  between bodies closer than debye_cutoff * debye_length
+  using a cell list.
   '''
+  debye_cutoff = kwargs.get('debye_cutoff', 10.0)
   if implementation == 'None':
     return default_zero_bodies
   elif implementation == 'python':
     return calc_body_body_forces_torques_python
+  elif implementation == 'numpy_cells':
+    return partial(calc_body_body_forces_torques_numpy_cells, debye_cutoff = debye_cutoff)
 
 
 def body_body_force_torque(r, quaternion_i, quaternion_j, *args, **kwargs):
@@ -334,6 +496,50 @@ def calc_body_body_forces_torques_python(bodies, r_vectors, *args, **kwargs):
   return force_torque_bodies
 
 
+def body_body_force_torque_numpy(r, *args, **kwargs):
+  '''
+  Vectorized version of body_body_force_torque. It computes the
+  force-torques for an array of vectors r with shape (N, 3),
+  already projected to the minimal image. It returns an 
+  array with shape (N, 2, 3).
+  '''
+  force_torque = np.zeros((r.shape[0], 2, 3))
+
+  # Get parameters from arguments
+  eps = kwargs.get('repulsion_strength')
+  b = kwargs.get('debye_length')
+
+  # Compute force
+  r_norm = np.sqrt(np.sum(r * r, axis=1))
+  force_torque[:, 0] = -(((eps / b) + (eps / r_norm)) * np.exp(-r_norm / b) / r_norm**2)[:, None] * r
+  return force_torque
+
+
+def calc_body_body_forces_torques_numpy_cells(bodies, r_vectors, *args, **kwargs):
+  '''
+  This function computes the body-body forces and torques using a cell list,
+  only the pairs closer than debye_cutoff * debye_length interact. 
+  If a VerletList is given in the argument verlet_list_bodies
+  the pairs are taken from it. It returns an array with shape (2*Nbodies, 3).
+  '''
+  Nbodies = len(bodies)
+  location = np.array([b.location for b in bodies])
+  cutoff = kwargs.get('debye_cutoff') * kwargs.get('debye_length')
+  verlet_list = kwargs.get('verlet_list_bodies')
+
+  if verlet_list is not None:
+    i, j, r = verlet_list.pairs(location, cutoff, kwargs.get('periodic_length'))
+  else:
+    i, j, r = neighbor_pairs_cell_list(location, cutoff, kwargs.get('periodic_length'))
+  force_torque = body_body_force_torque_numpy(r, *args, **kwargs)
+  force_torque_bodies = np.zeros((Nbodies, 2, 3))
+  for m in range(2):
+    for k in range(3):
+      force_torque_bodies[:, m, k] = (np.bincount(i, weights=force_torque[:, m, k], minlength=Nbodies) - 
+                                      np.bincount(j, weights=force_torque[:, m, k], minlength=Nbodies))
+  return np.reshape(force_torque_bodies, (2*Nbodies, 3))
+
+
 def force_torque_calculator_sort_by_bodies(bodies, r_vectors, *args, **kwargs):
   '''
   Return the forces and torque in each body with
@@ -0,0 +1,250 @@
+''' Unit tests for multi_bodies and multi_bodies_functions. '''
+import unittest
+import numpy as np
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+sys.path.append('..')
+
+import multi_bodies_functions
+import multi_bodies
+from body import body
+from quaternion_integrator.quaternion import Quaternion
+
+# The tests use the default force laws, undo the overrides
+# of user_defined_functions.py if it is in the working directory
+if multi_bodies_functions.user_defined_functions_found:
+  cwd = os.getcwd()
+  sys.path.append(cwd)
+  os.chdir('..')
+  reload(multi_bodies_functions)
+  os.chdir(cwd)
+
+
+class Body(object):
+  ''' Minimal body with a location and an orientation. '''
+  def __init__(self, location):
+    self.location = location
+    self.orientation = Quaternion([1., 0., 0., 0.])
+
+
+class TestForces(unittest.TestCase):
+
+  def setUp(self):
+    pass
+
+  def test_blob_blob_forces_numpy_cells(self):
+    ''' Compare the numpy_cells blob-blob forces with the python implementation,
+    with and without periodic_length and with a VerletList.'''
+    r_vectors = np.random.rand(200, 3) * np.array([20., 20., 5.])
+    kwargs = {'repulsion_strength': 1.3, 'debye_length': 0.1, 'blob_radius': 0.5, 'debye_cutoff': 40.0}
+    for L in [None, np.array([20., 20., 0.])]:
+      force_python = multi_bodies_functions.calc_blob_blob_forces_python(r_vectors, periodic_length = L, **kwargs)
+      force_cells = multi_bodies_functions.calc_blob_blob_forces_numpy_cells(r_vectors, periodic_length = L, **kwargs)
+      self.assertTrue(np.allclose(force_cells, force_python, rtol=1e-12, atol=1e-12))
+      verlet_list = multi_bodies_functions.VerletList(0.5)
+      for k in range(3):
+        r_vectors_k = r_vectors + np.random.normal(0., 0.02, r_vectors.shape)
+        force_python = multi_bodies_functions.calc_blob_blob_forces_python(r_vectors_k, periodic_length = L, **kwargs)
+        force_verlet = multi_bodies_functions.calc_blob_blob_forces_numpy_cells(r_vectors_k, periodic_length = L,
+                                                                                verlet_list_blobs = verlet_list, **kwargs)
+        self.assertTrue(np.allclose(force_verlet, force_python, rtol=1e-12, atol=1e-12))
+      self.assertEqual(verlet_list.rebuild_count, 1)
+
+
+  def test_body_body_forces_torques_numpy_cells(self):
+    ''' Compare the numpy_cells body-body forces with the python implementation,
+    with and without periodic_length and with a VerletList.'''
+    bodies = [Body(x) for x in np.random.rand(100, 3) * np.array([20., 20., 5.])]
+    kwargs = {'repulsion_strength': 1.3, 'debye_length': 0.1, 'debye_cutoff': 40.0}
+    for L in [None, np.array([20., 20., 0.])]:
+      force_python = multi_bodies_functions.calc_body_body_forces_torques_python(bodies, None, periodic_length = L, **kwargs)
+      force_cells = multi_bodies_functions.calc_body_body_forces_torques_numpy_cells(bodies, None, periodic_length = L, **kwargs)
+      self.assertTrue(np.allclose(force_cells, force_python, rtol=1e-12, atol=1e-12))
+      force_verlet = multi_bodies_functions.calc_body_body_forces_torques_numpy_cells(bodies, None, periodic_length = L,
+                                                                                      verlet_list_bodies = multi_bodies_functions.VerletList(0.5),
+                                                                                      **kwargs)
+      self.assertTrue(np.allclose(force_verlet, force_python, rtol=1e-12, atol=1e-12))
+
+
+class TestPreconditioners(unittest.TestCase):
+
+  def setUp(self):
+    pass
+
+  def random_bodies(self, num_bodies, mobility_blobs_implementation):
+    ''' Bodies made of 8 blobs in a cube, with random locations and orientations. '''
+    a = 0.2
+    reference_configuration = 0.4 * np.array([[i, j, k] for i in range(2) for j in range(2) for k in range(2)], dtype=float)
+    bodies = []
+    for k in range(num_bodies):
+      location = np.array([4.0 * k, np.random.normal(0., 0.5), np.random.uniform(2.0, 3.0)])
+      theta = np.random.normal(0., 1., 4)
+      b = body.Body(location, Quaternion(theta / np.linalg.norm(theta)), reference_configuration, a)
+      b.mobility_blobs = multi_bodies.set_mobility_blobs(mobility_blobs_implementation)
+      b.ID = 'cube'
+      bodies.append(b)
+    Nblobs = sum([b.Nblobs for b in bodies])
+    r_vectors = multi_bodies.get_blobs_r_vectors(bodies, Nblobs)
+    return bodies, r_vectors, Nblobs, a
+
+  def preconditioner_matrices(self, preconditioners, Nblobs, num_bodies):
+    ''' Apply the preconditioner functions to the columns of the identity. '''
+    block_diagonal_preconditioner, mobility_pc, P_inv_mult = preconditioners
+    PC = np.array([block_diagonal_preconditioner(x) for x in np.eye(3 * Nblobs + 6 * num_bodies)]).T
+    M_pc = np.array([mobility_pc(x) for x in np.eye(3 * Nblobs)]).T
+    P_inv = np.array([P_inv_mult(x) for x in np.eye(3 * Nblobs)]).T
+    return PC, M_pc, P_inv
+
+  def test_cholesky_and_cluster_preconditioners(self):
+    ''' Compare the cholesky and cluster (with max_bodies = 1) preconditioners
+    with the det_stoch preconditioners.'''
+    num_bodies = 4
+    eta = 1.0
+    bodies, r_vectors, Nblobs, a = self.random_bodies(num_bodies, 'numpy')
+    multi_bodies.mobility_vector_prod = multi_bodies.set_mobility_vector_prod('numpy')
+    PC, M_pc, P_inv = self.preconditioner_matrices(
+      multi_bodies.build_block_diagonal_preconditioners_det_stoch(bodies, r_vectors, Nblobs, eta, a, step = 0, update_PC = 1),
+      Nblobs, num_bodies)
+    for preconditioners in [multi_bodies.build_block_diagonal_preconditioners_cholesky(bodies, r_vectors, Nblobs, eta, a, 
+                                                                                       step = 0, update_PC = 1),
+                            multi_bodies.build_block_diagonal_preconditioners_cluster(bodies, r_vectors, Nblobs, eta, a, max_bodies = 1,
+                                                                                      step = 0, update_PC = 1)]:
+      PC_new, M_pc_new, P_inv_new = self.preconditioner_matrices(preconditioners, Nblobs, num_bodies)
+      self.assertTrue(np.allclose(PC_new, PC, rtol=1e-10, atol=1e-10 * np.max(np.abs(PC))))
+      self.assertTrue(np.allclose(M_pc_new, M_pc, rtol=1e-10, atol=1e-10))
+      self.assertTrue(np.allclose(P_inv_new, P_inv, rtol=1e-10, atol=1e-10 * np.max(np.abs(P_inv))))
+
+  def test_structure_preconditioners(self):
+    ''' Compare the structure preconditioners without wall with the
+    det_stoch preconditioners. The Cholesky factors are computed in a 
+    different frame of reference, so instead of P_inv we compare 
+    the noise covariance P_inv * (P.T * M * P) * P_inv.T = M.'''
+    num_bodies = 4
+    eta = 1.0
+    bodies, r_vectors, Nblobs, a = self.random_bodies(num_bodies, 'numpy_no_wall')
+    multi_bodies.mobility_vector_prod = multi_bodies.set_mobility_vector_prod('numpy_no_wall')
+    PC, M_pc, P_inv = self.preconditioner_matrices(
+      multi_bodies.build_block_diagonal_preconditioners_det_stoch(bodies, r_vectors, Nblobs, eta, a, domain = 'no_wall', 
+                                                                  step = 0, update_PC = 1),
+      Nblobs, num_bodies)
+    refresh = multi_bodies.PreconditionerRefresh()
+    PC_new, M_pc_new, P_inv_new = self.preconditioner_matrices(
+      multi_bodies.build_block_diagonal_preconditioners_structure(bodies, r_vectors, Nblobs, eta, a, domain = 'no_wall', 
+                                                                  refresh = refresh, step = 0, update_PC = 1),
+      Nblobs, num_bodies)
+    self.assertEqual(len(refresh.caches['structure']['shared']), 1)
+    self.assertEqual(refresh.body_factorizations_count, 1)
+    self.assertTrue(np.allclose(PC_new, PC, rtol=1e-10, atol=1e-10 * np.max(np.abs(PC))))
+    M = np.dot(P_inv, np.dot(M_pc, P_inv.T))
+    M_new = np.dot(P_inv_new, np.dot(M_pc_new, P_inv_new.T))
+    self.assertTrue(np.allclose(M_new, M, rtol=1e-10, atol=1e-10 * np.max(np.abs(M))))
+    self.assertTrue(np.allclose(M, np.array([multi_bodies.mobility_vector_prod(r_vectors, x, eta, a) for x in np.eye(3 * Nblobs)]).T))
+
+  def test_structure_preconditioners_wall(self):
+    ''' Test the structure preconditioners with a wall. The bodies 1 and 0 
+    only differ by a rotation about the z axis and share the blocks, which
+    is exact; the bodies with other tilts do not share blocks.'''
+    num_bodies = 4
+    eta = 1.0
+    bodies, r_vectors, Nblobs, a = self.random_bodies(num_bodies, 'numpy')
+    theta = 0.9
+    bodies[1].orientation = Quaternion([np.cos(0.5 * theta), 0., 0., np.sin(0.5 * theta)]) * bodies[0].orientation
+    for b in bodies:
+      b.location[2] = 2.5
+    r_vectors = multi_bodies.get_blobs_r_vectors(bodies, Nblobs)
+    multi_bodies.mobility_vector_prod = multi_bodies.set_mobility_vector_prod('numpy')
+    PC, M_pc, P_inv = self.preconditioner_matrices(
+      multi_bodies.build_block_diagonal_preconditioners_det_stoch(bodies, r_vectors, Nblobs, eta, a, step = 0, update_PC = 1),
+      Nblobs, num_bodies)
+    refresh = multi_bodies.PreconditionerRefresh()
+    PC_new, M_pc_new, P_inv_new = self.preconditioner_matrices(
+      multi_bodies.build_block_diagonal_preconditioners_structure(bodies, r_vectors, Nblobs, eta, a, domain = 'single_wall', 
+                                                                  refresh = refresh, step = 0, update_PC = 1),
+      Nblobs, num_bodies)
+    self.assertEqual(len(refresh.caches['structure']['shared']), 3)
+    self.assertTrue(refresh.caches['structure']['blocks'][1] is refresh.caches['structure']['blocks'][0])
+    self.assertTrue(np.allclose(PC_new, PC, rtol=1e-10, atol=1e-10 * np.max(np.abs(PC))))
+    M = np.dot(P_inv, np.dot(M_pc, P_inv.T))
+    M_new = np.dot(P_inv_new, np.dot(M_pc_new, P_inv_new.T))
+    self.assertTrue(np.allclose(M_new, M, rtol=1e-10, atol=1e-10 * np.max(np.abs(M))))
+
+  def test_refresh_structure_cholesky_and_cluster(self):
+    ''' The structure, cholesky and cluster preconditioners keep their blocks 
+    in the PreconditionerRefresh and only factorize again the bodies that moved.'''
+    num_bodies = 4
+    eta = 1.0
+    bodies, r_vectors, Nblobs, a = self.random_bodies(num_bodies, 'numpy')
+    multi_bodies.mobility_vector_prod = multi_bodies.set_mobility_vector_prod('numpy')
+    for build in [multi_bodies.build_block_diagonal_preconditioners_structure, 
+                  multi_bodies.build_block_diagonal_preconditioners_cholesky,
+                  multi_bodies.build_block_diagonal_preconditioners_cluster]:
+      location = np.copy(bodies[0].location)
+      refresh = multi_bodies.PreconditionerRefresh(update_PC = 10, height_threshold = 0.1)
+      build(bodies, r_vectors, Nblobs, eta, a, refresh = refresh, step = 0)
+      count = refresh.body_factorizations_count
+      bodies[0].location[2] = 5.0
+      r_vectors_new = multi_bodies.get_blobs_r_vectors(bodies, Nblobs)
+      PC, M_pc, P_inv = self.preconditioner_matrices(build(bodies, r_vectors_new, Nblobs, eta, a, refresh = refresh, step = 1),
+                                                     Nblobs, num_bodies)
+      self.assertEqual(refresh.full_factorizations_count, 1)
+      self.assertEqual(refresh.body_factorizations_count, count + 1)
+      PC_new, M_pc_new, P_inv_new = self.preconditioner_matrices(build(bodies, r_vectors_new, Nblobs, eta, a, step = 1),
+                                                                 Nblobs, num_bodies)
+      self.assertTrue(np.allclose(PC_new, PC, rtol=1e-10, atol=1e-10 * np.max(np.abs(PC))))
+      self.assertTrue(np.allclose(M_pc_new, M_pc, rtol=1e-10, atol=1e-10))
+      bodies[0].location[:] = location
+
+
+class TestMain(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def run_main(self, options, num_bodies):
+    ''' Run multi_bodies.py with the options and num_bodies blobs above the wall. '''
+    path = os.path.dirname(os.path.abspath(multi_bodies.__file__))
+    name = os.path.join(self.directory, 'run')
+    with open(name + '.clones', 'w') as f:
+      f.write(str(num_bodies) + '\n')
+      for x in np.random.rand(num_bodies, 3) * np.array([20., 20., 0.]) + np.array([0., 0., 1.5]):
+        f.write('%s %s %s 1 0 0 0\n' % (x[0], x[1], x[2]))
+    with open(name + '.in', 'w') as f:
+      f.write(options)
+      f.write('output_name ' + name + '\n')
+      f.write('structure ' + os.path.join(path, 'Structures', 'blob.vertex') + ' ' + name + '.clones\n')
+    subprocess.check_call([sys.executable, 'multi_bodies.py', '--input-file', name + '.in'], cwd = path, 
+                          stdout = open(os.devnull, 'w'))
+    with open(name + '.info', 'r') as f:
+      return f.read()
+
+  def test_rollers(self):
+    ''' Run the rollers integrator to the end, the .info file is written.'''
+    options = ('scheme deterministic_forward_euler_rollers \n'
+               'mobility_blobs_implementation numpy \n'
+               'blob_blob_force_implementation python \n'
+               'dt 0.016 \n'
+               'n_steps 3 \n'
+               'n_save 1 \n'
+               'eta 1.0e-3 \n'
+               'g 0.0024892 \n'
+               'blob_radius 0.656 \n'
+               'repulsion_strength 0.0165677856 \n'
+               'debye_length 0.0656 \n'
+               'repulsion_strength_wall 0.0165677856 \n'
+               'debye_length_wall 0.0656 \n'
+               'omega_one_roller 0.0 62.8 0.0 \n'
+               'free_kinematics False \n'
+               'hydro_interactions 0 \n'
+               'save_clones one_file \n')
+    info = self.run_main(options, 20)
+    self.assertTrue('invalid_configuration_count    = 0' in info)
+
+
+if __name__ == '__main__':
+  unittest.main()
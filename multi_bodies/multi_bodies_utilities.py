@@ -10,6 +10,7 @@ import scipy.linalg as sla
 import scipy.sparse.linalg as spla
 import subprocess
 import cPickle
+import multiprocessing
 from functools import partial
 import sys
 import time
@@ -156,6 +157,25 @@ class gmres_counter(object):
         print 'gmres =  0 1'
       print 'gmres = ', self.niter, rk
 
+
+@utils.static_var('problem', {})
+def solve_body_mobility_columns(columns):
+  '''
+  Solve with block GMRES the mobility problems with a unit force
+  or torque in the body components columns and return the 
+  columns of the body mobility, an array (6*num_bodies, len(columns)).
+  The linear operator, preconditioner and parameters are read from
+  solve_body_mobility_columns.problem, so the function can be
+  called by the processes of a multiprocessing pool.
+  '''
+  p = solve_body_mobility_columns.problem
+  Ncomp_blobs = 3 * p['Nblobs']
+  RHS = np.zeros((p['System_size'], len(columns)))
+  RHS[Ncomp_blobs + np.array(columns), np.arange(len(columns))] = -1.0
+  counter = gmres_counter(print_residual = p['print_residual'])
+  (sol_precond, info_precond) = utils.block_gmres(p['A'], RHS, tol=p['tol'], M=p['PC'], maxiter=1000, restart=60, callback=counter)
+  return sol_precond[Ncomp_blobs:]
+
 if __name__ ==  '__main__':
   # Get command line arguments
   parser = argparse.ArgumentParser(description='Solve the mobility or resistance problem'
@@ -200,9 +220,14 @@ if __name__ ==  '__main__':
   num_of_body_types = len(body_types)
   num_bodies = bodies.size
   Nblobs = sum([x.Nblobs for x in bodies])
-  multi_bodies.mobility_vector_prod = multi_bodies.set_mobility_vector_prod(read.mobility_vector_prod_implementation)
-  multi_bodies_functions.calc_blob_blob_forces = multi_bodies_functions.set_blob_blob_forces(read.blob_blob_force_implementation)
-  multi_bodies_functions.calc_body_body_forces_torques = multi_bodies_functions.set_body_body_forces_torques(read.body_body_force_torque_implementation)
+  multi_bodies.mobility_vector_prod = multi_bodies.set_mobility_vector_prod(read.mobility_vector_prod_implementation,
+                                                                     num_threads=read.num_threads,
+                                                                     tree_theta=read.tree_theta)
+  multi_bodies.mobility_matmat = multi_bodies.set_mobility_matmat(read.mobility_vector_prod_implementation,
+                                                                  num_threads=read.num_threads,
+                                                                  tree_theta=read.tree_theta)
+  multi_bodies_functions.calc_blob_blob_forces = multi_bodies_functions.set_blob_blob_forces(read.blob_blob_force_implementation, debye_cutoff=read.debye_cutoff)
+  multi_bodies_functions.calc_body_body_forces_torques = multi_bodies_functions.set_body_body_forces_torques(read.body_body_force_torque_implementation, debye_cutoff=read.debye_cutoff)
   multi_bodies.mobility_blobs = multi_bodies.set_mobility_blobs(read.mobility_blobs_implementation)
 
   # Write bodies information
@@ -340,50 +365,37 @@ if __name__ ==  '__main__':
     # Set System size right hand side
     System_size = Nblobs * 3 + num_bodies * 6
 
-    # Set linear operators
-    linear_operator_partial = partial(multi_bodies.linear_operator_rigid, bodies=bodies, r_vectors=r_vectors_blobs, eta=read.eta, a=read.blob_radius)
-    A = spla.LinearOperator((System_size, System_size), matvec = linear_operator_partial, dtype='float64')
-
-    '''
-    # Set preconditioner
-    mobility_inv_blobs = []
-    mobility_bodies = np.empty((len(bodies), 6, 6))
-    # Loop over bodies
-    for k, b in enumerate(bodies):
-      # 1. Compute blobs mobility and invert it
-      if k>=0:  # calculate M inverse only for the first sphere and reuse it
-          M = b.calc_mobility_blobs(read.eta, read.blob_radius)
-          M_inv = np.linalg.inv(M)
-      mobility_inv_blobs.append(M_inv)
-      # 2. Compute body mobility
-      N = b.calc_mobility_body(read.eta, read.blob_radius, M_inv = M_inv)
-      mobility_bodies[k] = N
-
-    # 4. Pack preconditioner
-    PC_partial = partial(multi_bodies.block_diagonal_preconditioner, bodies=bodies, mobility_bodies=mobility_bodies, \
-                           mobility_inv_blobs=mobility_inv_blobs, Nblobs=Nblobs)
-    PC = spla.LinearOperator((System_size, System_size), matvec = PC_partial, dtype='float64')
-    '''
-    PC = None
-
-    Mobility = []
-    for b_i in range(num_bodies):
-        for c_i in range(6):
-            # Set right hand side
-            force_torque = np.zeros(6 * num_bodies)
-            force_torque[b_i*6+c_i] = 1
-            force_torque = np.reshape(force_torque, (2*num_bodies, 3))
-            RHS = np.reshape(np.concatenate([np.zeros((Nblobs, 3)), -force_torque]), (System_size))
-            # Solve preconditioned linear system # callback=make_callback()
-            counter = gmres_counter(print_residual = args.print_residual)
-            (sol_precond, info_precond) = utils.gmres(A, RHS, tol=read.solver_tolerance, M=PC, maxiter=1000, restart=60, callback=counter)
-
-            # Extract one column of the mobility matrix
-            Mobility.append(sol_precond[3*Nblobs: 3*Nblobs + 6*num_bodies])
+    # Set linear operators, the products with several columns
+    # compute the blobs mobility products at once
+    K_bodies = multi_bodies.calc_K_matrix_bodies(bodies, Nblobs, r_vectors = r_vectors_blobs)
+    linear_operator_partial = partial(multi_bodies.linear_operator_rigid, bodies=bodies, r_vectors=r_vectors_blobs, eta=read.eta, a=read.blob_radius,
+                                      K_bodies=K_bodies)
+    linear_operator_matmat_partial = partial(multi_bodies.linear_operator_rigid_matmat, bodies=bodies, r_vectors=r_vectors_blobs, eta=read.eta, a=read.blob_radius,
+                                             K_bodies=K_bodies)
+    A = spla.LinearOperator((System_size, System_size), matvec = linear_operator_partial, matmat = linear_operator_matmat_partial, dtype='float64')
+
+    # Set block diagonal preconditioner
+    PC_partial = multi_bodies.build_block_diagonal_preconditioner(bodies, r_vectors_blobs, Nblobs, read.eta, read.blob_radius)
+    PC = spla.LinearOperator((System_size, System_size), matvec = PC_partial, matmat = PC_partial, dtype='float64')
+
+    # Solve the problems with unit force-torques in batches of
+    # columns, distributed among processes if body_mobility_processes > 1
+    solve_body_mobility_columns.problem.update({'A': A, 'PC': PC, 'Nblobs': Nblobs, 'System_size': System_size, 
+                                                'tol': read.solver_tolerance, 'print_residual': args.print_residual})
+    columns = range(6 * num_bodies)
+    batches = [columns[i : i + read.body_mobility_batch] for i in range(0, len(columns), read.body_mobility_batch)]
+    if read.body_mobility_processes > 1:
+      pool = multiprocessing.Pool(read.body_mobility_processes)
+      Mobility = pool.map(solve_body_mobility_columns, batches)
+      pool.close()
+      pool.join()
+    else:
+      Mobility = map(solve_body_mobility_columns, batches)
+    Mobility = np.concatenate(Mobility, axis=1)
 
     # Save velocity
     name = read.output_name + '.body_mobility.dat'
-    np.savetxt(name, np.transpose(Mobility), delimiter='  ')
+    np.savetxt(name, Mobility, delimiter='  ')
     print 'Time to compute body mobility =', time.time() - start_time
 
   elif read.scheme == 'body_mobility_dense':
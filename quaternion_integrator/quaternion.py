@@ -1,53 +1,130 @@
 '''
 Simple quaternion object for use with quaternion integrators.
+
+The functions *_array work with arrays of quaternions with
+shape (N, 4), where each row is (s, p1, p2, p3), so many
+orientations can be updated without loops. The Quaternion
+object is a thin view of one of these rows.
 '''
 import numpy as np
 
+
+def from_rotation_array(phi):
+  '''
+  Create the quaternions, shape (N, 4), given the rotation vectors
+  phi with shape (N, 3). See Quaternion.from_rotation.
+  '''
+  phi = np.reshape(phi, (-1, 3))
+  phi_norm = np.sqrt(np.einsum('ij,ij->i', phi, phi))
+  theta = np.zeros((phi.shape[0], 4))
+  theta[:, 0] = np.cos(phi_norm * 0.5)
+  sel = phi_norm > 0
+  theta[sel, 1:4] = (np.sin(phi_norm[sel] * 0.5) / phi_norm[sel])[:, None] * phi[sel]
+  return theta
+
+
+def product_array(theta, psi):
+  '''
+  Quaternion multiplication theta * psi, both arrays with shape (N, 4).
+  '''
+  result = np.empty((max(theta.shape[0], psi.shape[0]), 4))
+  result[:, 0] = theta[:, 0] * psi[:, 0] - np.einsum('ij,ij->i', theta[:, 1:4], psi[:, 1:4])
+  result[:, 1:4] = theta[:, 0, None] * psi[:, 1:4] + psi[:, 0, None] * theta[:, 1:4] + np.cross(theta[:, 1:4], psi[:, 1:4])
+  return result
+
+
+def rotation_matrix_array(theta):
+  '''
+  Return the rotation matrices, shape (N, 3, 3), representing
+  the rotation by the quaternions theta with shape (N, 4).
+  '''
+  s = theta[:, 0]
+  p = theta[:, 1:4]
+  R = 2.0 * p[:, :, None] * p[:, None, :]
+  diag = 2.0 * s * s - 1.0
+  R[:, 0, 0] += diag
+  R[:, 1, 1] += diag
+  R[:, 2, 2] += diag
+  sp = 2.0 * s[:, None] * p
+  R[:, 0, 1] -= sp[:, 2]
+  R[:, 0, 2] += sp[:, 1]
+  R[:, 1, 0] += sp[:, 2]
+  R[:, 1, 2] -= sp[:, 0]
+  R[:, 2, 0] -= sp[:, 1]
+  R[:, 2, 1] += sp[:, 0]
+  return R
+
+
+def inverse_array(theta):
+  ''' Return the inverse quaternions, shape (N, 4).'''
+  result = np.copy(theta)
+  result[:, 1:4] *= -1.0
+  return result
+
+
+def rotation_angle_array(theta):
+  '''
+  Return the 3 dimensional rotation angles, shape (N, 3),
+  that the quaternions represent.
+  '''
+  p_norm = np.sqrt(np.einsum('ij,ij->i', theta[:, 1:4], theta[:, 1:4]))
+  phi = np.zeros((theta.shape[0], 3))
+  sel = p_norm > 0
+  phi[sel] = (2.0 * np.arccos(np.clip(theta[sel, 0], -1.0, 1.0)) / p_norm[sel])[:, None] * theta[sel, 1:4]
+  return phi
+
+
+def normalize_array(theta):
+  '''
+  Normalize in place the quaternions theta, shape (N, 4),
+  to remove the round-off drift of their norm.
+  '''
+  theta /= np.sqrt(np.einsum('ij,ij->i', theta, theta))[:, None]
+  return theta
+
+
 class Quaternion(object):
-  
+
   def __init__(self, entries):
-    ''' Constructor, takes 4 entries = s, p1, p2, p3 as a numpy array. '''
-    self.entries = entries
-    self.s = np.array(entries[0])
-    self.p = np.array(entries[1:4])
+    '''
+    Constructor, takes 4 entries = s, p1, p2, p3 as a numpy array.
+    If entries is a float array the quaternion is a view of it.
+    '''
+    self.entries = np.asarray(entries, dtype=float)
+
+
+  @property
+  def s(self):
+    return self.entries[0]
+
+
+  @property
+  def p(self):
+    return self.entries[1:4]
 
 
   @classmethod
   def from_rotation(cls, phi):
     ''' Create a quaternion given an angle of rotation phi,
-    which represents a rotation clockwise about the vector phi of magnitude 
+    which represents a rotation clockwise about the vector phi of magnitude
     phi. This will be used with phi = omega*dt or similar in the integrator.'''
-    phi_norm = np.linalg.norm(phi)
-    s = np.array([np.cos(phi_norm/2.)])
-    if phi_norm != 0:
-      p = np.sin(phi_norm/2)*(phi/phi_norm)
-    else:
-      p = np.zeros(3)
-    return cls(np.concatenate([s, p]))
-
-    
+    return cls(from_rotation_array(phi)[0])
+
+
   def __mul__(self, other):
-    ''' 
-    Quaternion multiplication.  In this case, other is the 
-    right quaternion. 
     '''
-    s = (self.s*other.s - 
-         np.dot(self.p, other.p))
-    p = (self.s*other.p + other.s*self.p
-         + np.cross(self.p, other.p))
-    return Quaternion(np.concatenate(([s], p)))
+    Quaternion multiplication.  In this case, other is the
+    right quaternion.
+    '''
+    return Quaternion(product_array(self.entries[None, :], other.entries[None, :])[0])
 
 
   def rotation_matrix(self):
-    ''' 
+    '''
     Return the rotation matrix representing rotation
     by this quaternion.
     '''
-    # Cross product matrix for p, actually the negative.
-    diag = self.s**2 - 0.5
-    return 2.0 * np.array([[self.p[0]**2+diag,                    self.p[0]*self.p[1]-self.s*self.p[2], self.p[0]*self.p[2]+self.s*self.p[1]], 
-                           [self.p[1]*self.p[0]+self.s*self.p[2], self.p[1]**2+diag,                    self.p[1]*self.p[2]-self.s*self.p[0]],
-                           [self.p[2]*self.p[0]-self.s*self.p[1], self.p[2]*self.p[1]+self.s*self.p[0], self.p[2]**2+diag]])
+    return rotation_matrix_array(self.entries[None, :])[0]
 
 
   def __str__(self):
@@ -56,20 +133,22 @@ class Quaternion(object):
 
   def inverse(self):
     ''' Return the inverse quaternion.'''
-    return Quaternion([self.s, -1.*self.p[0], -1.*self.p[1],
-                       -1.*self.p[2]])
+    return Quaternion(inverse_array(self.entries[None, :])[0])
+
 
-  
   def rotation_angle(self):
     ''' Return 3 dimensional rotation angle that the quaternion represents. '''
-    phi_norm = 2.*np.arccos(self.s)
-    return phi_norm*self.p/(np.linalg.norm(self.p))
+    return rotation_angle_array(self.entries[None, :])[0]
+
+
+  def normalize(self):
+    ''' Normalize in place the quaternion. '''
+    normalize_array(self.entries[None, :])
+    return self
+
 
   def random_orientation(self):
     '''Give this quaternion object a random orientation'''
     theta = np.random.normal(0., 1., 4)
     theta = theta/np.linalg.norm(theta)
     self.entries = theta
-    self.s = theta[0]
-    self.p = theta[1:4]
-    
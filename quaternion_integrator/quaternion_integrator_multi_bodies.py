@@ -10,6 +10,7 @@ import copy
 from quaternion import Quaternion
 from stochastic_forcing import stochastic_forcing as stochastic
 from mobility import mobility as mob
+from body.bodies_array import BodiesArray
 import utils
 
 import scipy
@@ -25,6 +26,7 @@ class QuaternionIntegrator(object):
     Init object
     '''
     self.bodies = bodies
+    self.bodies_array = BodiesArray(bodies)
     self.Nblobs = Nblobs
     self.scheme = scheme
     self.mobility_bodies = np.empty((len(bodies), 6, 6))
@@ -57,6 +59,16 @@ class QuaternionIntegrator(object):
     self.first_guess = None
     self.preconditioner = None
     self.mobility_vector_prod = None
+    self.verlet_list_blobs = None
+    self.verlet_list_bodies = None
+    self.stochastic_forcing_implementation = 'lanczos'
+    self.eig_bounds = None
+    self.eig_bounds_step = None
+    self.chebyshev_coefficients = None
+    self.krylov_recycle_dim = 0
+    self.krylov_recycle_space = None
+    self.initial_guess = None
+    self.preconditioner_refresh = None
     if tolerance is not None:
       self.tolerance = tolerance
       self.rf_delta = 0.1 * np.power(self.tolerance, 1.0/3.0)
@@ -83,19 +95,13 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Solve mobility problem
-      sol_precond = self.solve_mobility_problem(x0 = self.first_guess, save_first_guess = True, update_PC = self.update_PC, step = kwargs.get('step'))
+      sol_precond = self.solve_mobility_problem(slot = 'deterministic', x0 = self.first_guess, save_first_guess = True, update_PC = self.update_PC, step = kwargs.get('step'))
 
       # Extract velocities
       velocities = np.reshape(sol_precond[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Update location orientation
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location + velocities[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation
-        else:
-          b.orientation_new = b.orientation
+      self.bodies_array.update_configuration(velocities, dt, origin = 'current', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -124,13 +130,7 @@ class QuaternionIntegrator(object):
       velocities, mobility_bodies = self.solve_mobility_problem_dense_algebra()
 
       # Update location orientation
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location + velocities[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation
-        else:
-          b.orientation_new = b.orientation
+      self.bodies_array.update_configuration(velocities, dt, origin = 'current', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -156,7 +156,7 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Solve mobility problem
-      sol_precond = self.solve_mobility_problem(x0 = self.first_guess, save_first_guess = True, update_PC = self.update_PC, step = kwargs.get('step'))
+      sol_precond = self.solve_mobility_problem(slot = 'deterministic', x0 = self.first_guess, save_first_guess = True, update_PC = self.update_PC, step = kwargs.get('step'))
 
       # Extract velocities
       velocities = np.reshape(sol_precond[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
@@ -164,23 +164,10 @@ class QuaternionIntegrator(object):
       # Update location and orientation
       if self.first_step == False:
         # Use Adams-Bashforth
-        for k, b in enumerate(self.bodies):
-          b.location_new = b.location + (1.5 * velocities[6*k:6*k+3] - 0.5 * self.velocities_previous_step[6*k:6*k+3]) * dt
-          if self.do_rotation == 'True':
-            quaternion_dt = Quaternion.from_rotation((1.5 * velocities[6*k+3:6*k+6] \
-                                                      - 0.5 * self.velocities_previous_step[6*k+3:6*k+6]) * dt)
-            b.orientation_new = quaternion_dt * b.orientation
-          else:
-            b.orientation_new = b.orientation
+        self.bodies_array.update_configuration(1.5 * velocities - 0.5 * self.velocities_previous_step, dt, origin = 'current', target = 'new', do_rotation = self.do_rotation == 'True')
       else:
         # Use forward Euler
-        for k, b in enumerate(self.bodies):
-          b.location_new = b.location + velocities[6*k:6*k+3] * dt
-          if self.do_rotation == 'True':
-            quaternion_dt = Quaternion.from_rotation((velocities[6*k+3:6*k+6]) * dt)
-            b.orientation_new = quaternion_dt * b.orientation
-          else:
-            b.orientation_new = b.orientation
+        self.bodies_array.update_configuration(velocities, dt, origin = 'current', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -209,15 +196,13 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Save initial configuration
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
 
       # Generate random vector
       rfd_noise = np.random.normal(0.0, 1.0, len(self.bodies) * 6)
 
       # Get blobs vectors
-      r_vectors_blobs = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors()
 
       # Build preconditioners
       PC_partial, mobility_pc_partial, P_inv_mult = self.build_block_diagonal_preconditioners_det_stoch(self.bodies,
@@ -230,47 +215,39 @@ class QuaternionIntegrator(object):
                                                                                                         step = kwargs.get('step'))
 
       # Add noise contribution sqrt(2kT/dt)*N^{1/2}*W
-      velocities_noise, it_lanczos = stochastic.stochastic_forcing_lanczos(factor = np.sqrt(2*self.kT / dt),
-                                                                           tolerance = self.tolerance,
-                                                                           dim = self.Nblobs * 3,
-                                                                           mobility_mult = mobility_pc_partial,
-                                                                           L_mult = P_inv_mult,
-                                                                           print_residual = self.print_residual)
+      velocities_noise, it_lanczos = self.stochastic_forcing(factor = np.sqrt(2*self.kT / dt),
+                                                             tolerance = self.tolerance,
+                                                             dim = self.Nblobs * 3,
+                                                             mobility_mult = mobility_pc_partial,
+                                                             L_mult = P_inv_mult,
+                                                             print_residual = self.print_residual,
+                                                             step = kwargs.get('step'))
       self.stoch_iterations_count += it_lanczos
 
       # Solve mobility problem
-      sol_precond = self.solve_mobility_problem(noise = velocities_noise, x0 = self.first_guess, save_first_guess = True, PC_partial = PC_partial)
+      sol_precond = self.solve_mobility_problem(slot = 'deterministic', noise = velocities_noise, x0 = self.first_guess, save_first_guess = True, PC_partial = PC_partial)
 
       # Extract velocities
       velocities = np.reshape(sol_precond[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Update configuration for rfd
-      force_rfd = np.copy(rfd_noise)
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + rfd_noise[k*6 : k*6+3] * (-self.rf_delta * 0.5 * b.body_length)
-        force_rfd[k*6 : k*6+3] /= b.body_length
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(rfd_noise[(k*6+3):(k*6+6)] * (-self.rf_delta * 0.5))
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      force_rfd = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      force_rfd[:, 0:3] /= self.bodies_array.body_length[:, None]
+      force_rfd = np.reshape(force_rfd, rfd_noise.size)
+      rfd_displacement = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      rfd_displacement[:, 0:3] *= self.bodies_array.body_length[:, None]
+      self.bodies_array.update_configuration(rfd_displacement, -self.rf_delta * 0.5, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Add thermal drift contribution with N at x = x - random_displacement
       System_size = self.Nblobs * 3 + len(self.bodies) * 6
-      sol_precond = self.solve_mobility_problem(RHS = np.reshape(np.concatenate([np.zeros(3*self.Nblobs), -force_rfd]), (System_size)), PC_partial = PC_partial)
+      sol_precond = self.solve_mobility_problem(slot = 'drift', RHS = np.reshape(np.concatenate([np.zeros(3*self.Nblobs), -force_rfd]), (System_size)), PC_partial = PC_partial)
 
       # Update configuration for rfd
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + rfd_noise[k*6 : k*6+3] * (self.rf_delta * 0.5 * b.body_length)
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(rfd_noise[(k*6+3):(k*6+6)] * (self.rf_delta * 0.5))
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(rfd_displacement, self.rf_delta * 0.5, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Modify RHS for drift solve
       # Set linear operators
-      r_vectors_blobs = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors()
       linear_operator_partial = partial(self.linear_operator,
                                         bodies=self.bodies,
                                         r_vectors=r_vectors_blobs,
@@ -290,13 +267,7 @@ class QuaternionIntegrator(object):
       velocities += (self.kT / self.rf_delta) * velocities_drift
 
       # Update location orientation
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location_old + velocities[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation_old
-        else:
-          b.orientation_new = b.orientation_old
+      self.bodies_array.update_configuration(velocities, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -323,15 +294,13 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Save initial configuration
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
 
       # Generate random vector
       rfd_noise = np.random.normal(0.0, 1.0, len(self.bodies) * 6)
 
       # Get blobs vectors
-      r_vectors_blobs = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors()
 
       # Build preconditioners
       PC_partial, mobility_pc_partial, P_inv_mult = self.build_block_diagonal_preconditioners_det_stoch(self.bodies,
@@ -344,12 +313,13 @@ class QuaternionIntegrator(object):
                                                                                                         step = kwargs.get('step'))
 
       # Add noise contribution sqrt(2kT/dt)*N^{1/2} * W
-      velocities_noise, it_lanczos = stochastic.stochastic_forcing_lanczos(factor = np.sqrt(2*self.kT / dt),
-                                                                           tolerance = self.tolerance,
-                                                                           dim = self.Nblobs * 3,
-                                                                           mobility_mult = mobility_pc_partial,
-                                                                           L_mult = P_inv_mult,
-                                                                           print_residual = self.print_residual)
+      velocities_noise, it_lanczos = self.stochastic_forcing(factor = np.sqrt(2*self.kT / dt),
+                                                             tolerance = self.tolerance,
+                                                             dim = self.Nblobs * 3,
+                                                             mobility_mult = mobility_pc_partial,
+                                                             L_mult = P_inv_mult,
+                                                             print_residual = self.print_residual,
+                                                             step = kwargs.get('step'))
       self.stoch_iterations_count += it_lanczos
 
       # Solve stochastic mobility problem
@@ -360,37 +330,28 @@ class QuaternionIntegrator(object):
       velocities_stoch = np.reshape(sol_precond[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Solve deterministic mobility problem
-      sol_precond = self.solve_mobility_problem(x0 = self.first_guess, save_first_guess = True, PC_partial = PC_partial)
+      sol_precond = self.solve_mobility_problem(slot = 'deterministic', x0 = self.first_guess, save_first_guess = True, PC_partial = PC_partial)
 
       # Extract deterministic velocities
       velocities_det = np.reshape(sol_precond[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Update configuration for rfd
-      force_rfd = np.copy(rfd_noise)
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + rfd_noise[k*6 : k*6+3] * (-self.rf_delta * 0.5 * b.body_length)
-        force_rfd[k*6 : k*6+3] /= b.body_length
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(rfd_noise[(k*6+3):(k*6+6)] * (-self.rf_delta * 0.5))
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      force_rfd = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      force_rfd[:, 0:3] /= self.bodies_array.body_length[:, None]
+      force_rfd = np.reshape(force_rfd, rfd_noise.size)
+      rfd_displacement = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      rfd_displacement[:, 0:3] *= self.bodies_array.body_length[:, None]
+      self.bodies_array.update_configuration(rfd_displacement, -self.rf_delta * 0.5, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Add thermal drift contribution with N at x = x - random_displacement
-      sol_precond = self.solve_mobility_problem(RHS = np.reshape(np.concatenate([np.zeros(3*self.Nblobs), -force_rfd]), (System_size)), PC_partial = PC_partial)
+      sol_precond = self.solve_mobility_problem(slot = 'drift', RHS = np.reshape(np.concatenate([np.zeros(3*self.Nblobs), -force_rfd]), (System_size)), PC_partial = PC_partial)
 
       # Update configuration for rfd
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + rfd_noise[k*6 : k*6+3] * (self.rf_delta * 0.5 * b.body_length)
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(rfd_noise[(k*6+3):(k*6+6)] * (self.rf_delta * 0.5))
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(rfd_displacement, self.rf_delta * 0.5, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Modify RHS for drift solve
       # Set linear operators
-      r_vectors_blobs = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors()
       linear_operator_partial = partial(self.linear_operator,
                                         bodies=self.bodies,
                                         r_vectors=r_vectors_blobs,
@@ -412,22 +373,10 @@ class QuaternionIntegrator(object):
       # Update location and orientation
       if self.first_step == False:
         # Use Adams-Bashforth
-        for k, b in enumerate(self.bodies):
-          b.location_new = b.location_old + (1.5 * velocities_det[6*k:6*k+3] - 0.5 * self.velocities_previous_step[6*k:6*k+3] + velocities_stoch[6*k:6*k+3]) * dt
-          if self.do_rotation == 'True':
-            quaternion_dt = Quaternion.from_rotation((1.5 * velocities_det[6*k+3:6*k+6] - 0.5 * self.velocities_previous_step[6*k+3:6*k+6] + velocities_stoch[6*k+3:6*k+6]) * dt)
-            b.orientation_new = quaternion_dt * b.orientation_old
-          else:
-            b.orientation_new = b.orientation_old
+        self.bodies_array.update_configuration(1.5 * velocities_det - 0.5 * self.velocities_previous_step + velocities_stoch, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
       else:
         # Use forward Euler
-        for k, b in enumerate(self.bodies):
-          b.location_new = b.location_old + (velocities_det[6*k:6*k+3] + velocities_stoch[6*k:6*k+3]) * dt
-          if self.do_rotation == 'True':
-            quaternion_dt = Quaternion.from_rotation((velocities_det[6*k+3:6*k+6] + velocities_stoch[6*k+3:6*k+6]) * dt)
-            b.orientation_new = quaternion_dt * b.orientation_old
-          else:
-            b.orientation_new = b.orientation_old
+        self.bodies_array.update_configuration(velocities_det + velocities_stoch, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -465,23 +414,16 @@ class QuaternionIntegrator(object):
       velocities += stochastic.stochastic_forcing_eig(mobility_bodies, factor = np.sqrt(2*self.kT / dt))
 
       # Update configuration for rfd
-      force_rfd = np.copy(rfd_noise)
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location + rfd_noise[k*6 : k*6+3] * (self.rf_delta * b.body_length)
-        force_rfd[k*6 : k*6+3] /= b.body_length
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(rfd_noise[(k*6+3):(k*6+6)] * (self.rf_delta))
-          b.orientation_new = quaternion_dt * b.orientation
-        else:
-          b.orientation_new = b.orientation
+      force_rfd = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      force_rfd[:, 0:3] /= self.bodies_array.body_length[:, None]
+      force_rfd = np.reshape(force_rfd, rfd_noise.size)
+      rfd_displacement = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      rfd_displacement[:, 0:3] *= self.bodies_array.body_length[:, None]
+      self.bodies_array.update_configuration(rfd_displacement, self.rf_delta, origin = 'current', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Compute bodies' mobility at new configuration
       # Get blobs coordinates
-      r_vectors_blobs = np.empty((self.Nblobs, 3))
-      offset = 0
-      for b in self.bodies:
-        r_vectors_blobs[offset:(offset+b.Nblobs)] = b.get_r_vectors(b.location_new, b.orientation_new)
-        offset += b.Nblobs
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors('new')
 
       # Calculate mobility (M) at the blob level
       mobility_blobs = self.mobility_blobs(r_vectors_blobs, self.eta, self.a)
@@ -490,11 +432,7 @@ class QuaternionIntegrator(object):
       resistance_blobs = np.linalg.inv(mobility_blobs)
 
       # Calculate block-diagonal matrix K
-      K = np.zeros((3*self.Nblobs, 6*len(self.bodies)))
-      offset = 0
-      for k, b in enumerate(self.bodies):
-        K[3*offset:3*(offset+b.Nblobs), 6*k:6*k+6] = b.calc_K_matrix(location = b.location_new, orientation = b.orientation_new)
-        offset += b.Nblobs
+      K = self.bodies_array.calc_K_matrix('new')
 
       # Calculate mobility (N) at the body level. Use np.linalg.inv or np.linalg.pinv
       mobility_bodies_new = np.linalg.pinv(np.dot(K.T, np.dot(resistance_blobs, K)), rcond=1e-14)
@@ -503,13 +441,7 @@ class QuaternionIntegrator(object):
       velocities += (self.kT / self.rf_delta) * np.dot(mobility_bodies_new - mobility_bodies, force_rfd)
 
       # Update location orientation
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location + velocities[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientationw
-        else:
-          b.orientation_new = b.orientation
+      self.bodies_array.update_configuration(velocities, dt, origin = 'current', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -540,14 +472,12 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       rfd_noise = np.random.normal(0.0, 1.0, 6*len(self.bodies))
-      W = np.empty_like(rfd_noise)
 
       # Save initial configuration and scale noise
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
-        W[k*6 : k*6+3] = rfd_noise[k*6 : k*6+3] * (self.kT / b.body_length)
-        W[(k*6+3):(k*6+6)] = rfd_noise[(k*6+3):(k*6+6)] * self.kT
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
+      W = np.reshape(rfd_noise * self.kT, (len(self.bodies), 6))
+      W[:, 0:3] /= self.bodies_array.body_length[:, None]
+      W = np.reshape(W, rfd_noise.size)
 
       # Set RHS for RFD increments
       System_size = self.Nblobs * 3 + len(self.bodies) * 6
@@ -555,7 +485,7 @@ class QuaternionIntegrator(object):
       RAND_RHS[3*self.Nblobs:System_size] = -1.0*W
 
       # Get blobs vectors
-      r_vectors_blobs_n = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_n = self.bodies_array.get_blobs_r_vectors()
 
       # Build preconditioners
       PC_partial, mobility_pc_partial, P_inv_mult = self.build_block_diagonal_preconditioners_det_stoch(self.bodies,
@@ -575,46 +505,41 @@ class QuaternionIntegrator(object):
       # compute M*Lambda_rfd
       MxLam = self.mobility_vector_prod(r_vectors_blobs_n, Lam_RFD, self.eta, self.a, periodic_length = self.periodic_length)
       # compute K^T*Lambda_rfd
-      KTxLam = self.K_matrix_T_vector_prod(self.bodies, Lam_RFD, self.Nblobs)
+      KTxLam = self.bodies_array.K_matrix_T_vector_prod(Lam_RFD)
       # compute K*U_rfd
-      KxU = self.K_matrix_vector_prod(self.bodies, U_RFD, self.Nblobs)
+      KxU = self.bodies_array.K_matrix_vector_prod(U_RFD)
 
       # Compute RFD bits
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + rfd_noise[6*k:6*k+3] * (self.rf_delta * b.body_length)
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(rfd_noise[6*k+3:6*k+6] * self.rf_delta)
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
-      r_vectors_blobs_RFD = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      rfd_displacement = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      rfd_displacement[:, 0:3] *= self.bodies_array.body_length[:, None]
+      self.bodies_array.update_configuration(rfd_displacement, self.rf_delta, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
+      r_vectors_blobs_RFD = self.bodies_array.get_blobs_r_vectors()
 
       # compute (M_rfd-M)*Lambda_rfd
       DxM = self.mobility_vector_prod(r_vectors_blobs_RFD, Lam_RFD, self.eta, self.a, periodic_length = self.periodic_length) - MxLam
       # compute (K_rfd^T - K^T)*Lambda_rfd
-      DxKT = self.K_matrix_T_vector_prod(self.bodies, Lam_RFD, self.Nblobs) - KTxLam
+      DxKT = self.bodies_array.K_matrix_T_vector_prod(Lam_RFD) - KTxLam
       # compute (K_rfd - K)*U_rfd
-      DxK = np.reshape( self.K_matrix_vector_prod(self.bodies, U_RFD, self.Nblobs) - KxU, 3*self.Nblobs)
+      DxK = np.reshape( self.bodies_array.K_matrix_vector_prod(U_RFD) - KxU, 3*self.Nblobs)
 
       # reset locs and thetas
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location, b.location_old)
-        b.orientation = copy.copy(b.orientation_old)
+      self.bodies_array.copy_configuration(origin = 'old', target = 'current')
 
       # Add noise contribution sqrt(2kT/dt)*N^{1/2}*W
-      slip_noise, it_lanczos = stochastic.stochastic_forcing_lanczos(factor = np.sqrt(2.0*self.kT / dt),
-                                                                     tolerance = self.tolerance,
-                                                                     dim = self.Nblobs * 3,
-                                                                     mobility_mult = mobility_pc_partial,
-                                                                     L_mult = P_inv_mult,
-                                                                     print_residual = self.print_residual)
+      slip_noise, it_lanczos = self.stochastic_forcing(factor = np.sqrt(2.0*self.kT / dt),
+                                                       tolerance = self.tolerance,
+                                                       dim = self.Nblobs * 3,
+                                                       mobility_mult = mobility_pc_partial,
+                                                       L_mult = P_inv_mult,
+                                                       print_residual = self.print_residual,
+                                                       step = kwargs.get('step'))
       self.stoch_iterations_count += it_lanczos
 
       rand_slip = slip_noise + (1.0 / self.rf_delta) * (DxM - DxK)
       rand_force = (-1.0 / self.rf_delta) * DxKT
 
       # Solve mobility problem with drift
-      sol_precond_new = self.solve_mobility_problem(noise = rand_slip,
+      sol_precond_new = self.solve_mobility_problem(slot = 'deterministic', noise = rand_slip,
                                                     noise_FT = rand_force,
                                                     x0 = self.first_guess,
                                                     save_first_guess = True,
@@ -622,13 +547,7 @@ class QuaternionIntegrator(object):
       velocities_new = np.reshape(sol_precond_new[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Update location and orientation
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location_old + velocities_new[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_new[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation_old
-        else:
-          b.orientation_new = b.orientation_old
+      self.bodies_array.update_configuration(velocities_new, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -654,9 +573,7 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Save initial configuration
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
 
       # Solve mobility problem
       velocities_mid, mobility_bodies = self.solve_mobility_problem_dense_algebra()
@@ -675,13 +592,7 @@ class QuaternionIntegrator(object):
       velocities_mid += Nhalf_W1
 
       # Update location orientation to mid point
-      for k, b in enumerate(self.bodies):
-	b.location = b.location_old + velocities_mid[6*k:6*k+3] * dt * 0.5
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_mid[6*k+3:6*k+6]) * dt * 0.5)
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(velocities_mid, dt * 0.5, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Check positions, if invalid continue
       if self.check_positions(new = 'current', old = 'old', update_in_success = False, update_in_failure = True, domain = self.domain) is False:
@@ -692,13 +603,7 @@ class QuaternionIntegrator(object):
       velocities_new += np.dot(mobility_bodies,Ninvhalf_cor)
 
       # Update location orientation to end point
-      for k, b in enumerate(self.bodies):
-	b.location_new = b.location_old + velocities_new[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_new[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation_old
-        else:
-          b.orientation_new = b.orientation_old
+      self.bodies_array.update_configuration(velocities_new, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -728,14 +633,12 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       rfd_noise = np.random.normal(0.0, 1.0, 6*len(self.bodies))
-      W = np.empty_like(rfd_noise)
 
       # Save initial configuration
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
-        W[k*6 : k*6+3] = rfd_noise[k*6 : k*6+3] * (self.kT / b.body_length)
-	W[(k*6+3):(k*6+6)] = rfd_noise[(k*6+3):(k*6+6)] * self.kT
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
+      W = np.reshape(rfd_noise * self.kT, (len(self.bodies), 6))
+      W[:, 0:3] /= self.bodies_array.body_length[:, None]
+      W = np.reshape(W, rfd_noise.size)
 
       # Set RHS for RFD increments
       System_size = self.Nblobs * 3 + len(self.bodies) * 6
@@ -743,7 +646,7 @@ class QuaternionIntegrator(object):
       RAND_RHS[3*self.Nblobs:System_size] = -1.0 * W
 
       # Get blobs vectors
-      r_vectors_blobs_n = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_n = self.bodies_array.get_blobs_r_vectors()
 
       # Build preconditioners
       PC_partial, mobility_pc_partial, P_inv_mult = self.build_block_diagonal_preconditioners_det_stoch(self.bodies,
@@ -763,39 +666,34 @@ class QuaternionIntegrator(object):
       # compute M*Lambda_rfd
       MxLam = self.mobility_vector_prod(r_vectors_blobs_n, Lam_RFD, self.eta, self.a, periodic_length = self.periodic_length)
       # compute K^T*Lambda_rfd
-      KTxLam = self.K_matrix_T_vector_prod(self.bodies, Lam_RFD, self.Nblobs)
+      KTxLam = self.bodies_array.K_matrix_T_vector_prod(Lam_RFD)
       # compute K*U_rfd
-      KxU = self.K_matrix_vector_prod(self.bodies, U_RFD, self.Nblobs)
+      KxU = self.bodies_array.K_matrix_vector_prod(U_RFD)
 
       # Compute RFD bits
-      for k, b in enumerate(self.bodies):
-	b.location = b.location_old + rfd_noise[6*k:6*k+3] * (self.rf_delta * b.body_length)
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(rfd_noise[6*k+3:6*k+6] * self.rf_delta)
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      rfd_displacement = np.reshape(np.copy(rfd_noise), (len(self.bodies), 6))
+      rfd_displacement[:, 0:3] *= self.bodies_array.body_length[:, None]
+      self.bodies_array.update_configuration(rfd_displacement, self.rf_delta, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # compute (M_rfd-M)*Lambda_rfd
-      r_vectors_blobs_RFD = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_RFD = self.bodies_array.get_blobs_r_vectors()
       DxM = self.mobility_vector_prod(r_vectors_blobs_RFD, Lam_RFD, self.eta, self.a, periodic_length = self.periodic_length) - MxLam
       # compute (K_rfd^T - K^T)*Lambda_rfd
-      DxKT = self.K_matrix_T_vector_prod(self.bodies, Lam_RFD, self.Nblobs) - KTxLam
+      DxKT = self.bodies_array.K_matrix_T_vector_prod(Lam_RFD) - KTxLam
       # compute (K_rfd - K)*U_rfd
-      DxK = np.reshape( self.K_matrix_vector_prod(self.bodies, U_RFD, self.Nblobs) - KxU, 3*self.Nblobs)
+      DxK = np.reshape( self.bodies_array.K_matrix_vector_prod(U_RFD) - KxU, 3*self.Nblobs)
 
       # reset locs and thetas
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location, b.location_old)
-        b.orientation = copy.copy(b.orientation_old)
+      self.bodies_array.copy_configuration(origin = 'old', target = 'current')
 
       # Add noise contribution sqrt(2kT/dt)*N^{1/2}*W
-      slip_noise, it_lanczos = stochastic.stochastic_forcing_lanczos(factor = np.sqrt(2.0*self.kT / dt),
-                                                                     tolerance = self.tolerance,
-                                                                     dim = self.Nblobs * 3,
-                                                                     mobility_mult = mobility_pc_partial,
-                                                                     L_mult = P_inv_mult,
-                                                                     print_residual = self.print_residual)
+      slip_noise, it_lanczos = self.stochastic_forcing(factor = np.sqrt(2.0*self.kT / dt),
+                                                       tolerance = self.tolerance,
+                                                       dim = self.Nblobs * 3,
+                                                       mobility_mult = mobility_pc_partial,
+                                                       L_mult = P_inv_mult,
+                                                       print_residual = self.print_residual,
+                                                       step = kwargs.get('step'))
       self.stoch_iterations_count += it_lanczos
 
       rand_slip = (1.0 / self.rf_delta)* (DxM - DxK)
@@ -803,7 +701,7 @@ class QuaternionIntegrator(object):
 
 
       # Solve mobility problem with drift
-      sol_precond_new = self.solve_mobility_problem(noise = rand_slip,
+      sol_precond_new = self.solve_mobility_problem(slot = 'deterministic', noise = rand_slip,
                                                     noise_FT = rand_force,
                                                     x0 = self.first_guess,
                                                     save_first_guess = True,
@@ -820,13 +718,7 @@ class QuaternionIntegrator(object):
         velocities_AB = velocities_new + velocities_noise
 
       # Update location and orientation
-      for k, b in enumerate(self.bodies):
-	b.location_new = b.location_old + velocities_AB[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_AB[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation_old
-        else:
-          b.orientation_new = b.orientation_old
+      self.bodies_array.update_configuration(velocities_AB, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -858,21 +750,19 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Save initial configuration
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
 
       # Generate random vector
       W1 = np.random.normal(0.0, 1.0, self.Nblobs*3)
       W_slip = np.random.normal(0.0, 1.0, self.Nblobs*3)
 
       # Compute M at time level n
-      r_vectors_blobs_n = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_n = self.bodies_array.get_blobs_r_vectors()
 
       #compute M*W to be used by the corrector step
       MxW_slip = self.mobility_vector_prod(r_vectors_blobs_n, W_slip, self.eta, self.a, periodic_length = self.periodic_length)
       #compute K^T*W to be used by the corrector step
-      KTxW_slip = self.K_matrix_T_vector_prod(self.bodies,W_slip, self.Nblobs)
+      KTxW_slip = self.bodies_array.K_matrix_T_vector_prod(W_slip)
 
       # Build preconditioners
       PC_partial, mobility_pc_partial, P_inv_mult = self.build_block_diagonal_preconditioners_det_stoch(self.bodies,
@@ -885,18 +775,19 @@ class QuaternionIntegrator(object):
                                                                                                         step = kwargs.get('step'))
 
       # Calc noise contributions M^{1/2}*W1 and M^{1/2}*(W1+W3)
-      velocities_noise_W1, it_lanczos = stochastic.stochastic_forcing_lanczos(factor = np.sqrt(2*self.kT / dt),
-                                                                              tolerance = self.tolerance,
-                                                                              dim = self.Nblobs * 3,
-                                                                              mobility_mult = mobility_pc_partial,
-                                                                              L_mult = P_inv_mult,
-                                                                              z = W1,
-                                                                              print_residual = self.print_residual)
+      velocities_noise_W1, it_lanczos = self.stochastic_forcing(factor = np.sqrt(2*self.kT / dt),
+                                                                tolerance = self.tolerance,
+                                                                dim = self.Nblobs * 3,
+                                                                mobility_mult = mobility_pc_partial,
+                                                                L_mult = P_inv_mult,
+                                                                z = W1,
+                                                                print_residual = self.print_residual,
+                                                                step = kwargs.get('step'))
       self.stoch_iterations_count += it_lanczos
 
 
       # Solve mobility problem
-      sol_precond = self.solve_mobility_problem(noise = velocities_noise_W1,
+      sol_precond = self.solve_mobility_problem(slot = 'deterministic', noise = velocities_noise_W1,
                                                 x0 = self.first_guess,
                                                 save_first_guess = True,
                                                 PC_partial = PC_partial)
@@ -909,39 +800,27 @@ class QuaternionIntegrator(object):
       W_RFD = np.reshape(slip_precond_rfd[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Update configuration for rfd
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + W_RFD[k*6 : k*6+3] * self.rf_delta
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(W_RFD[(k*6+3):(k*6+6)] * self.rf_delta )
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(W_RFD, self.rf_delta, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Compute M at RFD time level
-      r_vectors_blobs_rfd = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_rfd = self.bodies_array.get_blobs_r_vectors()
       #compute M*W to be used by the corrector step
       M_rfdxW_slip = self.mobility_vector_prod(r_vectors_blobs_rfd, W_slip, self.eta, self.a, periodic_length = self.periodic_length)
       #compute K^T*W to be used by the corrector step
-      KT_rfdxW_slip = self.K_matrix_T_vector_prod(self.bodies, W_slip, self.Nblobs)
+      KT_rfdxW_slip = self.bodies_array.K_matrix_T_vector_prod(W_slip)
 
       rand_slip_cor = velocities_noise_W1 + (2.0*self.kT / self.rf_delta) * (M_rfdxW_slip - MxW_slip)
       rand_force_cor = -2.0 * (self.kT / self.rf_delta) * (KT_rfdxW_slip - KTxW_slip)
 
       # Update location orientation to mid point
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + velocities_1[k*6 : k*6+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(velocities_1[(k*6+3):(k*6+6)] * dt )
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(velocities_1, dt, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Check positions, if invalid continue
       if self.check_positions(new = 'current', old = 'old', update_in_success = False, update_in_failure = True, domain = self.domain) is False:
         continue
 
       # Solve mobility problem at the corrector step
-      sol_precond_cor = self.solve_mobility_problem(noise = rand_slip_cor,
+      sol_precond_cor = self.solve_mobility_problem(slot = 'corrector', noise = rand_slip_cor,
                                                     noise_FT = rand_force_cor,
                                                     x0 = self.first_guess,
                                                     save_first_guess = True,
@@ -953,13 +832,7 @@ class QuaternionIntegrator(object):
       velocities_new = 0.5 * (velocities_1 + velocities_2)
 
       # Update location orientation
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location_old + velocities_new[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_new[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation_old
-        else:
-          b.orientation_new = b.orientation_old
+      self.bodies_array.update_configuration(velocities_new, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -990,9 +863,7 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Save initial configuration
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
 
       # Generate random vector
       W1 = np.random.normal(0.0, 1.0, self.Nblobs*3)
@@ -1000,12 +871,12 @@ class QuaternionIntegrator(object):
       Wcor = W1 + np.random.normal(0.0, 1.0, self.Nblobs*3)
 
       # Compute M at time level n
-      r_vectors_blobs_n = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_n = self.bodies_array.get_blobs_r_vectors()
 
       #compute M*W to be used by the corrector step
       MxW_slip = self.mobility_vector_prod(r_vectors_blobs_n, W_slip, self.eta, self.a, periodic_length = self.periodic_length)
       #compute K^T*W to be used by the corrector step
-      KTxW_slip = self.K_matrix_T_vector_prod(self.bodies,W_slip, self.Nblobs)
+      KTxW_slip = self.bodies_array.K_matrix_T_vector_prod(W_slip)
 
       # Build preconditioners
       PC_partial, mobility_pc_partial, P_inv_mult = self.build_block_diagonal_preconditioners_det_stoch(self.bodies,
@@ -1019,26 +890,28 @@ class QuaternionIntegrator(object):
 
 
       # Calc noise contributions M^{1/2}*W1 and M^{1/2}*(W1+W3)
-      velocities_noise_W1, it_lanczos = stochastic.stochastic_forcing_lanczos(factor = np.sqrt(4*self.kT / dt),
-                                                                              tolerance = self.tolerance,
-                                                                              dim = self.Nblobs * 3,
-                                                                              mobility_mult = mobility_pc_partial,
-                                                                              L_mult = P_inv_mult,
-                                                                              z = W1,
-                                                                              print_residual = self.print_residual)
+      velocities_noise_W1, it_lanczos = self.stochastic_forcing(factor = np.sqrt(4*self.kT / dt),
+                                                                tolerance = self.tolerance,
+                                                                dim = self.Nblobs * 3,
+                                                                mobility_mult = mobility_pc_partial,
+                                                                L_mult = P_inv_mult,
+                                                                z = W1,
+                                                                print_residual = self.print_residual,
+                                                                step = kwargs.get('step'))
       self.stoch_iterations_count += it_lanczos
 
-      velocities_noise_Wcor, it_lanczos = stochastic.stochastic_forcing_lanczos(factor = np.sqrt(self.kT / dt),
-                                                                                tolerance = self.tolerance,
-                                                                                dim = self.Nblobs * 3,
-                                                                                mobility_mult = mobility_pc_partial,
-                                                                                L_mult = P_inv_mult,
-                                                                                z = Wcor,
-                                                                                print_residual = self.print_residual)
+      velocities_noise_Wcor, it_lanczos = self.stochastic_forcing(factor = np.sqrt(self.kT / dt),
+                                                                  tolerance = self.tolerance,
+                                                                  dim = self.Nblobs * 3,
+                                                                  mobility_mult = mobility_pc_partial,
+                                                                  L_mult = P_inv_mult,
+                                                                  z = Wcor,
+                                                                  print_residual = self.print_residual,
+                                                                  step = kwargs.get('step'))
       self.stoch_iterations_count += it_lanczos
 
       # Solve mobility problem
-      sol_precond = self.solve_mobility_problem(noise = velocities_noise_W1,
+      sol_precond = self.solve_mobility_problem(slot = 'deterministic', noise = velocities_noise_W1,
                                                 x0 = self.first_guess,
                                                 save_first_guess = True,
                                                 PC_partial = PC_partial)
@@ -1052,39 +925,27 @@ class QuaternionIntegrator(object):
       W_RFD = np.reshape(slip_precond_rfd[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Update configuration for rfd
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + W_RFD[k*6 : k*6+3] * self.rf_delta
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(W_RFD[(k*6+3):(k*6+6)] * self.rf_delta )
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(W_RFD, self.rf_delta, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Compute M at RFD time level
-      r_vectors_blobs_rfd = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_rfd = self.bodies_array.get_blobs_r_vectors()
       #compute M*W to be used by the corrector step
       M_rfdxW_slip = self.mobility_vector_prod(r_vectors_blobs_rfd, W_slip, self.eta, self.a, periodic_length = self.periodic_length)
       #compute K^T*W to be used by the corrector step
-      KT_rfdxW_slip = self.K_matrix_T_vector_prod(self.bodies,W_slip, self.Nblobs)
+      KT_rfdxW_slip = self.bodies_array.K_matrix_T_vector_prod(W_slip)
 
       rand_slip_cor = velocities_noise_Wcor + (self.kT / self.rf_delta)* (M_rfdxW_slip - MxW_slip)
       rand_force_cor = -1.0*(self.kT / self.rf_delta)*(KT_rfdxW_slip - KTxW_slip)
 
       # Update location orientation to mid point
-      for k, b in enumerate(self.bodies):
-        b.location = b.location_old + velocities_mid[k*6 : k*6+3] * dt * 0.5
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(velocities_mid[(k*6+3):(k*6+6)] * dt * 0.5)
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(velocities_mid, dt * 0.5, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Check positions, if invalid continue
       if self.check_positions(new = 'current', old = 'old', update_in_success = False, update_in_failure = True, domain = self.domain) is False:
         continue
 
       # Solve mobility problem at the corrector step
-      sol_precond_cor = self.solve_mobility_problem(noise = rand_slip_cor,
+      sol_precond_cor = self.solve_mobility_problem(slot = 'corrector', noise = rand_slip_cor,
                                                     noise_FT = rand_force_cor,
                                                     x0 = self.first_guess,
                                                     save_first_guess = True,
@@ -1094,13 +955,7 @@ class QuaternionIntegrator(object):
       velocities_new = np.reshape(sol_precond_cor[3*self.Nblobs: 3*self.Nblobs + 6*len(self.bodies)], (len(self.bodies) * 6))
 
       # Update location orientation
-      for k, b in enumerate(self.bodies):
-        b.location_new = b.location_old + velocities_new[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_new[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation_old
-        else:
-          b.orientation_new = b.orientation_old
+      self.bodies_array.update_configuration(velocities_new, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -1126,9 +981,7 @@ class QuaternionIntegrator(object):
       preprocess_result = self.preprocess(self.bodies)
 
       # Save initial configuration
-      for k, b in enumerate(self.bodies):
-        np.copyto(b.location_old, b.location)
-        b.orientation_old = copy.copy(b.orientation)
+      self.bodies_array.copy_configuration(origin = 'current', target = 'old')
 
       # Solve mobility problem predictor step
       velocities_mid, mobility_bodies_mid, mobility_blobs_mid, resistance_blobs_mid, K_mid, r_vectors_blobs_mid = self.solve_mobility_problem_DLA()
@@ -1161,31 +1014,19 @@ class QuaternionIntegrator(object):
       velocities_mid += RHS_pred
 
       # Compute RFD bits
-      for k, b in enumerate(self.bodies):
-	b.location = b.location_old + W_RFD[6*k:6*k+3] * self.rf_delta
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation(W_RFD[6*k+3:6*k+6] * self.rf_delta)
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(W_RFD, self.rf_delta, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
-      r_vectors_blobs_RFD = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs_RFD = self.bodies_array.get_blobs_r_vectors()
       # Calculate mobility (M) at the blob level
       mobility_blobs_RFD = self.mobility_blobs(r_vectors_blobs_RFD, self.eta, self.a)
       # Calculate block-diagonal matrix K
-      K_RFD = self.calc_K_matrix(self.bodies, self.Nblobs)
+      K_RFD = self.bodies_array.calc_K_matrix()
 
       DxM = np.dot(mobility_blobs_RFD,W_slip) - MxW_slip
       DxKT = np.dot(K_RFD.T,W_slip) - KTxW_slip
 
       # Update to mid-point
-      for k, b in enumerate(self.bodies):
-	b.location = b.location_old + velocities_mid[6*k:6*k+3] * dt * 0.5
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_mid[6*k+3:6*k+6]) * dt * 0.5)
-          b.orientation = quaternion_dt * b.orientation_old
-        else:
-          b.orientation = b.orientation_old
+      self.bodies_array.update_configuration(velocities_mid, dt * 0.5, origin = 'old', target = 'current', do_rotation = self.do_rotation == 'True')
 
       # Check positions, if invalid continue
       if self.check_positions(new = 'current', old = 'old', update_in_success = False, update_in_failure = True, domain = self.domain) is False:
@@ -1205,13 +1046,7 @@ class QuaternionIntegrator(object):
 
 
       # Update location orientation to end point
-      for k, b in enumerate(self.bodies):
-	b.location_new = b.location_old + velocities_new[6*k:6*k+3] * dt
-        if self.do_rotation == 'True':
-          quaternion_dt = Quaternion.from_rotation((velocities_new[6*k+3:6*k+6]) * dt)
-          b.orientation_new = quaternion_dt * b.orientation_old
-        else:
-          b.orientation_new = b.orientation_old
+      self.bodies_array.update_configuration(velocities_new, dt, origin = 'old', target = 'new', do_rotation = self.do_rotation == 'True')
 
       # Call postprocess
       postprocess_result = self.postprocess(self.bodies)
@@ -1223,12 +1058,40 @@ class QuaternionIntegrator(object):
     return
 
 
-  def solve_mobility_problem(self, RHS = None, noise = None, noise_FT = None, AB = None, x0 = None, save_first_guess = False, PC_partial = None, *args, **kwargs):
+  def stochastic_forcing(self, step = None, *args, **kwargs):
+    '''
+    Compute the stochastic forcing with the Lanczos (default) or
+    the Chebyshev method according to stochastic_forcing_implementation.
+    For the Chebyshev method the bounds of the spectrum of the
+    preconditioned mobility and the Chebyshev coefficients are computed 
+    once and refreshed every update_PC steps, when the preconditioner is 
+    rebuilt. If the bounds fail the check (see 
+    stochastic.chebyshev_eigenvalue_bounds) Lanczos is used until the next refresh.
+    '''
+    if self.stochastic_forcing_implementation == 'chebyshev':
+      if self.eig_bounds_step is None or (step is not None and step % self.update_PC == 0 and step != self.eig_bounds_step):
+        self.eig_bounds, self.chebyshev_coefficients = stochastic.chebyshev_eigenvalue_bounds(kwargs.get('dim'), 
+                                                                                              mobility_mult = kwargs.get('mobility_mult'),
+                                                                                              tolerance = kwargs.get('tolerance'))
+        self.eig_bounds_step = step
+    if self.stochastic_forcing_implementation == 'chebyshev' and self.eig_bounds is not None:
+      velocities_noise, it = stochastic.stochastic_forcing_chebyshev(eig_bounds = self.eig_bounds, coefficients = self.chebyshev_coefficients, *args, **kwargs)
+    else:
+      velocities_noise, it = stochastic.stochastic_forcing_lanczos(*args, **kwargs)
+    if self.preconditioner_refresh is not None:
+      self.preconditioner_refresh.add_iterations('stochastic', it)
+    return velocities_noise, it
+
+
+  def solve_mobility_problem(self, RHS = None, noise = None, noise_FT = None, AB = None, x0 = None, save_first_guess = False, PC_partial = None, slot = None, *args, **kwargs):
     '''
     Solve the mobility problem using preconditioned GMRES. Compute
     velocities on the bodies subject to active slip and enternal
     forces-torques.
 
+    If self.initial_guess is not None and slot is given, the initial
+    guess is the extrapolation of the previous solutions of the slot.
+
     The linear and angular velocities are sorted like
     velocities = (v_1, w_1, v_2, w_2, ...)
     where v_i and w_i are the linear and angular velocities of body i.
@@ -1237,7 +1100,7 @@ class QuaternionIntegrator(object):
       System_size = self.Nblobs * 3 + len(self.bodies) * 6
 
       # Get blobs coordinates
-      r_vectors_blobs = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors()
 
       # If RHS = None set RHS = [slip, -force_torque]
       if RHS is None:
@@ -1259,7 +1122,7 @@ class QuaternionIntegrator(object):
         RHS[0:r_vectors_blobs.size] -= noise
 
       # Calculate K matrix
-      K = self.calc_K_matrix_bodies(self.bodies, self.Nblobs)
+      K = self.calc_K_matrix_bodies(self.bodies, self.Nblobs, r_vectors = r_vectors_blobs)
 
       # Set linear operators
       linear_operator_partial = partial(self.linear_operator,
@@ -1281,10 +1144,46 @@ class QuaternionIntegrator(object):
       if RHS_norm > 0:
         RHS = RHS / RHS_norm
 
+      # Use the extrapolation of the previous solutions as initial guess x_guess
+      # and solve for the correction, i.e. solve A*x = RHS - A*x_guess
+      # scaled to norm 1; use zero if the guess is worse than zero
+      tolerance = self.tolerance
+      residual_norm = 1.0
+      x_guess = None
+      if self.initial_guess is not None and slot is not None and RHS_norm > 0:
+        x0 = None
+        x_guess = self.initial_guess.guess(slot)
+        if x_guess is not None:
+          x_guess = x_guess / RHS_norm
+          residual = RHS - A.matvec(x_guess)
+          self.det_iterations_count += 1
+          residual_norm = np.linalg.norm(residual)
+          if residual_norm > 0 and residual_norm < 1.0:
+            RHS = residual / residual_norm
+            tolerance = self.tolerance / residual_norm
+          else:
+            x_guess = None
+            residual_norm = 1.0
+
       # Solve preconditioned linear system
       counter = gmres_counter(print_residual = self.print_residual)
-      (sol_precond, info_precond) = utils.gmres(A, RHS, x0=x0, tol=self.tolerance, M=PC, maxiter=1000, restart=60, callback=counter)
-      self.det_iterations_count += counter.niter
+      if self.krylov_recycle_dim > 0:
+        # Recycle the deflation subspace of the previous solves, 
+        # it costs one product per vector of the subspace
+        if self.krylov_recycle_space is not None:
+          self.det_iterations_count += self.krylov_recycle_space.shape[1]
+        (sol_precond, info_precond, self.krylov_recycle_space) = utils.gcrodr(A, RHS, x0=x0, tol=tolerance, M=PC, maxiter=1000, restart=60, callback=counter,
+                                                                              k=self.krylov_recycle_dim, U=self.krylov_recycle_space)
+        self.det_iterations_count += counter.niter
+      else:
+        (sol_precond, info_precond) = utils.gmres(A, RHS, x0=x0, tol=tolerance, M=PC, maxiter=1000, restart=60, callback=counter)
+        self.det_iterations_count += counter.niter
+
+      if self.preconditioner_refresh is not None:
+        self.preconditioner_refresh.add_iterations('deterministic', counter.niter)
+
+      if x_guess is not None:
+        sol_precond = sol_precond * residual_norm + x_guess
 
       if save_first_guess:
         self.first_guess = sol_precond
@@ -1295,6 +1194,10 @@ class QuaternionIntegrator(object):
       else:
         sol_precond[:] = 0.0
 
+      # Save solution to extrapolate the next initial guesses
+      if self.initial_guess is not None and slot is not None:
+        self.initial_guess.add(slot, np.copy(sol_precond), counter.niter, guessed = x_guess is not None)
+
       # Return solution
       return sol_precond
 
@@ -1317,7 +1220,7 @@ class QuaternionIntegrator(object):
         slip = np.zeros((self.Nblobs, 3))
 
       # Get blobs coordinates
-      r_vectors_blobs = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors()
 
       # Calculate mobility (M) at the blob level
       mobility_blobs = self.mobility_blobs(r_vectors_blobs, self.eta, self.a)
@@ -1329,7 +1232,7 @@ class QuaternionIntegrator(object):
       force_torque = self.force_torque_calculator(self.bodies, r_vectors_blobs)
 
       # Calculate block-diagonal matrix K
-      K = self.calc_K_matrix(self.bodies, self.Nblobs)
+      K = self.bodies_array.calc_K_matrix()
 
       # Add slip force = K^T * M^{-1} * slip
       force_torque -= np.reshape(np.dot(K.T,np.dot(resistance_blobs, np.reshape(slip, (3*self.Nblobs,1)))), force_torque.shape)
@@ -1359,7 +1262,7 @@ class QuaternionIntegrator(object):
         slip = np.zeros((self.Nblobs, 3))
 
       # Get blobs coordinates
-      r_vectors_blobs = self.get_blobs_r_vectors(self.bodies, self.Nblobs)
+      r_vectors_blobs = self.bodies_array.get_blobs_r_vectors()
 
       # Calculate mobility (M) at the blob level
       mobility_blobs = self.mobility_blobs(r_vectors_blobs, self.eta, self.a)
@@ -1368,7 +1271,7 @@ class QuaternionIntegrator(object):
       resistance_blobs = np.linalg.inv(mobility_blobs)
 
       # Calculate block-diagonal matrix K
-      K = self.calc_K_matrix(self.bodies, self.Nblobs)
+      K = self.bodies_array.calc_K_matrix()
 
       # Calculate constraint force due to slip l = M^{-1}*slip
       force_slip = np.dot(K.T,np.dot(resistance_blobs, np.reshape(slip, (3*self.Nblobs,1))))
@@ -1391,46 +1294,25 @@ class QuaternionIntegrator(object):
   def check_positions(self, new = None, old = None, update_in_success = None, update_in_failure = None, domain = 'single_wall'):
     '''
     This function checks if the configuration is valid calling
-    body.check_function. If necessary it updates the configuration
+    bodies_array.check_function. If necessary it updates the configuration
     of body.location and body.orientation.
     '''
     # Check positions, if valid return
     valid_configuration = True
     if domain == 'single_wall':
-      if new == 'current':
-        for b in self.bodies:
-          valid_configuration = b.check_function(b.location, b.orientation)
-          if valid_configuration is False:
-            self.invalid_configuration_count += 1
-            print 'Invalid configuration number ', self.invalid_configuration_count
-            break
-      elif new == 'new':
-        for b in self.bodies:
-          valid_configuration = b.check_function(b.location_new, b.orientation_new)
-          if valid_configuration is False:
-            self.invalid_configuration_count += 1
-            print 'Invalid configuration number ', self.invalid_configuration_count
-            break
+      if new == 'current' or new == 'new':
+        valid_configuration = self.bodies_array.check_function(configuration = new)
+        if valid_configuration is False:
+          self.invalid_configuration_count += 1
+          print 'Invalid configuration number ', self.invalid_configuration_count
 
     # Update position if necessary
     if (valid_configuration is False) and (update_in_failure is True):
       if old == 'old':
-        for b in self.bodies:
-          np.copyto(b.location, b.location_old)
-          b.orientation = copy.copy(b.orientation_old)
-      if old == 'current':
-        for b in self.bodies:
-          b.location = b.location
-          b.orientation = b.orientation
+        self.bodies_array.copy_configuration(origin = 'old', target = 'current')
     elif (valid_configuration is True) and (update_in_success is True):
-      if new == 'current':
-        for b in self.bodies:
-          b.location = b.location
-          b.orientation = b.orientation
       if new == 'new':
-        for b in self.bodies:
-          np.copyto(b.location, b.location_new)
-          b.orientation = copy.copy(b.orientation_new)
+        self.bodies_array.copy_configuration(origin = 'new', target = 'current')
 
     # Return true or false
     return valid_configuration
@@ -1449,3 +1331,63 @@ class gmres_counter(object):
       if self.niter == 1:
         print 'gmres =  0 1'
       print 'gmres = ', self.niter, rk
+
+
+class InitialGuess(object):
+  '''
+  Initial guesses for the iterative solver. It keeps the last 
+  solutions of each solve slot of a scheme (e.g. 'deterministic',
+  'drift' or 'corrector') and extrapolates them in time with
+  order 0 (last solution), 1 (linear) or 2 (quadratic), assuming
+  that the solves of a slot are equispaced in time.
+  '''
+  def __init__(self, order = 1):
+    self.order = order
+    self.solutions = {}
+    self.solves = {}
+    self.iterations = {}
+    self.saved_iterations = {}
+    self.reference_iterations = {}
+
+  def guess(self, slot):
+    '''
+    Return the extrapolated solution of slot or None if
+    there are not previous solutions.
+    '''
+    x = self.solutions.get(slot)
+    if not x:
+      return None
+    elif len(x) == 1:
+      return x[-1]
+    elif len(x) == 2:
+      return 2.0 * x[-1] - x[-2]
+    return 3.0 * x[-1] - 3.0 * x[-2] + x[-3]
+
+  def add(self, slot, solution, iterations, guessed = False):
+    '''
+    Save the solution of slot and the number of iterations used.
+    The iterations saved by the guess are estimated as the difference 
+    with the last solve of the slot that did not use a guess, minus 
+    the product used to compute the initial residual.
+    '''
+    x = self.solutions.setdefault(slot, [])
+    x.append(solution)
+    if len(x) > self.order + 1:
+      del x[0]
+    self.solves[slot] = self.solves.get(slot, 0) + 1
+    self.iterations[slot] = self.iterations.get(slot, 0) + iterations
+    if not guessed:
+      self.reference_iterations[slot] = iterations
+    elif slot in self.reference_iterations:
+      self.saved_iterations[slot] = self.saved_iterations.get(slot, 0) + self.reference_iterations[slot] - iterations - 1
+
+  def info(self):
+    '''
+    Return a string with the number of solves, iterations and estimated
+    saved iterations of each slot.
+    '''
+    lines = ''
+    for slot in sorted(self.solves):
+      lines += ('initial_guess_' + slot).ljust(31) + '= solves ' + str(self.solves[slot]) + ', iterations ' + str(self.iterations[slot]) \
+               + ', estimated saved iterations ' + str(self.saved_iterations.get(slot, 0)) + '\n'
+    return lines
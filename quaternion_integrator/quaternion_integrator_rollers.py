@@ -49,6 +49,9 @@ class QuaternionIntegratorRollers(object):
     self.det_iterations_count = 0
     self.stoch_iterations_count = 0
     self.domain = domain
+    self.verlet_list_blobs = None
+    self.initial_guess = None
+    self.preconditioner_refresh = None
     if domain == 'single_wall':
       self.mobility_trans_times_force = mob.single_wall_mobility_trans_times_force_pycuda
       self.mobility_trans_times_torque = mob.single_wall_mobility_trans_times_torque_pycuda
@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
 import random
+import quaternion
 from quaternion import Quaternion
 
 class TestQuaternion(unittest.TestCase):
@@ -20,7 +21,6 @@ class TestQuaternion(unittest.TestCase):
     self.assertAlmostEqual(theta.entries[2], np.sin(phi_norm/2.)*phi[1]/phi_norm)
     self.assertAlmostEqual(theta.entries[3], np.sin(phi_norm/2.)*phi[2]/phi_norm)
 
-<<<<<<< HEAD
   def test_quaternion_rot_matrix_det_one(self):
     ''' Test that the determinant of the rotation matrix is 1.'''
     for _ in range(10):
@@ -29,10 +29,7 @@ class TestQuaternion(unittest.TestCase):
       R = theta.rotation_matrix()
       self.assertAlmostEqual(np.linalg.det(R), 1.0)
 
-  
-=======
 
->>>>>>> 9d81c63e9e914c3783b81d215bcfbe1e16011e79
   def test_multiply_quaternions(self):
     ''' Test that quaternion multiplication works '''
     # First construct any random unit quaternion. Not uniform.
@@ -79,8 +76,6 @@ class TestQuaternion(unittest.TestCase):
     self.assertAlmostEqual(R[1][1], 2.*(theta.s**2 + theta.p[1]**2 - 0.5))
     self.assertAlmostEqual(R[2][2], 2.*(theta.s**2 + theta.p[2]**2 - 0.5))
     self.assertAlmostEqual(R[2][0], 2.*(theta.p[0]*theta.p[2] - theta.s*theta.p[1]))
-<<<<<<< HEAD
-=======
 
 
   def test_rot_matrix_against_rodriguez(self):
@@ -104,8 +99,7 @@ class TestQuaternion(unittest.TestCase):
     for j in range(3):
       for k in range(3):
         self.assertAlmostEqual(R[j, k], R_rodriguez[j, k])
-                                           
->>>>>>> 9d81c63e9e914c3783b81d215bcfbe1e16011e79
+
 
   def test_quaternion_inverse(self):
     '''Test that the quaternion inverse works.'''
@@ -199,6 +193,31 @@ class TestQuaternion(unittest.TestCase):
     self.assertAlmostEqual(max_orthogonal_err, 0.0)
 
 
+  def test_quaternion_arrays(self):
+    ''' Test that the array functions agree with the Quaternion methods. '''
+    phi = np.random.normal(0., 1., (5, 3))
+    phi[0] = 0.
+    theta = quaternion.from_rotation_array(phi)
+    psi = quaternion.from_rotation_array(np.random.normal(0., 1., (5, 3)))
+    product = quaternion.product_array(theta, psi)
+    R = quaternion.rotation_matrix_array(theta)
+    theta_inv = quaternion.inverse_array(theta)
+    rotation_angle = quaternion.rotation_angle_array(theta)
+    norm = np.linalg.norm(quaternion.normalize_array(theta * 1.1), axis=1)
+    for k in range(5):
+      theta_k = Quaternion.from_rotation(phi[k])
+      psi_k = Quaternion(psi[k])
+      for j in range(4):
+        self.assertAlmostEqual(theta[k, j], theta_k.entries[j])
+        self.assertAlmostEqual(product[k, j], (theta_k * psi_k).entries[j])
+        self.assertAlmostEqual(theta_inv[k, j], theta_k.inverse().entries[j])
+      for j in range(3):
+        self.assertAlmostEqual(rotation_angle[k, j], phi[k, j])
+        for l in range(3):
+          self.assertAlmostEqual(R[k, j, l], theta_k.rotation_matrix()[j, l])
+      self.assertAlmostEqual(norm[k], 1.0)
+
+
     
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,127 @@
+'''
+Small module to write and read the trajectories of the rigid bodies
+in a binary file (save_clones binary).
+
+The file starts with a header, the magic string 'RMBCLONE',
+the length of the header text (uint64) and the header text,
+a JSON dictionary with the structures IDs, the number of bodies
+of each structure and the record dtype. The text is padded to
+a multiple of 8 bytes. Then the file stores one record per saved
+step with the fields
+
+step = step index, int64.
+location = locations of all the bodies, float64 array (Nbodies, 3).
+orientation = orientations (quaternions) of all the bodies, float64 array (Nbodies, 4).
+
+The bodies are ordered by structure, the bodies of the structure i
+are body_offsets[i] <= j < body_offsets[i+1]. The records have all
+the same size, so the file can be appended and read with a memmap.
+'''
+import json
+import numpy as np
+import os
+
+magic = 'RMBCLONE'
+
+
+def clones_record_dtype(num_bodies):
+  '''
+  Return the dtype of one record (step) for num_bodies bodies.
+  '''
+  return np.dtype([('step', '<i8'), ('location', '<f8', (num_bodies, 3)), ('orientation', '<f8', (num_bodies, 4))])
+
+
+def read_clones_binary_header(name_file):
+  '''
+  Read the header of a binary clones file.
+  Output:
+  header = dictionary with the keys structures_ID, body_types and body_offsets.
+  dtype = dtype of the records.
+  offset = size of the header in bytes.
+  '''
+  with open(name_file, 'rb') as f:
+    if f.read(len(magic)) != magic:
+      raise IOError('File ' + name_file + ' is not a binary clones file')
+    length = int(np.fromfile(f, dtype='<u8', count=1)[0])
+    header = json.loads(f.read(length).decode('utf-8'))
+  header['body_offsets'] = np.concatenate([[0], np.cumsum(header['body_types'])]).astype(int)
+  dtype = clones_record_dtype(int(header['body_offsets'][-1]))
+  offset = len(magic) + 8 + length
+  return header, dtype, offset
+
+
+class ClonesBinaryWriter(object):
+  '''
+  Append the configurations of the bodies to a binary clones file.
+  '''
+  def __init__(self, name_file, structures_ID, body_types, mode = 'w', last_step = None):
+    '''
+    Constructor. If mode is 'w' a new file is created, if mode is 'a'
+    the records are appended to an existing file with the same structures,
+    or to a new file if it does not exist. When appending, the records
+    with step larger than last_step are discarded (e.g. to restart
+    from a checkpoint).
+    '''
+    self.name_file = name_file
+    self.num_bodies = int(np.sum(body_types))
+    self.dtype = clones_record_dtype(self.num_bodies)
+    self.record = np.zeros(1, dtype=self.dtype)
+    if mode == 'a' and os.path.isfile(name_file):
+      header, dtype, offset = read_clones_binary_header(name_file)
+      if list(header['structures_ID']) != list(structures_ID) or list(header['body_types']) != list(body_types):
+        raise IOError('File ' + name_file + ' was written with different structures')
+      self.f = open(name_file, 'r+b')
+      # Discard an incomplete last record and the records after last_step
+      num_records = (os.path.getsize(name_file) - offset) // dtype.itemsize
+      if last_step is not None and num_records > 0:
+        steps = np.memmap(name_file, dtype=dtype, mode='r', offset=offset, shape=(num_records,))['step']
+        num_records = int(np.searchsorted(steps, last_step, side='right'))
+        del steps
+      self.f.truncate(offset + num_records * dtype.itemsize)
+      self.f.seek(0, os.SEEK_END)
+    else:
+      text = json.dumps({'structures_ID': list(structures_ID),
+                         'body_types': [int(x) for x in body_types],
+                         'dtype': str(self.dtype.descr)})
+      text += ' ' * (-(len(magic) + 8 + len(text)) % 8)
+      self.f = open(name_file, 'wb')
+      self.f.write(magic)
+      np.array([len(text)], dtype='<u8').tofile(self.f)
+      self.f.write(text)
+
+  def write(self, step, location, orientation):
+    '''
+    Append one record with the locations (Nbodies, 3)
+    and orientations (Nbodies, 4) of the bodies.
+    '''
+    self.record['step'] = step
+    self.record['location'] = location
+    self.record['orientation'] = orientation
+    self.record.tofile(self.f)
+    self.f.flush()
+
+  def close(self):
+    self.f.close()
+
+
+def read_clones_binary_file(name_file, start = 0, end = None):
+  '''
+  It reads the records start <= k < end of a binary clones file.
+  The arrays are views of a read-only memmap of the file,
+  the data is read from disk when it is used.
+  Input:
+  name_file = string.
+  start, end = range of records (saved steps), like a slice.
+  Output:
+  header = dictionary with the keys structures_ID, body_types and body_offsets.
+  steps = step index of the records, array shape (Nrecords).
+  locations = locations of the bodies, array shape (Nrecords, Nbodies, 3).
+  orientations = orientations of the bodies, array shape (Nrecords, Nbodies, 4).
+  '''
+  header, dtype, offset = read_clones_binary_header(name_file)
+  num_records = (os.path.getsize(name_file) - offset) // dtype.itemsize
+  if num_records == 0:
+    records = np.zeros(0, dtype=dtype)
+  else:
+    records = np.memmap(name_file, dtype=dtype, mode='r', offset=offset, shape=(num_records,))[start:end]
+  return header, records['step'], records['location'], records['orientation']
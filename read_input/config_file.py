@@ -0,0 +1,158 @@
+'''
+Small module to access the trajectories saved in one text file
+per structure (save_clones one_file, extension .config).
+
+The file is a sequence of frames (saved steps); each frame is a line
+with the number of bodies followed by one line per body with
+the location and the orientation (quaternion)
+
+x y z s p1 p2 p3
+
+The first time the file is opened the offsets (in bytes) of all the
+lines are saved in the file name_file + '.index.npy', then any frame
+or any body of a frame can be read from a memmap of the text file
+without scanning the file. If the simulation appends more frames
+the index is extended. Optionally, the trajectory can be converted
+once to a binary cache, name_file + '.columns.npy', with shape
+(7, Nbodies, Nframes), so the time series of a column of one body
+is contiguous.
+'''
+import mmap
+import numpy as np
+import os
+
+
+class ConfigFile(object):
+  '''
+  Random access to the frames and bodies of a .config file.
+  '''
+  def __init__(self, name_file, cache = False):
+    '''
+    Constructor. Open the file and build or update the index.
+    If cache is True build or load the binary cache.
+    '''
+    self.name_file = name_file
+    self.name_index = name_file + '.index.npy'
+    self.name_cache = name_file + '.columns.npy'
+    self.f = open(name_file, 'rb')
+    line = self.f.readline()
+    if line.strip() == b'':
+      self.f.close()
+      raise IOError('File ' + name_file + ' is empty')
+    self.num_bodies = int(line.split()[0])
+    self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.offsets = self.build_index()
+    self.num_frames = (self.offsets.size - 1) // (self.num_bodies + 1)
+    self.cache = None
+    if cache:
+      self.cache = self.build_cache()
+
+  def build_index(self):
+    '''
+    Return the offsets of the lines of the complete frames plus
+    the offset of the end of the last frame. Load the index
+    file if it exists and extend it if the file has grown.
+    '''
+    lines_per_frame = self.num_bodies + 1
+    header_length = len(str(self.num_bodies)) + 1
+    text = np.frombuffer(self.data, dtype=np.uint8)
+    offsets = np.zeros(1, dtype=np.int64)
+    if os.path.isfile(self.name_index):
+      if os.path.getmtime(self.name_index) >= os.path.getmtime(self.name_file):
+        return np.load(self.name_index, mmap_mode='r')
+      # Keep the old index if it is consistent with the file
+      offsets = np.load(self.name_index)
+      if offsets[-1] > text.size or np.any(text[offsets[1:] - 1] != ord('\n')) \
+         or np.any(text[offsets[0:-1:lines_per_frame] + header_length - 1] != ord('\n')):
+        offsets = np.zeros(1, dtype=np.int64)
+
+    # Find the line starts after the last indexed frame
+    start = int(offsets[-1])
+    new_lines = np.flatnonzero(text[start:] == ord('\n')).astype(np.int64) + start + 1
+    num_new_frames = new_lines.size // lines_per_frame
+    offsets = np.concatenate([offsets, new_lines[0 : num_new_frames * lines_per_frame]])
+
+    # Check that all the frames have the same number of bodies
+    lengths = offsets[1:] - offsets[:-1]
+    if np.any(lengths[0::lines_per_frame] != header_length):
+      raise IOError('File ' + self.name_file + ' has frames with different number of bodies')
+
+    with open(self.name_index, 'wb') as f:
+      np.save(f, offsets)
+    return offsets
+
+  def build_cache(self, frames_per_block = 1024):
+    '''
+    Return the binary cache with shape (7, Nbodies, Nframes), as a memmap.
+    The cache is (re)built if it does not exist or it is older than the
+    text file.
+    '''
+    if os.path.isfile(self.name_cache) and os.path.getmtime(self.name_cache) >= os.path.getmtime(self.name_file):
+      cache = np.load(self.name_cache, mmap_mode='r')
+      if cache.shape == (7, self.num_bodies, self.num_frames):
+        return cache
+    cache = np.lib.format.open_memmap(self.name_cache, mode='w+', dtype=np.float64, shape=(7, self.num_bodies, self.num_frames))
+    for k in range(0, self.num_frames, frames_per_block):
+      frames = self.read_frames(k, min(k + frames_per_block, self.num_frames))
+      cache[:, :, k : k + frames.shape[0]] = frames.transpose(2, 1, 0)
+    cache.flush()
+    del cache
+    return np.load(self.name_cache, mmap_mode='r')
+
+  def read_frames(self, start, end):
+    '''
+    Parse the text of the frames start <= k < end,
+    return an array with shape (end - start, Nbodies, 7).
+    '''
+    lines_per_frame = self.num_bodies + 1
+    text = self.data[self.offsets[start * lines_per_frame] : self.offsets[end * lines_per_frame]]
+    x = np.fromstring(text, sep=' ').reshape((end - start, 1 + 7 * self.num_bodies))
+    return x[:, 1:].reshape((end - start, self.num_bodies, 7))
+
+  def frame(self, k):
+    '''
+    Return the configuration of the frame k, array with shape (Nbodies, 7).
+    '''
+    if self.cache is not None:
+      return np.array(self.cache[:, :, k].T)
+    return self.read_frames(k, k + 1)[0]
+
+  def line(self, k, j):
+    '''
+    Return the text line (without end of line) of the body j in the frame k.
+    '''
+    i = k * (self.num_bodies + 1) + j + 1
+    return self.data[self.offsets[i] : self.offsets[i + 1] - 1].decode()
+
+  def body(self, j, start = 0, end = None):
+    '''
+    Return the configuration of the body j in the frames start <= k < end,
+    array with shape (Nframes, 7).
+    '''
+    if end is None:
+      end = self.num_frames
+    if self.cache is not None:
+      return np.array(self.cache[:, j, start:end].T)
+    x = np.empty((end - start, 7))
+    for k in range(start, end):
+      i = k * (self.num_bodies + 1) + j + 1
+      x[k - start] = np.fromstring(self.data[self.offsets[i] : self.offsets[i + 1]], sep=' ')
+    return x
+
+  def column(self, c, start = 0, end = None):
+    '''
+    Return the column c (0 = x, ..., 6 = p3) of all the bodies in
+    the frames start <= k < end, array with shape (Nframes, Nbodies).
+    '''
+    if end is None:
+      end = self.num_frames
+    if self.cache is not None:
+      return np.array(self.cache[c, :, start:end].T)
+    x = np.empty((end - start, self.num_bodies))
+    for k in range(start, end, 1024):
+      x[k - start : min(k + 1024, end) - start] = self.read_frames(k, min(k + 1024, end))[:, :, c]
+    return x
+
+  def close(self):
+    self.data.close()
+    self.f.close()
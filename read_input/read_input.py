@@ -3,6 +3,7 @@ Simple class to read the input files to run a simulation.
 '''
 import numpy as np
 import ntpath
+import multiprocessing
 
 class ReadInput(object):
   '''
@@ -53,8 +54,12 @@ class ReadInput(object):
     self.debye_length_wall = float(self.options.get('debye_length_wall') or 1.0)
     self.mobility_blobs_implementation = str(self.options.get('mobility_blobs_implementation') or 'python')
     self.mobility_vector_prod_implementation = str(self.options.get('mobility_vector_prod_implementation') or 'python')
+    self.num_threads = int(self.options.get('num_threads') or multiprocessing.cpu_count())
+    self.tree_theta = float(self.options.get('tree_theta') or 0.5)
     self.repulsion_strength = float(self.options.get('repulsion_strength') or 1.0)
     self.debye_length = float(self.options.get('debye_length') or 1.0)
+    self.debye_cutoff = float(self.options.get('debye_cutoff') or 10.0)
+    self.verlet_skin = float(self.options.get('verlet_skin') or 0.0)
     self.blob_blob_force_implementation = str(self.options.get('blob_blob_force_implementation') or 'None')
     self.body_body_force_torque_implementation = str(self.options.get('body_body_force_torque_implementation') or 'None')
     self.save_body_mobility = str(self.options.get('save_body_mobility') or 'False')
@@ -64,8 +69,13 @@ class ReadInput(object):
     self.force_file = self.options.get('force_file')
     self.velocity_file = self.options.get('velocity_file')
     self.solver_tolerance = float(self.options.get('solver_tolerance') or 1e-08)
+    self.body_mobility_batch = int(self.options.get('body_mobility_batch') or 6)
+    self.body_mobility_processes = int(self.options.get('body_mobility_processes') or 1)
     self.rf_delta = self.options.get('rf_delta') or None
     self.save_clones = str(self.options.get('save_clones') or 'one_file_per_step')
+    self.output_queue_size = int(self.options.get('output_queue_size') or 4)
+    self.n_checkpoint = int(self.options.get('n_checkpoint') or 0)
+    self.checkpoint_preconditioner = str(self.options.get('checkpoint_preconditioner') or 'False')
     self.periodic_length = np.fromstring(self.options.get('periodic_length') or '0 0 0', sep=' ')
     self.omega_one_roller = np.fromstring(self.options.get('omega_one_roller') or '0 0 0', sep=' ')
     self.free_kinematics = str(self.options.get('free_kinematics') or 'True')
@@ -76,6 +86,17 @@ class ReadInput(object):
     self.save_HydroGrid = int(self.options.get('save_HydroGrid') or 0)
     self.hydro_interactions = int(self.options.get('hydro_interactions') or 1)    
     self.update_PC = int(self.options.get('update_PC') or 1)
+    self.preconditioner_implementation = str(self.options.get('preconditioner_implementation') or 'body')
+    self.preconditioner_height_bucket = float(self.options.get('preconditioner_height_bucket') or 0.0)
+    self.preconditioner_single_precision = str(self.options.get('preconditioner_single_precision') or 'False')
+    self.preconditioner_refresh_height = float(self.options.get('preconditioner_refresh_height') or 0.0)
+    self.preconditioner_refresh_angle = float(self.options.get('preconditioner_refresh_angle') or 0.0)
+    self.preconditioner_refresh_iterations = float(self.options.get('preconditioner_refresh_iterations') or 0.0)
+    self.preconditioner_cluster_gap = float(self.options.get('preconditioner_cluster_gap') or 0.0)
+    self.preconditioner_cluster_size = int(self.options.get('preconditioner_cluster_size') or 8)
+    self.stochastic_forcing_implementation = str(self.options.get('stochastic_forcing_implementation') or 'lanczos')
+    self.krylov_recycle_dim = int(self.options.get('krylov_recycle_dim') or 0)
+    self.initial_guess_extrapolation = str(self.options.get('initial_guess_extrapolation') or 'None')
     self.domain = str(self.options.get('domain') or 'single_wall')
     self.do_rotation = str(self.options.get('do_rotation') or 'True')
           
@@ -0,0 +1,141 @@
+''' Unit tests for the trajectory files of read_input. '''
+import unittest
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from config_file import ConfigFile
+from clones_binary_file import ClonesBinaryWriter, read_clones_binary_file
+
+
+class TestConfigFile(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.name = os.path.join(self.directory, 'run.config')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write_frames(self, frames, mode = 'w'):
+    ''' Write the frames, array with shape (Nframes, Nbodies, 7), in the .config format. '''
+    with open(self.name, mode) as f:
+      for frame in frames:
+        f.write(str(frame.shape[0]) + '\n')
+        for x in frame:
+          f.write(' '.join(repr(y) for y in x) + '\n')
+
+  def check_frames(self, frames, cache):
+    ''' Check frame, body, column and line against the frames written. '''
+    config = ConfigFile(self.name, cache = cache)
+    self.assertEqual(config.num_bodies, frames.shape[1])
+    self.assertEqual(config.num_frames, frames.shape[0])
+    for k in range(frames.shape[0]):
+      self.assertTrue(np.array_equal(config.frame(k), frames[k]))
+    for j in range(frames.shape[1]):
+      self.assertTrue(np.array_equal(config.body(j), frames[:, j]))
+      self.assertTrue(np.array_equal(config.body(j, 1, 3), frames[1:3, j]))
+    for c in range(7):
+      self.assertTrue(np.array_equal(config.column(c), frames[:, :, c]))
+      self.assertTrue(np.array_equal(config.column(c, 2), frames[2:, :, c]))
+    self.assertEqual(config.line(1, 1), ' '.join(repr(y) for y in frames[1, 1]))
+    config.close()
+
+  def test_round_trip(self):
+    ''' Read the frames with and without the binary cache, also after appending frames. '''
+    frames = np.random.randn(5, 3, 7)
+    self.write_frames(frames)
+    for cache in [False, True]:
+      self.check_frames(frames, cache)
+    self.assertTrue(os.path.isfile(self.name + '.index.npy'))
+    self.assertTrue(os.path.isfile(self.name + '.columns.npy'))
+
+    # Append frames, the index and the cache are extended
+    new_frames = np.random.randn(4, 3, 7)
+    self.write_frames(new_frames, mode = 'a')
+    mtime = os.path.getmtime(self.name + '.columns.npy') + 1.0
+    os.utime(self.name, (mtime, mtime))
+    frames = np.concatenate([frames, new_frames])
+    for cache in [True, False]:
+      self.check_frames(frames, cache)
+
+  def test_incomplete_frame(self):
+    ''' A frame still being written is not read. '''
+    frames = np.random.randn(3, 4, 7)
+    self.write_frames(frames)
+    with open(self.name, 'a') as f:
+      f.write('4\n1 2 3 1 0 0 0\n')
+    self.check_frames(frames, False)
+
+  def test_different_number_of_bodies(self):
+    ''' The frames must have the same number of bodies. '''
+    self.write_frames(np.random.randn(2, 2, 7))
+    self.write_frames(np.random.randn(1, 12, 7), mode = 'a')
+    self.assertRaises(IOError, ConfigFile, self.name)
+
+
+class TestClonesBinaryFile(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.name = os.path.join(self.directory, 'run.clones.bin')
+    self.structures_ID = ['shell', 'rod']
+    self.body_types = [2, 3]
+    self.location = np.random.randn(6, 5, 3)
+    self.orientation = np.random.randn(6, 5, 4)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write_steps(self, steps, mode = 'w', last_step = None):
+    ''' Write the configurations of the steps. '''
+    writer = ClonesBinaryWriter(self.name, self.structures_ID, self.body_types, mode = mode, last_step = last_step)
+    for step in steps:
+      writer.write(step, self.location[step], self.orientation[step])
+    writer.close()
+
+  def check_steps(self, steps):
+    ''' Check the records of the file against the configurations of the steps. '''
+    header, read_steps, location, orientation = read_clones_binary_file(self.name)
+    self.assertEqual(header['structures_ID'], self.structures_ID)
+    self.assertEqual(list(header['body_offsets']), [0, 2, 5])
+    self.assertTrue(np.array_equal(read_steps, steps))
+    self.assertTrue(np.array_equal(location, self.location[steps]))
+    self.assertTrue(np.array_equal(orientation, self.orientation[steps]))
+
+  def test_round_trip(self):
+    ''' Write, append and read records. '''
+    self.write_steps([0, 1, 2])
+    self.check_steps([0, 1, 2])
+    header, steps, location, orientation = read_clones_binary_file(self.name, 1, 2)
+    self.assertTrue(np.array_equal(steps, [1]))
+    self.assertTrue(np.array_equal(location[0], self.location[1]))
+    self.write_steps([3, 4], mode = 'a')
+    self.check_steps([0, 1, 2, 3, 4])
+    # Mode 'a' creates the file if it does not exist
+    os.remove(self.name)
+    self.write_steps([0, 1], mode = 'a')
+    self.check_steps([0, 1])
+
+  def test_restart(self):
+    ''' Appending with last_step discards the later records and an incomplete record. '''
+    self.write_steps([0, 1, 2, 3, 4])
+    with open(self.name, 'ab') as f:
+      f.write(b'incomplete record')
+    self.write_steps([], mode = 'a')
+    self.check_steps([0, 1, 2, 3, 4])
+    self.write_steps([3, 4, 5], mode = 'a', last_step = 2)
+    self.check_steps([0, 1, 2, 3, 4, 5])
+    self.write_steps([], mode = 'a', last_step = 0)
+    self.check_steps([0])
+
+  def test_different_structures(self):
+    ''' A file can only be appended with the same structures. '''
+    self.write_steps([0])
+    self.assertRaises(IOError, ClonesBinaryWriter, self.name, self.structures_ID, [3, 2], mode = 'a')
+    self.assertRaises(IOError, ClonesBinaryWriter, self.name, ['shell', 'sphere'], self.body_types, mode = 'a')
+
+
+if __name__ == '__main__':
+  unittest.main()
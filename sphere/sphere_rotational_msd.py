@@ -27,6 +27,7 @@ from fluids import mobility as mb
 from quaternion_integrator.quaternion import Quaternion
 from quaternion_integrator.quaternion_integrator import QuaternionIntegrator
 import sphere as sph
+from utils import calc_msd_fft
 from utils import log_time_progress
 from utils import static_var
 from utils import MSDStatistics
@@ -118,10 +119,8 @@ def calc_sphere_msd_from_equilibrium(initial_orientation,
     if trajectory_length*data_interval > n_steps:
       raise Exception('Trajectory length is greater than number of steps.  '
                       'Do a longer run.')
-    lagged_trajectory = []   # Store rotation matrices to avoid re-calculation.
-    lagged_location_trajectory = [] 
-    average_rotational_msd = np.array([np.zeros((dim, dim)) 
-                                       for _ in range(trajectory_length)])
+    sampled_orientations = []
+    sampled_locations = [] 
     for step in range(burn_in + n_steps):
       if scheme == 'FIXMAN':
         integrator.fixman_time_step(dt)
@@ -131,19 +130,8 @@ def calc_sphere_msd_from_equilibrium(initial_orientation,
         integrator.additive_em_time_step(dt)
 
       if (step > burn_in) and (step % data_interval == 0):
-        lagged_trajectory.append(integrator.orientation[0].rotation_matrix())
-        lagged_location_trajectory.append(integrator.location[0])
-
-      if len(lagged_trajectory) > trajectory_length:
-        lagged_trajectory = lagged_trajectory[1:]
-        lagged_location_trajectory = lagged_location_trajectory[1:]
-        for k in range(trajectory_length):
-          current_rot_msd = (calc_total_sphere_msd(
-            lagged_location_trajectory[0],
-            lagged_trajectory[0],
-            lagged_location_trajectory[k],
-            lagged_trajectory[k]))
-          average_rotational_msd[k] += current_rot_msd
+        sampled_orientations.append(np.array(integrator.orientation[0].entries))
+        sampled_locations.append(np.array(integrator.location[0]))
 
       if (step % print_increment == 0 ) and (step > 0): 
         progress_logger.info('At step: %d in run %d of %d' % (step, run + 1, n_runs))
@@ -155,6 +143,16 @@ def calc_sphere_msd_from_equilibrium(initial_orientation,
     progress_logger.info('Integrator Rejection rate: %s' % 
                          (float(integrator.rejections)/
                           float(integrator.rejections + n_steps)))
+    # Average over the time origins 1, ..., num_samples - trajectory_length
+    num_origins = len(sampled_locations) - trajectory_length
+    if num_origins > 0:
+      average_rotational_msd = num_origins * calc_msd_fft(np.array(sampled_locations), 
+                                                          np.array(sampled_orientations), 
+                                                          trajectory_length, 
+                                                          first_origin = 1, 
+                                                          num_origins = num_origins)
+    else:
+      average_rotational_msd = np.zeros((trajectory_length, dim, dim))
     average_rotational_msd = average_rotational_msd/(n_steps/data_interval - trajectory_length)
     rot_msd_list.append(average_rotational_msd)
   
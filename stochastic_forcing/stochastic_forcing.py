@@ -2,6 +2,8 @@
 Module to compute the stochastic forcing (sqrt(2*k_B*T*dt)*M^{1/2}*z) with several algorithms.
 '''
 import numpy as np
+import scipy.linalg
+import scipy.fftpack
 
 def stochastic_forcing_eig(mobility, factor = 1.0, z = None):
   '''
@@ -117,7 +119,8 @@ def stochastic_forcing_lanczos(factor = 1.0,
                                mobility_mult = None,
                                L_mult = None,
                                z = None,
-                               print_residual = False):
+                               print_residual = False,
+                               check_every = 1):
   '''
   Compute the stochastic forcing (factor * M^{1/2} * z) using
   the Lanczos algorithm, see Krylov subspace methods for 
@@ -128,6 +131,12 @@ def stochastic_forcing_lanczos(factor = 1.0,
   The noise generated by this function should be the same 
   (to within tolerance) than the noise generated by the function
   stochastic_forcing_eig_symm.  
+
+  The Krylov basis is stored in a preallocated array (its size is
+  doubled when it is full), it is reorthogonalized with matrix-vector
+  products and the eigenvalues of the tridiagonal matrix are computed
+  with a tridiagonal solver, so the cost per iteration is dominated 
+  by the mobility product.
   
   Input: 
   factor = the prefactor, in general something like sqrt(2*k_B*T*dt)
@@ -135,7 +144,7 @@ def stochastic_forcing_lanczos(factor = 1.0,
   max_iter = maximum number of iterations allowed.
   dim = The dimension of the noise. If it is not passed dim = len(z).
   print_residual = (Optional, default False) If True, it prints the iteration number and the 
-                   residual every iteration.
+                   residual every time the convergence is checked.
   z = (Optional) the random vector.
   mobility = the mobility matrix. You can pass it like a list of lists or
              a list of numpy arrays. It is not used if mobility_mult
@@ -147,6 +156,8 @@ def stochastic_forcing_lanczos(factor = 1.0,
            between the preconditioner matrix L and the noise generated by
            the Lanczos algorithm. L should obey the relation
            M \approx L*L^T.
+  check_every = (Optional, default 1) compute the noise and check the 
+                convergence every check_every iterations.
   
   Output:
   The code returns 
@@ -163,26 +174,27 @@ def stochastic_forcing_lanczos(factor = 1.0,
   if factor == 0.0:
     return (np.zeros(dim), 0)
 
-  # Create matrix v (initial column is random)
+  # Create matrix v (initial row is random)
   # Note: v will have shape (iteration, dim);
   # in the standard notation used in the Lanczos
   # scheme v will be the matrix V^T
+  v = np.empty((min(max_iter + 2, 32), dim))
   if z is None:
-    v = np.random.randn(1, dim)
+    v[0] = np.random.randn(dim)
   else:
-    v = np.copy(np.reshape(z, (1, dim)))
+    v[0] = np.reshape(z, dim)
 
   # Normalize v
   v_norm = np.linalg.norm(v[0])
   v[0] /= v_norm 
 
-  # Create list for the data of the symmetric tridiagonal matrix h 
-  h_sup = []
-  h_diag = []
+  # Create arrays for the data of the symmetric tridiagonal matrix h 
+  h_sup = np.zeros(max_iter + 1)
+  h_diag = np.zeros(max_iter + 1)
 
   # Create vectors noise
   noise = np.zeros(dim) 
-  noise_old = np.zeros(dim) 
+  noise_old = None
 
   # Iterate until convergence or max_iter
   for i in range(max_iter+1):
@@ -197,65 +209,62 @@ def stochastic_forcing_lanczos(factor = 1.0,
       w = w - h_sup[i-1] * v[i-1] 
 
     # h(i, i) = <w, v[i]> 
-    h_diag.append( np.dot(w, v[i]) ) 
+    h_diag[i] = np.dot(w, v[i])
 
     # w = w - h(i, i)*v(i)
-    w = w - h_diag[i] * v[i]
+    w -= h_diag[i] * v[i]
 
     # h(i+1, i) = h(i, i+1) = <w, w>
-    h_sup.append( np.linalg.norm(w) )
+    h_sup[i] = np.linalg.norm(w)
 
     # w = w/normw;
     if h_sup[i] > 0:
       w /= h_sup[i]
     else:
       w[0] = 1.0;
-    
-    # Build tridiagonal matrix h
-    h = h_diag * np.eye(len(h_diag)) + h_sup * np.eye(len(h_sup), k=-1) + (h_sup * np.eye(len(h_sup), k=-1)).T
 
-    # Compute eigenvalues and eigenvectors of h
-    # IMPORTANT: this is NOT optimized for tridiagonal matrices
-    eig_values, eig_vectors = np.linalg.eigh(h)
+    if i % check_every == 0 or i == max_iter:
+      # Compute eigenvalues and eigenvectors of h
+      eig_values, eig_vectors = scipy.linalg.eigh_tridiagonal(h_diag[0:i+1], h_sup[0:i])
 
-    # Compute the square root of positive eigenvalues set to zero otherwise
-    eig_values_sqrt = np.array([np.sqrt(x) if x > 0 else 0 for x in eig_values])
-    
-    # Create vector e_1
-    e_1 = np.zeros(len(eig_values))
-    e_1[0] = 1.0
+      # Compute the square root of positive eigenvalues set to zero otherwise
+      eig_values_sqrt = np.sqrt(np.maximum(eig_values, 0))
 
-    # Compute noise approximation as in Eq. 16 of Ando et al. 2012
-    noise = np.dot(v.T, np.dot(eig_vectors, v_norm * factor * eig_values_sqrt * np.dot(eig_vectors.T, e_1)))
+      # Compute noise approximation as in Eq. 16 of Ando et al. 2012,
+      # note that eig_vectors.T * e_1 = eig_vectors[0]
+      noise = np.dot(np.dot(eig_vectors, v_norm * factor * eig_values_sqrt * eig_vectors[0]), v[0:i+1])
 
-    # Orthogonalize base with modified Gram-Schmidt;
+    # Orthogonalize base with two passes of classical Gram-Schmidt;
     # we use that norm(v[i])=norm(w)=1
-    for row in v:
-      w = w - (np.dot(row, w)) * row 
-
-    # v(i+1) = w
-    v = np.concatenate([v, [w]])
-
-    if i > 0:
-      # Compute difference with noise of previous iteration
-      noise_old_norm = np.linalg.norm(noise_old)
-      diff_norm = np.linalg.norm(noise - noise_old)
-
-      # (Optional) Print residual
-      if i > 0 and print_residual is True:
-        if i == 1:
-          print 'lanczos =  0 1' 
-        print 'lanczos = ', i, diff_norm / noise_old_norm
-
-      # Check convergence and return if difference < tolerance
-      if diff_norm / np.maximum(noise_old_norm, np.finfo(float).eps) < tolerance:
-        if L_mult is None:
-          return (noise, i)
-        else:
-          return (np.reshape(L_mult(noise), dim), i)
+    for k in range(2):
+      w -= np.dot(np.dot(v[0:i+1], w), v[0:i+1])
+
+    # v(i+1) = w, double the size of v if it is full
+    if i + 1 == v.shape[0]:
+      v = np.concatenate([v, np.empty((min(v.shape[0], max_iter + 2 - v.shape[0]), dim))])
+    v[i+1] = w
+
+    if i % check_every == 0:
+      if noise_old is not None:
+        # Compute difference with noise of previous check
+        noise_old_norm = np.linalg.norm(noise_old)
+        diff_norm = np.linalg.norm(noise - noise_old)
+
+        # (Optional) Print residual
+        if print_residual is True:
+          if i == check_every:
+            print 'lanczos =  0 1' 
+          print 'lanczos = ', i, diff_norm / noise_old_norm
+
+        # Check convergence and return if difference < tolerance
+        if diff_norm / np.maximum(noise_old_norm, np.finfo(float).eps) < tolerance:
+          if L_mult is None:
+            return (noise, i)
+          else:
+            return (np.reshape(L_mult(noise), dim), i)
           
-    # Save noise to check convergence in the next iteration
-    noise_old = np.copy(noise)
+      # Save noise to check convergence in the next check
+      noise_old = noise
 
   # Return UNCONVERGED noise
   if L_mult is None:
@@ -264,3 +273,267 @@ def stochastic_forcing_lanczos(factor = 1.0,
     return (np.reshape(L_mult(noise), dim), max_iter)
 
 
+def lanczos_eigenvalue_bounds(dim, 
+                              mobility = None, 
+                              mobility_mult = None, 
+                              num_iter = 20):
+  '''
+  Estimate the bounds of the spectrum of the symmetric positive
+  definite mobility M with num_iter iterations of the Lanczos
+  algorithm. The extreme Ritz values are widened with their
+  residuals (the lower bound is at most reduced by half and 
+  the upper bound is increased at least a 5%). This is only an 
+  estimate, the extreme eigenvalues can be outside the bounds; 
+  see chebyshev_eigenvalue_bounds to check them.
+
+  The initial vector is generated with its own random generator
+  so the state of np.random is not modified.
+
+  Input:
+  dim = The dimension of the mobility.
+  mobility = the mobility matrix. It is not used if mobility_mult
+             is passed (see below).
+  mobility_mult = function that computes a matrix vector product 
+                  with the mobility matrix.
+  num_iter = number of Lanczos iterations.
+
+  Output:
+  (lambda_min, lambda_max) = bounds of the spectrum.
+  '''
+  num_iter = min(num_iter, dim)
+  v = np.empty((num_iter + 1, dim))
+  v[0] = np.random.RandomState(1).randn(dim)
+  v[0] /= np.linalg.norm(v[0])
+  h_diag = np.zeros(num_iter)
+  h_sup = np.zeros(num_iter)
+  for i in range(num_iter):
+    # w = mobility * v[i]
+    if mobility is None:
+      w = np.reshape(mobility_mult(v[i]), dim)
+    else:
+      w = np.dot(mobility, v[i])
+    if i > 0:
+      w = w - h_sup[i-1] * v[i-1] 
+    h_diag[i] = np.dot(w, v[i])
+    # Orthogonalize against the whole basis
+    for k in range(2):
+      w -= np.dot(np.dot(v[0:i+1], w), v[0:i+1])
+    h_sup[i] = np.linalg.norm(w)
+    # Stop if the Krylov subspace is invariant
+    if h_sup[i] <= np.finfo(float).eps * np.abs(h_diag[0:i+1]).max():
+      num_iter = i + 1
+      break
+    v[i+1] = w / h_sup[i]
+
+  # Compute Ritz values and their residuals
+  eig_values, eig_vectors = scipy.linalg.eigh_tridiagonal(h_diag[0:num_iter], h_sup[0:num_iter-1])
+  residuals = h_sup[num_iter-1] * np.abs(eig_vectors[-1])
+  lambda_min = max(eig_values[0] - residuals[0], 0.5 * eig_values[0])
+  lambda_max = max(eig_values[-1] + residuals[-1], 1.05 * eig_values[-1])
+  return (lambda_min, lambda_max)
+
+
+def chebyshev_sqrt_coefficients(eig_bounds, tolerance = 1e-06, max_iter = 1000):
+  '''
+  Compute the coefficients of the Chebyshev approximation of sqrt(x)
+  in the interval eig_bounds = (lambda_min, lambda_max). The series
+  is truncated so the neglected coefficients are smaller than tolerance
+  (relative to the first one), the degree is at most max_iter.
+  The coefficients are computed with a discrete cosine transform.
+
+  Output:
+  coefficients = array with the degree + 1 coefficients.
+  '''
+  lambda_min, lambda_max = eig_bounds
+  lambda_max = max(lambda_max, lambda_min * (1.0 + 1e-08))
+
+  # c_j = (2/n) * sum_k f(x_k) * cos(j * theta_k) with x_k the Chebyshev nodes
+  n = max_iter + 1
+  theta = np.pi * (np.arange(n) + 0.5) / n
+  f = np.sqrt(0.5 * (lambda_max - lambda_min) * np.cos(theta) + 0.5 * (lambda_max + lambda_min))
+  c = scipy.fftpack.dct(f, type=2) / n
+  c[0] *= 0.5
+
+  # Select degree, tail[k] = sum_{j >= k} |c_j|
+  tail = np.append(np.cumsum(np.abs(c[::-1]))[::-1], 0.0)
+  degree = np.argmax(tail < tolerance * c[0]) - 1
+  if degree < 0:
+    degree = max_iter
+  return c[0 : degree + 1]
+
+
+def chebyshev_sqrt_mult(mult, z, coefficients, eig_bounds):
+  '''
+  Compute p(M) * z with p the Chebyshev polynomial with coefficients 
+  in the interval eig_bounds, mult(x) computes M * x.
+  '''
+  lambda_min, lambda_max = eig_bounds
+  lambda_max = max(lambda_max, lambda_min * (1.0 + 1e-08))
+
+  # Three terms recurrence T_{k+1} = 2*X*T_k - T_{k-1}
+  # with X = (2*M - (lambda_max + lambda_min)) / (lambda_max - lambda_min)
+  alpha = 2.0 / (lambda_max - lambda_min)
+  beta = (lambda_max + lambda_min) / (lambda_max - lambda_min)
+  T_old = z
+  result = coefficients[0] * z
+  if coefficients.size > 1:
+    T = alpha * mult(z) - beta * z
+    result += coefficients[1] * T
+  for k in range(2, coefficients.size):
+    T, T_old = 2.0 * (alpha * mult(T) - beta * T) - T_old, T
+    result += coefficients[k] * T
+  return result
+
+
+def chebyshev_eigenvalue_bounds(dim, 
+                                mobility = None, 
+                                mobility_mult = None, 
+                                tolerance = 1e-06, 
+                                max_iter = 1000,
+                                num_iter = 20,
+                                max_tries = 3):
+  '''
+  Compute bounds of the spectrum of M for the Chebyshev method 
+  and check them. The bounds are estimated with lanczos_eigenvalue_bounds,
+  but the Ritz values are inside the spectrum and the
+  Chebyshev approximation is not accurate for eigenvalues below 
+  lambda_min or above lambda_max. Therefore, for a random vector z we 
+  compare the Chebyshev approximation of M^{1/2} * z with the one computed 
+  with Lanczos (with tolerance / 100); if the relative difference is 
+  larger than tolerance the interval is widened, lambda_min is reduced
+  by a factor 10 and lambda_max increased by a factor 1.1, and the check 
+  is repeated, at most max_tries times.
+
+  Input:
+  dim = The dimension of the mobility.
+  mobility = the mobility matrix. It is not used if mobility_mult
+             is passed (see below).
+  mobility_mult = function that computes a matrix vector product 
+                  with the mobility matrix.
+  tolerance = the tolerance to determine the degree of the polynomial.
+  max_iter = maximum degree of the polynomial.
+  num_iter = number of Lanczos iterations to estimate the bounds.
+  max_tries = number of checks.
+
+  Output:
+  (eig_bounds, coefficients) = the bounds and the Chebyshev coefficients
+  of sqrt(x) in them, or (None, None) if the check failed.
+  '''
+  if mobility is None:
+    mult = lambda x: np.reshape(mobility_mult(x), dim)
+  else:
+    mult = lambda x: np.dot(mobility, x)
+  lambda_min, lambda_max = lanczos_eigenvalue_bounds(dim, mobility = mobility, mobility_mult = mobility_mult, num_iter = num_iter)
+
+  # Reference noise, the vector z has its own random generator 
+  # so the state of np.random is not modified
+  z = np.random.RandomState(2).randn(dim)
+  noise_lanczos, it = stochastic_forcing_lanczos(tolerance = 0.01 * tolerance, max_iter = max_iter, dim = dim, mobility = mobility,
+                                                 mobility_mult = mobility_mult, z = np.copy(z))
+  for i in range(max_tries):
+    coefficients = chebyshev_sqrt_coefficients((lambda_min, lambda_max), tolerance = tolerance, max_iter = max_iter)
+    if coefficients.size > max_iter:
+      break
+    noise = chebyshev_sqrt_mult(mult, z, coefficients, (lambda_min, lambda_max))
+    if np.linalg.norm(noise - noise_lanczos) <= tolerance * np.linalg.norm(noise_lanczos):
+      return ((lambda_min, lambda_max), coefficients)
+    lambda_min *= 0.1
+    lambda_max *= 1.1
+  return (None, None)
+
+
+def stochastic_forcing_chebyshev(factor = 1.0, 
+                                 tolerance = 1e-06, 
+                                 max_iter = 1000, 
+                                 dim = None, 
+                                 mobility = None, 
+                                 mobility_mult = None,
+                                 L_mult = None,
+                                 z = None,
+                                 eig_bounds = None,
+                                 coefficients = None,
+                                 print_residual = False):
+  '''
+  Compute the stochastic forcing (factor * M^{1/2} * z) approximating
+  the square root with a Chebyshev polynomial in the interval 
+  eig_bounds = (lambda_min, lambda_max) that contains the spectrum
+  of M, see M. Fixman, Macromolecules 19, 1204 (1986).
+  The degree of the polynomial is chosen so the truncated
+  coefficients are smaller than tolerance (relative to the first one).
+
+  Unlike Lanczos the memory used does not grow with the number
+  of iterations and z can have shape (dim, number_of_vectors) to 
+  generate several noises at once if mobility_mult accepts
+  arrays with that shape.
+  
+  Input: 
+  factor = the prefactor, in general something like sqrt(2*k_B*T*dt)
+  tolerance = the tolerance to determine the degree of the polynomial.
+  max_iter = maximum degree of the polynomial.
+  dim = The dimension of the noise. If it is not passed dim = len(z).
+  print_residual = (Optional, default False) If True, it prints the degree
+                   of the polynomial.
+  z = (Optional) the random vector.
+  mobility = the mobility matrix. It is not used if mobility_mult
+             is passed (see below).
+  mobility_mult = function that computes a matrix vector product 
+                  with the mobility matrix. 
+  L_mult = function that computes a matrix vector product 
+           between the preconditioner matrix L and the noise.
+           L should obey the relation M \approx L*L^T.
+  eig_bounds = (Optional) bounds of the spectrum of M. If it is 
+               not passed they are computed and checked with 
+               chebyshev_eigenvalue_bounds; if the check fails
+               the noise is computed with stochastic_forcing_lanczos.
+  coefficients = (Optional) the Chebyshev coefficients in eig_bounds, 
+                 see chebyshev_sqrt_coefficients. Pass them to avoid
+                 computing them in every call.
+  
+  Output:
+  The code returns 
+  (stochastic_forcing, iterations) 
+  with
+  stochastic_forcing = (factor * M^{1/2} * z)
+  iterations = degree of the polynomial, i.e. number of products with M.
+  '''
+
+  # Define array dimension 
+  if dim is None:
+    dim = len(z)
+  if z is None:
+    z = np.random.randn(dim)
+
+  if factor == 0.0:
+    return (np.zeros(z.shape), 0)
+
+  # Define matrix vector product
+  if mobility is None:
+    mult = lambda x: np.reshape(mobility_mult(x), x.shape)
+  else:
+    mult = lambda x: np.dot(mobility, x)
+
+  # Get spectrum bounds and coefficients
+  if eig_bounds is None:
+    eig_bounds, coefficients = chebyshev_eigenvalue_bounds(dim, mobility = mobility, mobility_mult = mobility_mult, tolerance = tolerance, max_iter = max_iter)
+    if eig_bounds is None:
+      # Use Lanczos
+      if z.ndim == 1:
+        return stochastic_forcing_lanczos(factor = factor, tolerance = tolerance, max_iter = max_iter, dim = dim, mobility = mobility, 
+                                          mobility_mult = mobility_mult, L_mult = L_mult, z = z, print_residual = print_residual)
+      noise = [stochastic_forcing_lanczos(factor = factor, tolerance = tolerance, max_iter = max_iter, dim = dim, mobility = mobility, 
+                                          mobility_mult = mobility_mult, L_mult = L_mult, z = np.copy(x), print_residual = print_residual) for x in z.T]
+      return (np.array([x[0] for x in noise]).T, sum([x[1] for x in noise]))
+  if coefficients is None:
+    coefficients = chebyshev_sqrt_coefficients(eig_bounds, tolerance = tolerance, max_iter = max_iter)
+  degree = coefficients.size - 1
+  if print_residual is True:
+    print 'chebyshev = ', degree
+
+  noise = factor * chebyshev_sqrt_mult(mult, z, coefficients, eig_bounds)
+
+  if L_mult is None:
+    return (noise, degree)
+  elif noise.ndim == 1:
+    return (np.reshape(L_mult(noise), dim), degree)
+  else:
+    return (np.array([np.reshape(L_mult(np.copy(x)), dim) for x in noise.T]).T, degree)
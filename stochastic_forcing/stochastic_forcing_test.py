@@ -0,0 +1,62 @@
+''' Unit tests for the stochastic forcing functions. '''
+import unittest
+import numpy as np
+
+import stochastic_forcing as stoch
+
+
+class TestStochasticForcing(unittest.TestCase):
+
+  def setUp(self):
+    pass
+
+  def spd_matrix(self, eig_values):
+    ''' Symmetric positive definite matrix with the given eigenvalues. '''
+    Q, R = np.linalg.qr(np.random.randn(eig_values.size, eig_values.size))
+    M = np.dot(Q * eig_values, Q.T)
+    return 0.5 * (M + M.T)
+
+  def test_chebyshev(self):
+    ''' Compare the Chebyshev noise with stochastic_forcing_eig_symm for
+    well and badly conditioned matrices, in the second case the Lanczos
+    bounds overestimate the smallest eigenvalue or the noise is
+    computed with Lanczos.'''
+    for eig_values in [np.linspace(1.0, 10.0, 300), np.logspace(0, 5, 300), np.linspace(1.0, 1e+05, 300)]:
+      M = self.spd_matrix(eig_values)
+      z = np.random.randn(eig_values.size)
+      noise_eig = stoch.stochastic_forcing_eig_symm(M, factor = 2.0, z = z)
+      noise, it = stoch.stochastic_forcing_chebyshev(factor = 2.0, tolerance = 1e-06, mobility = M, z = np.copy(z))
+      self.assertTrue(np.linalg.norm(noise - noise_eig) < 5e-05 * np.linalg.norm(noise_eig))
+
+  def test_chebyshev_coefficients(self):
+    ''' Test that the cached coefficients give the same noise and
+    that several noises can be computed at once.'''
+    M = self.spd_matrix(np.linspace(1.0, 100.0, 200))
+    z = np.random.randn(200, 3)
+    eig_bounds, coefficients = stoch.chebyshev_eigenvalue_bounds(200, mobility = M, tolerance = 1e-08)
+    self.assertTrue(eig_bounds is not None)
+    noise, it = stoch.stochastic_forcing_chebyshev(tolerance = 1e-08, mobility = M, z = z, eig_bounds = eig_bounds)
+    noise_cached, it_cached = stoch.stochastic_forcing_chebyshev(tolerance = 1e-08, mobility = M, z = z,
+                                                                 eig_bounds = eig_bounds, coefficients = coefficients)
+    self.assertEqual(it, coefficients.size - 1)
+    self.assertEqual(it_cached, it)
+    self.assertTrue(np.allclose(noise_cached, noise, rtol = 1e-14, atol = 0))
+    for k in range(3):
+      noise_eig = stoch.stochastic_forcing_eig_symm(M, z = z[:, k])
+      self.assertTrue(np.linalg.norm(noise[:, k] - noise_eig) < 1e-07 * np.linalg.norm(noise_eig))
+
+  def test_chebyshev_bounds_fallback(self):
+    ''' If the degree needed is larger than max_iter the bounds are
+    rejected and the noise is computed with Lanczos.'''
+    M = self.spd_matrix(np.logspace(0, 5, 100))
+    z = np.random.randn(100)
+    eig_bounds, coefficients = stoch.chebyshev_eigenvalue_bounds(100, mobility = M, tolerance = 1e-06, max_iter = 50)
+    self.assertTrue(eig_bounds is None and coefficients is None)
+    noise, it = stoch.stochastic_forcing_chebyshev(tolerance = 1e-06, max_iter = 50, mobility = M, z = np.copy(z))
+    noise_lanczos, it_lanczos = stoch.stochastic_forcing_lanczos(tolerance = 1e-06, max_iter = 50, mobility = M, z = np.copy(z))
+    self.assertTrue(np.allclose(noise, noise_lanczos, rtol = 1e-14, atol = 0))
+    self.assertEqual(it, it_lanczos)
+
+
+if __name__ == '__main__':
+  unittest.main()
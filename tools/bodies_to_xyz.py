@@ -22,6 +22,7 @@ from body import body
 from read_input import read_input
 from read_input import read_vertex_file
 from read_input import read_clones_file
+from read_input import config_file
 
 
 if __name__ == '__main__':
@@ -29,12 +30,11 @@ if __name__ == '__main__':
   # 
   input_file = sys.argv[1]
   name_ID = sys.argv[2]
-  config_file = sys.argv[3]
+  config_name = sys.argv[3]
   
   # Read input file
   read = read_input.ReadInput(input_file)
   a = read.blob_radius
-  structure_names = read.structure_names
   n_steps = read.n_steps
   n_save = read.n_save
 
@@ -60,25 +60,25 @@ if __name__ == '__main__':
   num_blobs = sum([x.Nblobs for x in bodies]) 
 
   # Read configuration 
-  with open(config_file, 'r') as f: 
-    for step in range(n_steps / n_save + 1): 
-      # Read bodies
-      data = f.readline()
-      if data == '' or data.isspace():
-        break
+  f = config_file.ConfigFile(config_name)
+  for step in range(min(f.num_frames, n_steps / n_save + 1)): 
+    # Read bodies
+    data = f.frame(step)
       
-      print num_blobs_ID
-      print '#'
-      r_vectors = []
-      for k, b in enumerate(bodies):
-        if b.ID == name_ID:
-          data = f.readline().split()
-          b.location = [float(data[0]), float(data[1]), float(data[2])]
-          b.orientation = Quaternion([float(data[3]), float(data[4]), float(data[5]), float(data[6])])
-          r_vectors.append(b.get_r_vectors())
-      r_vectors = np.array(r_vectors)
-      r_vectors = np.reshape(r_vectors, (r_vectors.size / 3, 3))
-      for i in range(len(r_vectors)):
-        print  name_ID[0].upper() + ' ' + str(r_vectors[i,0]) + ' ' + str(r_vectors[i,1]) + ' ' + str(r_vectors[i,2]) 
+    print num_blobs_ID
+    print '#'
+    r_vectors = []
+    i = 0
+    for k, b in enumerate(bodies):
+      if b.ID == name_ID:
+        b.location = data[i, 0:3]
+        b.orientation = Quaternion(data[i, 3:7])
+        r_vectors.append(b.get_r_vectors())
+        i += 1
+    r_vectors = np.array(r_vectors)
+    r_vectors = np.reshape(r_vectors, (r_vectors.size / 3, 3))
+    for i in range(len(r_vectors)):
+      print  name_ID[0].upper() + ' ' + str(r_vectors[i,0]) + ' ' + str(r_vectors[i,1]) + ' ' + str(r_vectors[i,2])
+  f.close() 
 
 
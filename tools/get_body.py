@@ -1,5 +1,7 @@
 '''
 Extract one body trajectory from configurational files.
+The first call builds an index of the file (file_name.index.npy),
+so later calls read only the lines of the body.
 
 How to use:
 python get_body.py file_name num_bodies body_number dt
@@ -8,6 +10,9 @@ from __future__ import division, print_function
 import numpy as np
 import sys
 
+sys.path.append('../')
+from read_input import config_file
+
 
 if __name__ == '__main__':
   # Read input
@@ -16,16 +21,10 @@ if __name__ == '__main__':
   body = int(sys.argv[3])
   dt = float(sys.argv[4])
 
-  with open(name, 'r') as f:
-    count = num_bodies
-    step = -1
-    for line in f:
-      if count == num_bodies:
-        step += 1
-        time = step * dt
-        count = 0
-      else:
-        if count == body:
-          data = line.split()
-          print(time, line.strip())
-        count += 1
+  f = config_file.ConfigFile(name)
+  if f.num_bodies != num_bodies:
+    print('Error, the file', name, 'has', f.num_bodies, 'bodies per frame')
+    sys.exit()
+  for step in range(f.num_frames):
+    print(step * dt, f.line(step, body))
+  f.close()
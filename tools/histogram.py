@@ -1,8 +1,21 @@
+'''
+Compute the normalized histogram of one column of a data file.
+
+How to use:
+python histogram.py file_name column start end num_intervals
+
+For .config files (save_clones one_file) the column (0 = x, ..., 6 = p3)
+of all the bodies is read from the binary cache file_name.columns.npy,
+that is created the first time, see read_input/config_file.py.
+'''
 from __future__ import division, print_function
 import numpy as np
 import sys
 import mmap
 
+sys.path.append('../')
+from read_input import config_file
+
 if __name__ == '__main__':
   # Init variables
   name_file = sys.argv[1]
@@ -14,21 +27,29 @@ if __name__ == '__main__':
   histogram = np.zeros(num_intervales)
   comment_symbols = ['#']   
 
-  # Read file to memory
-  with open(name_file, 'r') as f:
-    f_read = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
-    
-    # Read file and create histogram
-    for line_b in iter(f_read.readline, b''):
-      line = line_b.decode()
-      # Strip comments
-      if comment_symbols[0] in line:
-        line, comment = line.split(comment_symbols[0], 1)
-      else:
-        data = line.split()
-        n = int((float(data[use_column]) - start) / dx)
-        if n < num_intervales and n >= 0:
-          histogram[n] += 1
+  if name_file.endswith('.config'):
+    # Read column from the binary cache
+    f = config_file.ConfigFile(name_file, cache = True)
+    n = ((f.column(use_column) - start) / dx).astype(int)
+    n = n[np.logical_and(n >= 0, n < num_intervales)]
+    histogram += np.bincount(n, minlength=num_intervales)
+    f.close()
+  else:
+    # Read file to memory
+    with open(name_file, 'r') as f:
+      f_read = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+
+      # Read file and create histogram
+      for line_b in iter(f_read.readline, b''):
+        line = line_b.decode()
+        # Strip comments
+        if comment_symbols[0] in line:
+          line, comment = line.split(comment_symbols[0], 1)
+        else:
+          data = line.split()
+          n = int((float(data[use_column]) - start) / dx)
+          if n < num_intervales and n >= 0:
+            histogram[n] += 1
 
 
   # Print histogram
@@ -8,10 +8,14 @@ try:
 except ImportError:
    pass
 import numpy as np
+import scipy.linalg
 import scipy.sparse.linalg as scspla
 import os
 import sys
 import time
+import atexit
+import threading
+import Queue
 from functools import partial
 
 
@@ -46,6 +50,69 @@ class Tee(object):
         for f in self.files:
             f.flush()
 
+class AsyncWriter(object):
+  '''
+  Run the output functions in a background thread so the disk
+  and the string formatting overlap with the computations.
+
+  The tasks are stored in a queue with at most max_tasks tasks,
+  put blocks while the queue is full. The arguments of the tasks
+  should be snapshots (copies) of the state. An exception raised by 
+  a task is raised again in the main thread by the next call to put
+  or close. close waits until all the tasks are done, it is also 
+  called at exit. If max_tasks is 0 the tasks are run by put.
+  '''
+  def __init__(self, max_tasks = 4):
+    self.error = None
+    self.queue = None
+    if max_tasks > 0:
+      self.queue = Queue.Queue(max_tasks)
+      self.thread = threading.Thread(target = self.run)
+      self.thread.daemon = True
+      self.thread.start()
+      atexit.register(self.close)
+
+  def run(self):
+    while True:
+      task = self.queue.get()
+      if task is None:
+        return
+      # After an error the remaining tasks are discarded
+      if self.error is None:
+        try:
+          task[0](*task[1], **task[2])
+        except Exception:
+          self.error = sys.exc_info()
+
+  def put(self, function, *args, **kwargs):
+    '''
+    Add the task function(*args, **kwargs) to the queue.
+    '''
+    self.check()
+    if self.queue is None:
+      function(*args, **kwargs)
+    else:
+      self.queue.put((function, args, kwargs))
+
+  def check(self):
+    '''
+    Raise the exception of a failed task.
+    '''
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error[0], error[1], error[2]
+
+  def close(self):
+    '''
+    Wait until all the tasks are done and stop the thread.
+    '''
+    if self.queue is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.queue = None
+    self.check()
+
+
 # Static Variable decorator for calculating acceptance rate.
 def static_var(varname, value):
     def decorate(func):
@@ -252,86 +319,133 @@ def calc_msd_data_from_trajectory(locations, orientations, calc_center_function,
     trajectory_length:  How many points to keep in the window 0 to end.
               The code will process every n steps to make the total 
               number of analyzed points roughly this value.
+
+  The MSD is computed with calc_msd_fft using as time origins the
+  sampled steps 1, ..., num_samples - trajectory_length.
  '''
+  from quaternion_integrator.quaternion import Quaternion
   data_interval = int(end/dt/trajectory_length) + 1
   print "data_interval is ", data_interval
   n_steps = len(locations)
-  e_1 = np.array([1., 0., 0.])
-  e_2 = np.array([0., 1., 0.])
-  e_3 = np.array([0., 0., 1.])
 
   if trajectory_length*data_interval > n_steps:
     raise Exception('Trajectory length is longer than the total run. '
                     'Perform a longer run, or choose a shorter end time.')
-  print_increment = int(n_steps/20)
-  average_rotational_msd = np.array([np.zeros((6, 6)) 
-                                     for _ in range(trajectory_length)])
-  lagged_rotation_trajectory = []
-  lagged_location_trajectory = []
-  start_time = time.time()
-  for k in range(n_steps):
-    if k > burn_in and (k % data_interval == 0):
-       orientation = Quaternion(orientations[k])
-       R = orientation.rotation_matrix()
-       u_hat = [np.inner(R, e_1),
-                np.inner(R, e_2),
-                np.inner(R,e_3)]
-       lagged_rotation_trajectory.append(u_hat)
-       lagged_location_trajectory.append(calc_center_function(locations[k], orientation))
-    if len(lagged_location_trajectory) > trajectory_length:
-      lagged_location_trajectory = lagged_location_trajectory[1:]
-      lagged_rotation_trajectory = lagged_rotation_trajectory[1:]
-      for l in range(trajectory_length):
-        current_rot_msd = (calc_total_msd_from_matrix_and_center(
-           lagged_location_trajectory[0],
-           lagged_rotation_trajectory[0],
-           lagged_location_trajectory[l],
-           lagged_rotation_trajectory[l]))
-        average_rotational_msd[l] += current_rot_msd
-    if (k % print_increment) == 0 and k > 0:
-       print 'At step %s of %s' % (k, n_steps)
-       print 'For this run, time status is:'
-       elapsed = time.time() - start_time
-       log_time_progress(elapsed, k, n_steps)
 
+  # Sample trajectory
+  samples = np.arange(data_interval * (burn_in // data_interval + 1), n_steps, data_interval)
+  centers = np.array([calc_center_function(locations[k], Quaternion(orientations[k])) for k in samples]).reshape((samples.size, 3))
+  quaternions = np.array([orientations[k] for k in samples], dtype=float).reshape((samples.size, 4))
+
+  # Average over time origins
+  num_origins = samples.size - trajectory_length
+  if num_origins > 0:
+    average_rotational_msd = num_origins * calc_msd_fft(centers, quaternions, trajectory_length, 
+                                                        first_origin = 1, num_origins = num_origins)
+  else:
+    average_rotational_msd = np.zeros((trajectory_length, 6, 6))
   average_rotational_msd = (average_rotational_msd/
                             (n_steps/data_interval - trajectory_length - 
                              burn_in/data_interval))
   
   return average_rotational_msd
+
+
+def calc_msd_fft(locations, orientations, num_lags, first_origin = 0, num_origins = None):
+  ''' 
+  Calculate the (6x6) translational and rotational MSD for the lags
+  0, ..., num_lags-1 (in units of the sampling interval) from the 
+  locations, shape (T, 3), and orientations (quaternions), shape (T, 4),
+  of a rigid body. For the lag l it returns the average over the
+  time origins t of d * d^T with
+
+  d = (x(t+l) - x(t), 0.5 * sum_i u_i(t) x u_i(t+l)),
+
+  where u_i(t) is the axis i of the body, i.e. the same displacement 
+  that calc_total_msd_from_matrix_and_center.
+
+  If num_origins is None all the time origins are used, T - l for the lag l,
+  otherwise the origins first_origin, ..., first_origin + num_origins - 1.
+  All the sums over time origins are correlations computed with FFTs, 
+  the cost is O(T * log(T)).
+  '''
+  from quaternion_integrator.quaternion import rotation_matrix_array
+  T = locations.shape[0]
+  if num_origins is None:
+    w = np.ones(T)
+    counts = np.arange(T, T - num_lags, -1, dtype=float)
+  else:
+    if first_origin + num_origins + num_lags - 1 > T:
+      raise Exception('Not enough samples for num_origins and num_lags.')
+    w = np.zeros(T)
+    w[first_origin : first_origin + num_origins] = 1.0
+    counts = np.ones(num_lags) * num_origins
+
+  # The MSD does not depend on the mean location, remove it to reduce round-off errors
+  x = locations - np.mean(locations, axis=0)
+  R = rotation_matrix_array(np.asarray(orientations, dtype=float).reshape((T, 4)))
+
+  # corr(f, g)[l] = sum_t w(t) * f(t) * g(t+l) with the subscripts to multiply f and g
+  n = 2**int(np.ceil(np.log2(T + num_lags)))
+  def corr(subscripts, f, g):
+    f_fft = np.fft.rfft(w.reshape((T,) + (1,) * (f.ndim - 1)) * f, n, axis=0)
+    g_fft = np.fft.rfft(g, n, axis=0)
+    return np.fft.irfft(np.einsum(subscripts, np.conj(f_fft), g_fft), n, axis=0)[0:num_lags]
+
+  # Translational part, sum of x(t+l)x(t+l)^T + x(t)x(t)^T - x(t)x(t+l)^T - x(t+l)x(t)^T
+  xx = x[:, :, None] * x[:, None, :]
+  cross = corr('ta,tb->tab', x, x)
+  msd = np.zeros((num_lags, 6, 6))
+  msd[:, 0:3, 0:3] = corr('t,tab->tab', np.ones(T), xx) + corr('tab,t->tab', xx, np.ones(T)) - cross - np.transpose(cross, (0, 2, 1))
+
+  # Rotational part, du_a = 0.5 * e_abc * sum_i R_bi(t) * R_ci(t+l)
+  e = np.zeros((3, 3, 3))
+  e[0, 1, 2] = e[1, 2, 0] = e[2, 0, 1] = 1.0
+  e[0, 2, 1] = e[2, 1, 0] = e[1, 0, 2] = -1.0
+  RR = R[:, :, None, :, None] * R[:, None, :, None, :]
+  C = corr('tbeij,tcfij->tbecf', RR, RR)
+  msd[:, 3:6, 3:6] = 0.25 * np.einsum('abc,def,lbecf->lad', e, e, C)
+
+  # Cross part, sum of (x(t+l) - x(t))_a * du_d
+  xR = x[:, :, None, None] * R[:, None, :, :]
+  B = corr('tej,tafj->taef', R, xR) - corr('taej,tfj->taef', xR, R)
+  msd[:, 0:3, 3:6] = 0.5 * np.einsum('def,laef->lad', e, B)
+  msd[:, 3:6, 0:3] = np.transpose(msd[:, 0:3, 3:6], (0, 2, 1))
+  return msd / counts[:, None, None]
    
 
 def fft_msd(x, y, end):
-  ''' Calculate scalar MSD between x and yusing FFT. 
-  We want D(tau) = sum(  (x(t+tau) -x(t))*(y(t+tau) - y(t)) )
-  This is computed with
+  ''' Calculate scalar MSD between x and y using FFT. 
+  We want D(tau) = mean(  (x(t+tau) -x(t))*(y(t+tau) - y(t)) )
+  averaged over the len(x) - tau time origins t. This is computed with
 
-  D(tau) = sum(x(t)y(t)) + sum(x(t+tau)y(t+tau) - sum(x(t)*x(t+tau)
+  D(tau) = sum(x(t)y(t)) + sum(x(t+tau)y(t+tau)) - sum(x(t)*y(t+tau))
            - sum(y(t)x(t+tau))
  
   Where the last 2 sums are performed using an FFT.
   We expect that x and y are the same length.
-
-  WARNING: THIS IS NOT CURRENTLY USED OR TESTED THOROUGHLY'''
+  It returns D(tau) for tau = 0, ..., end-1.'''
 
   if len(x) != len(y):
     raise Exception('Length of X and Y are not the same, aborting MSD '
                     'FFT calculation.')
-  xy_sum_tau = np.cumsum(x[::-1]*y[::-1])[::-1]/np.arange(len(x), 0, -1)
-  xy_sum_t   = np.cumsum(x*y)[::-1]/np.arange(len(x), 0, -1)
-
-  x_fft = np.fft.fft(x)
-  y_fft = np.fft.fft(y)
-  x_fft_xy = np.zeros(len(x))
-  x_fft_yx = np.zeros(len(x))
-  x_fft_xy[1:] = (x_fft[1:])*(y_fft[:0:-1])
-  x_fft_xy[0] = x_fft[0]*y_fft[0]
-  x_fft_yx[1:] = (y_fft[1:])*(x_fft[:0:-1])
-  x_fft_yx[0] = x_fft[0]*y_fft[0]
-  x_ifft_xy = np.fft.ifft(x_fft_xy)/np.arange(len(x), 0, -1)
-  x_ifft_yx = np.fft.ifft(x_fft_yx)/np.arange(len(x), 0, -1)
+  x = np.asarray(x, dtype=float)
+  y = np.asarray(y, dtype=float)
+  N = len(x)
+  xy = x * y
+  # sum_{t < N - tau} x(t)y(t) and sum_{t >= tau} x(t)y(t)
+  xy_sum_t = np.cumsum(xy)[::-1]
+  xy_sum_tau = np.cumsum(xy[::-1])[::-1]
+
+  # Zero padding to avoid circular correlations
+  n = 2**int(np.ceil(np.log2(2 * N)))
+  x_fft = np.fft.rfft(x, n)
+  y_fft = np.fft.rfft(y, n)
+  # sum_t x(t)*y(t+tau) and sum_t y(t)*x(t+tau)
+  x_ifft_xy = np.fft.irfft(np.conj(x_fft) * y_fft, n)[0:N]
+  x_ifft_yx = np.fft.irfft(np.conj(y_fft) * x_fft, n)[0:N]
   
-  return (xy_sum_tau + xy_sum_t - x_ifft_yx - x_ifft_xy)[:end]
+  return ((xy_sum_tau + xy_sum_t - x_ifft_yx - x_ifft_xy) / np.arange(N, 0, -1))[:end]
 
 
 def write_trajectory_to_txt(file_name, trajectory, params, location=True):
@@ -615,3 +729,222 @@ def gmres(A, b, x0=None, tol=1e-05, restart=None, maxiter=None, xtype=None, M=No
 
 
 
+
+
+def gcrodr(A, b, x0=None, tol=1e-05, restart=60, maxiter=None, M=None, callback=None, k=10, U=None):
+  '''
+  Solve the linear system A*x = b with GCRO-DR, restarted GMRES with 
+  deflated restarting and Krylov subspace recycling, see
+  M. L. Parks et al., SIAM J. Sci. Comput. 28, 1651 (2006).
+
+  As in gmres with PC_side = 'right' it solves A*P^{-1} * y = b 
+  and then x = P^{-1} * y. At the end of every cycle the code 
+  keeps the k harmonic Ritz vectors with the smallest Ritz values, 
+  they span an approximate invariant subspace that is used to deflate
+  the next cycles. The subspace U is returned so it can be reused
+  by the next solve, with a matrix A close to the present one, 
+  at the cost of k matrix vector products.
+
+  Inputs as in gmres plus
+  k : int, optional
+      Dimension of the recycled subspace. Default is 10.
+  U : array with shape (b.size, k), optional
+      Recycled subspace returned by a previous call.
+
+  Returns
+  -------
+  x : array
+      The solution of the linear system.
+  info : int
+      0 for success, >0 number of iterations if the
+      tolerance was not achieved.
+  U : array with shape (b.size, k)
+      Subspace to recycle in the next solve.
+  '''
+  n = b.size
+  A_LO = scspla.aslinearoperator(A)
+  if M is None:
+    APinv = A_LO.matvec
+    Pinv = lambda x: x
+  else:
+    M_LO = scspla.aslinearoperator(M)
+    APinv = lambda x: A_LO.matvec(M_LO.matvec(x))
+    Pinv = M_LO.matvec
+  if maxiter is None:
+    maxiter = 10 * n
+  k = min(k, restart - 1)
+
+  b_norm = np.linalg.norm(b)
+  if b_norm == 0:
+    return np.zeros(n), 0, U
+  y = np.zeros(n) if x0 is None else np.array(x0, dtype=float).reshape(n)
+  r = b - APinv(y) if x0 is not None else np.array(b, dtype=float).reshape(n)
+
+  # Project out the recycled subspace, with C = A*P^{-1}*U orthonormal
+  C = None
+  if U is not None and U.shape[0] == n:
+    C = np.array([APinv(u) for u in U.T]).T
+    C, R = np.linalg.qr(C)
+    U = np.linalg.solve(R.T, U.T).T
+    y += np.dot(U, np.dot(C.T, r))
+    r -= np.dot(C, np.dot(C.T, r))
+  else:
+    U = None
+
+  iterations = 0
+  while True:
+    beta = np.linalg.norm(r)
+    if beta <= tol * b_norm or iterations >= maxiter:
+      break
+
+    # Scale U to unit columns, A*P^{-1}*U_scaled = C*D
+    kc = 0 if C is None else C.shape[1]
+    if kc > 0:
+      D = 1.0 / np.linalg.norm(U, axis=0)
+      U = U * D
+
+    # Arnoldi process with (I - C*C^T)*A*P^{-1}
+    m = restart - kc
+    V = np.zeros((n, m + 1))
+    V[:, 0] = r / beta
+    G = np.zeros((kc + m + 1, kc + m))
+    if kc > 0:
+      G[0:kc, 0:kc] = np.diag(D)
+    rhs = np.zeros(kc + m + 1)
+    rhs[kc] = beta
+    for j in range(m):
+      w = APinv(V[:, j])
+      iterations += 1
+      if kc > 0:
+        G[0:kc, kc + j] = np.dot(C.T, w)
+        w -= np.dot(C, G[0:kc, kc + j])
+      # Orthogonalize with two passes of classical Gram-Schmidt
+      for l in range(2):
+        h = np.dot(V[:, 0:j+1].T, w)
+        w -= np.dot(V[:, 0:j+1], h)
+        G[kc:kc+j+1, kc + j] += h
+      G[kc + j + 1, kc + j] = np.linalg.norm(w)
+      if G[kc + j + 1, kc + j] > 0:
+        V[:, j+1] = w / G[kc + j + 1, kc + j]
+      # Solve least squares problem and compute residual
+      z = np.linalg.lstsq(G[0:kc+j+2, 0:kc+j+1], rhs[0:kc+j+2], rcond=-1)[0]
+      residual = np.linalg.norm(rhs[0:kc+j+2] - np.dot(G[0:kc+j+2, 0:kc+j+1], z))
+      if callback is not None:
+        callback(residual / b_norm)
+      if residual <= tol * b_norm or G[kc + j + 1, kc + j] == 0 or iterations >= maxiter:
+        break
+    j += 1
+
+    # Update solution and residual
+    W_hat = np.concatenate([U, V[:, 0:j]], axis=1) if kc > 0 else V[:, 0:j]
+    W = np.concatenate([C, V[:, 0:j+1]], axis=1) if kc > 0 else V[:, 0:j+1]
+    G = G[0:kc+j+1, 0:kc+j]
+    y += np.dot(W_hat, z)
+    r -= np.dot(W, np.dot(G, z))
+
+    # Harmonic Ritz vectors, G^T*G*p = theta*G^T*W^T*W_hat*p
+    WW = np.zeros((kc + j + 1, kc + j))
+    WW[kc:, kc:] = np.eye(j + 1, j)
+    if kc > 0:
+      WW[0:kc, 0:kc] = np.dot(C.T, U)
+      WW[kc:, 0:kc] = np.dot(V[:, 0:j+1].T, U)
+    theta, P = scipy.linalg.eig(np.dot(G.T, G), np.dot(G.T, WW))
+    order = np.argsort(np.abs(theta))[0:min(k, kc + j)]
+    # Real basis of the subspace spanned by the selected eigenvectors
+    P = np.concatenate([P[:, order].real, P[:, order].imag], axis=1)
+    P = scipy.linalg.orth(P)[:, 0:len(order)]
+    Q, R = np.linalg.qr(np.dot(G, P))
+    C = np.dot(W, Q)
+    U = np.linalg.solve(R.T, np.dot(W_hat, P).T).T
+
+  # Solve system P*x = y
+  x = Pinv(y)
+  info = 0 if np.linalg.norm(r) <= tol * b_norm else iterations
+  return x, info, U
+
+
+def block_gmres(A, B, X0=None, tol=1e-05, restart=20, maxiter=None, M=None, callback=None):
+  '''
+  Solve the linear systems A*X = B, with B an array (n, s),
+  with restarted block GMRES. All the columns share the same
+  block Krylov subspace, so every iteration needs one product
+  of A (and M) by a block of s vectors. Use LinearOperators
+  with a matmat function to compute these products at once.
+
+  As in gmres with PC_side = 'right' it solves A*P^{-1} * Y = B 
+  and then X = P^{-1} * Y.
+
+  Inputs as in gmres except
+  B : array with shape (n, s)
+      Right hand sides. 
+  X0 : array with shape (n, s), optional
+      Initial guess, for the preconditioned systems, Y.
+  restart : int, optional
+      Number of block iterations between restarts. Default is 20.
+  callback : function
+      It is called as callback(rk) after every block iteration, with rk 
+      the largest relative residual of the columns.
+
+  Returns
+  -------
+  X : array with shape (n, s)
+      The solution of the linear systems.
+  info : int
+      0 for success, >0 number of block iterations if the
+      tolerance was not achieved.
+  '''
+  n, s = B.shape
+  A_LO = scspla.aslinearoperator(A)
+  if M is None:
+    APinv = A_LO.matmat
+    Pinv = lambda X: X
+  else:
+    M_LO = scspla.aslinearoperator(M)
+    APinv = lambda X: A_LO.matmat(M_LO.matmat(X))
+    Pinv = M_LO.matmat
+  if maxiter is None:
+    maxiter = 10 * n
+
+  B_norm = np.linalg.norm(B, axis=0)
+  B_norm[B_norm == 0] = 1.0
+  Y = np.zeros((n, s)) if X0 is None else np.array(X0, dtype=float).reshape((n, s))
+  R = B - APinv(Y) if X0 is not None else np.array(B, dtype=float)
+
+  iterations = 0
+  while True:
+    if np.all(np.linalg.norm(R, axis=0) <= tol * B_norm) or iterations >= maxiter:
+      break
+
+    # Block Arnoldi process, A*P^{-1}*V_j = V_{j+1}*H_j
+    m = restart
+    V = np.zeros((n, (m + 1) * s))
+    H = np.zeros(((m + 1) * s, m * s))
+    V[:, 0:s], S = np.linalg.qr(R)
+    rhs = np.zeros(((m + 1) * s, s))
+    rhs[0:s] = S
+    for j in range(m):
+      W = APinv(V[:, j*s:(j+1)*s])
+      iterations += 1
+      # Orthogonalize with two passes of block classical Gram-Schmidt
+      for l in range(2):
+        h = np.dot(V[:, 0:(j+1)*s].T, W)
+        W -= np.dot(V[:, 0:(j+1)*s], h)
+        H[0:(j+1)*s, j*s:(j+1)*s] += h
+      V[:, (j+1)*s:(j+2)*s], H[(j+1)*s:(j+2)*s, j*s:(j+1)*s] = np.linalg.qr(W)
+      # Solve least squares problem and compute residuals
+      Z = np.linalg.lstsq(H[0:(j+2)*s, 0:(j+1)*s], rhs[0:(j+2)*s], rcond=-1)[0]
+      residual = np.linalg.norm(rhs[0:(j+2)*s] - np.dot(H[0:(j+2)*s, 0:(j+1)*s], Z), axis=0) / B_norm
+      if callback is not None:
+        callback(np.max(residual))
+      if np.all(residual <= tol) or iterations >= maxiter:
+        break
+    j += 1
+
+    # Update solution and residual
+    Y += np.dot(V[:, 0:j*s], Z)
+    R = np.dot(V[:, 0:(j+1)*s], rhs[0:(j+1)*s] - np.dot(H[0:(j+1)*s, 0:j*s], Z))
+
+  # Solve system P*X = Y
+  X = Pinv(Y)
+  info = 0 if np.all(np.linalg.norm(R, axis=0) <= tol * B_norm) else iterations
+  return X, info
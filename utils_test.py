@@ -0,0 +1,199 @@
+''' Unit tests for the MSD functions and the linear solvers in utils. '''
+
+import unittest
+import numpy as np
+
+from quaternion_integrator.quaternion import Quaternion
+from utils import calc_total_msd_from_matrix_and_center
+from utils import calc_msd_fft
+from utils import fft_msd
+from utils import gmres
+from utils import gcrodr
+from utils import block_gmres
+
+class TestMSD(unittest.TestCase):
+
+  def setUp(self):
+    pass
+
+  def random_trajectory(self, T):
+    ''' Random walk of locations and orientations. '''
+    locations = np.cumsum(np.random.normal(0., 0.1, (T, 3)), axis=0)
+    orientations = np.empty((T, 4))
+    q = np.random.normal(0., 1., 4)
+    for k in range(T):
+      q = q + np.random.normal(0., 0.1, 4)
+      q = q / np.linalg.norm(q)
+      orientations[k] = q
+    return locations, orientations
+
+
+  def test_fft_msd(self):
+    ''' Compare fft_msd with the direct average over time origins.'''
+    x = np.cumsum(np.random.normal(0., 1., 200))
+    y = np.cumsum(np.random.normal(0., 1., 200))
+    end = 50
+    msd = fft_msd(x, y, end)
+    self.assertEqual(len(msd), end)
+    for tau in range(end):
+      msd_direct = np.mean((x[tau:] - x[:len(x) - tau]) * (y[tau:] - y[:len(y) - tau]))
+      self.assertAlmostEqual(msd[tau], msd_direct)
+
+
+  def test_calc_msd_fft(self):
+    ''' Compare calc_msd_fft with calc_total_msd_from_matrix_and_center
+    for all the origins and for a window of origins.'''
+    T = 60
+    num_lags = 20
+    locations, orientations = self.random_trajectory(T)
+    R = [Quaternion(q).rotation_matrix() for q in orientations]
+    u_hat = [[R[k][:, 0], R[k][:, 1], R[k][:, 2]] for k in range(T)]
+    for first_origin, num_origins in [(0, None), (3, 30)]:
+      msd = calc_msd_fft(locations, orientations, num_lags, first_origin = first_origin, num_origins = num_origins)
+      self.assertEqual(msd.shape, (num_lags, 6, 6))
+      for l in range(num_lags):
+        if num_origins is None:
+          origins = range(T - l)
+        else:
+          origins = range(first_origin, first_origin + num_origins)
+        msd_direct = np.zeros((6, 6))
+        for t in origins:
+          msd_direct += calc_total_msd_from_matrix_and_center(locations[t], u_hat[t], locations[t + l], u_hat[t + l])
+        msd_direct /= len(origins)
+        for j in range(6):
+          for k in range(6):
+            self.assertAlmostEqual(msd[l, j, k], msd_direct[j, k])
+
+
+class TestSolvers(unittest.TestCase):
+
+  def setUp(self):
+    pass
+
+  def nonsymmetric_matrix(self, n):
+    ''' Nonsymmetric matrix with a few small eigenvalues. '''
+    d = np.concatenate([np.logspace(-3, -1, 8), np.random.uniform(1.0, 3.0, n - 8)])
+    return np.diag(d) + 0.2 * np.random.randn(n, n) / np.sqrt(n)
+
+
+  def test_gcrodr(self):
+    ''' Compare gcrodr with gmres on a nonsymmetric system.'''
+    n = 200
+    A = self.nonsymmetric_matrix(n)
+    b = np.random.randn(n)
+    M = np.diag(1.0 / np.diag(A))
+    residuals = []
+    x, info, U = gcrodr(A, b, tol=1e-10, restart=30, M=M, k=10, callback=residuals.append)
+    x_gmres, info_gmres = gmres(A, b, tol=1e-10, restart=30, M=M)
+    self.assertEqual(info, 0)
+    self.assertEqual(U.shape, (n, 10))
+    self.assertTrue(residuals[-1] <= 1e-10)
+    self.assertTrue(np.linalg.norm(np.dot(A, x) - b) <= 1e-10 * np.linalg.norm(b))
+    self.assertTrue(np.allclose(x, x_gmres, rtol=0, atol=1e-08 * np.linalg.norm(x)))
+
+
+  def test_gcrodr_recycling(self):
+    ''' Test that recycling U along a slowly changing sequence of
+    systems reduces the number of iterations.'''
+    n = 200
+    A = self.nonsymmetric_matrix(n)
+    E = np.random.randn(n, n) / np.sqrt(n)
+    iterations = []
+    iterations_recycling = []
+    U = None
+    for step in range(5):
+      A_step = A + 1e-03 * step * E
+      b = np.random.randn(n)
+      x, info, U = gcrodr(A_step, b, tol=1e-08, restart=30, k=10, U=U, callback=iterations_recycling.append)
+      self.assertEqual(info, 0)
+      self.assertTrue(np.linalg.norm(np.dot(A_step, x) - b) <= 1e-08 * np.linalg.norm(b))
+      x, info, U_new = gcrodr(A_step, b, tol=1e-08, restart=30, k=10, callback=iterations.append)
+      self.assertEqual(info, 0)
+    self.assertTrue(len(iterations_recycling) < 0.75 * len(iterations))
+
+
+  def test_gcrodr_arguments(self):
+    ''' Test the x0, b = 0 and maxiter paths of gcrodr.'''
+    n = 100
+    A = self.nonsymmetric_matrix(n)
+    b = np.random.randn(n)
+    U = np.random.randn(n, 10)
+
+    # b = 0 returns x = 0 and the same subspace
+    x, info, U_out = gcrodr(A, np.zeros(n), U=U)
+    self.assertEqual(info, 0)
+    self.assertTrue(np.all(x == 0))
+    self.assertTrue(U_out is U)
+
+    # x0 close to the solution needs fewer iterations
+    x_exact = np.linalg.solve(A, b)
+    residuals = []
+    x, info, U_out = gcrodr(A, b, tol=1e-10, restart=30, callback=residuals.append)
+    residuals_x0 = []
+    x, info, U_out = gcrodr(A, b, x0=x_exact + 1e-06 * np.random.randn(n), tol=1e-10, restart=30, callback=residuals_x0.append)
+    self.assertEqual(info, 0)
+    self.assertTrue(np.allclose(x, x_exact, rtol=0, atol=1e-08 * np.linalg.norm(x_exact)))
+    self.assertTrue(len(residuals_x0) < len(residuals))
+    residuals_x0 = []
+    x, info, U_out = gcrodr(A, b, x0=x_exact, tol=1e-10, callback=residuals_x0.append)
+    self.assertEqual(info, 0)
+    self.assertEqual(len(residuals_x0), 0)
+
+    # maxiter stops the solver and info returns the number of iterations
+    residuals = []
+    x, info, U_out = gcrodr(A, b, tol=1e-14, restart=10, maxiter=25, callback=residuals.append)
+    self.assertEqual(info, 25)
+    self.assertEqual(len(residuals), 25)
+
+
+  def test_block_gmres(self):
+    ''' Compare every column of block_gmres with gmres, B has repeated,
+    zero and linearly dependent columns.'''
+    n = 200
+    A = self.nonsymmetric_matrix(n)
+    M = np.diag(1.0 / np.diag(A))
+    B = np.random.randn(n, 5)
+    B[:, 1] = B[:, 0]
+    B[:, 2] = 0
+    B[:, 4] = B[:, 0] + 2.0 * B[:, 3]
+    residuals = []
+    X, info = block_gmres(A, B, tol=1e-10, restart=20, M=M, callback=residuals.append)
+    self.assertEqual(info, 0)
+    self.assertTrue(residuals[-1] <= 1e-10)
+    self.assertTrue(np.all(X[:, 2] == 0))
+    for j in range(5):
+      self.assertTrue(np.linalg.norm(np.dot(A, X[:, j]) - B[:, j]) <= 1e-10 * max(np.linalg.norm(B[:, j]), 1.0))
+      x_gmres, info_gmres = gmres(A, B[:, j], tol=1e-10, restart=30, M=M)
+      self.assertTrue(np.allclose(X[:, j], x_gmres, rtol=0, atol=1e-08 * max(np.linalg.norm(x_gmres), 1.0)))
+
+
+  def test_block_gmres_convergence(self):
+    ''' Test that every column converges to its own tolerance and
+    the callback and maxiter contract of block_gmres.'''
+    n = 200
+    A = self.nonsymmetric_matrix(n)
+    B = np.random.randn(n, 3)
+    B[:, 1] *= 1e-06
+    X, info = block_gmres(A, B, tol=1e-08, restart=20)
+    self.assertEqual(info, 0)
+    for j in range(3):
+      self.assertTrue(np.linalg.norm(np.dot(A, X[:, j]) - B[:, j]) <= 1e-08 * np.linalg.norm(B[:, j]))
+
+    # Initial guess equal to the solution
+    residuals = []
+    X0, info = block_gmres(A, B, X0=X, tol=1e-08, callback=residuals.append)
+    self.assertEqual(info, 0)
+    self.assertEqual(len(residuals), 0)
+
+    # The callback is called once per block iteration with the largest
+    # relative residual and maxiter stops the solver
+    residuals = []
+    X, info = block_gmres(A, B, tol=1e-14, restart=5, maxiter=12, callback=residuals.append)
+    self.assertEqual(info, 12)
+    self.assertEqual(len(residuals), 12)
+    R = np.linalg.norm(np.dot(A, X) - B, axis=0) / np.linalg.norm(B, axis=0)
+    self.assertAlmostEqual(residuals[-1] / np.max(R), 1.0, places=5)
+
+
+if __name__ == '__main__':
+  unittest.main()